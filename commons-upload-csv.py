@@ -6,18 +6,29 @@
 # nmnhbotany_2546215,https://ids.si.edu/ids/download?id=NMNH-00651834.jpg,Etlingera sp._nmnhbotany_2546215_NMNH-00651834.jpg,Uploaded by Wiki API Connector,"{{Information... }}"
 
 import os
+import re
 import sys
 import requests
+import wacsession
 import hashlib
 import pywikibot
 import csv
 import argparse
 import logging
-import tqdm
+import threading
+import time
+import sqlite3
+import tempfile
+import mimetypes
+import concurrent.futures
 
-from urllib.parse import urlparse
-from typing import Optional, List, Tuple
-from pywikibot.specialbots import UploadRobot
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from urllib.parse import urlparse, urljoin
+from typing import Optional, List, Tuple, Dict, Set, Iterable, BinaryIO
+from pywikibot.comms import http as pywikibot_http
+from pywikibot.data.api import Request
+from pywikibot.exceptions import APIError, MaxlagTimeoutError, UploadError
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)  # Adjust the logging level as needed
@@ -26,35 +37,132 @@ logger = logging.getLogger(__name__)
 # Configure Pywikibot
 from pywikibot import config
 config.usernames['commons']['commons'] = 'Fuzheado'
+config.put_throttle = 0  # Pacing is done by UploadThrottle, which reacts to maxlag instead of a fixed wait
+config.max_retries = 5   # Per API request, so a failed upload chunk is retried on its own
 
-def get_final_url(url: str, max_redirects: int = 10, current_redirects: int = 0) -> Optional[str]:
+DEFAULT_WORKERS = 4                             # Uploads kept in flight at once
+DEFAULT_CHUNK_THRESHOLD = 50 * 1024 * 1024      # Files larger than this use chunked upload
+DEFAULT_CHUNK_SIZE = 5 * 1024 * 1024
+DEFAULT_LEDGER = 'upload_ledger.sqlite'
+DEFAULT_URL_CACHE = 'resolved_urls.sqlite'
+DEFAULT_RESOLVE_WORKERS = 16
+DEFAULT_READ_WORKERS = 4
+
+# Columnar input (.parquet/.arrow, written by the generator) is read by column name, CSV by position
+COLUMNAR_EXTENSIONS = ('.parquet', '.arrow')
+CSV_COLUMNS = ['record_id', 'source_image_url', 'commons_filename', 'edit_summary', 'description']
+DEFAULT_TIMEOUT = (5, 10)  # (connect, read) seconds
+DEFAULT_SPOOL_THRESHOLD = 64 * 1024 * 1024       # Stream mode keeps images up to this size in memory
+DEFAULT_SPOOL_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else None  # Where larger images spill (tmpfs)
+DEFAULT_DOWNLOAD_ATTEMPTS = 5  # Connections per download (or per range), each resuming where the last stopped
+DEFAULT_PARALLEL_RANGES = 4    # Ranges fetched at once for images above --parallel-threshold
+
+# MediaWiki API error codes that mean "slow down" rather than "this upload is bad"
+THROTTLE_ERROR_CODES = {'maxlag', 'ratelimited', 'actionthrottledtext', 'throttled'}
+
+@dataclass
+class ResolvedUrl:
+    url: str
+    final_url: Optional[str]
+    status: int
+    content_length: Optional[int]
+
+def get_final_url(url: str, max_redirects: int = 10, timeout=DEFAULT_TIMEOUT) -> ResolvedUrl:
     """
-    Get the final URL after following redirects up to a specified maximum number.
+    Follow redirects for a URL with HEAD requests, up to max_redirects hops.
 
-    This function sends an HTTP GET request to the provided URL and follows redirects
-    until the final URL is reached or the maximum number of redirects is exceeded.
+    Returns the final URL, its HTTP status and Content-Length. final_url is None if the chain is broken,
+    too long, or ends in anything but a 200. Servers that refuse HEAD get a streamed GET whose body is never read.
     """
+    current = url
     try:
-        if current_redirects >= max_redirects:
-            return None
+        for _ in range(max_redirects + 1):
+            response = wacsession.get_policy().request(wacsession.get_session('images'), 'HEAD', current,
+                                                       allow_redirects=False, timeout=timeout)
+            if response.status_code in (405, 501):
+                response = wacsession.get_session('images').get(current, allow_redirects=False, timeout=timeout, stream=True)
+                response.close()
+            status_code = response.status_code
 
-        response = requests.get(url, allow_redirects=False)
-        status_code = response.status_code
-
-        # print ('Status code: ', status_code)
-        if status_code == 200:
-            return url
-        elif status_code in [301, 302, 307, 308]:
-            redirected_url = response.headers.get("Location")
-            if redirected_url:
-                return get_final_url(redirected_url, max_redirects, current_redirects + 1)
+            if status_code == 200:
+                length = response.headers.get('Content-Length')
+                return ResolvedUrl(url, current, status_code, int(length) if length and length.isdigit() else None)
+            elif status_code in [301, 302, 303, 307, 308] and response.headers.get('Location'):
+                current = urljoin(current, response.headers['Location'])
             else:
-                return None
-        else:
-            return None  # Handle other status codes as needed
-
+                return ResolvedUrl(url, None, status_code, None)
     except requests.RequestException as e:
-        return None
+        logger.debug(f"Error resolving {url}: {e}")
+        return ResolvedUrl(url, None, 0, None)
+
+    return ResolvedUrl(url, None, 0, None)  # Too many redirects
+
+class ResolvedUrlCache:
+    """
+    Persistent sqlite cache of source URL -> final URL, status and Content-Length.
+
+    Successful resolutions are trusted for ttl seconds; failures for failed_ttl, so a dead link
+    is rechecked sooner than a good one.
+    """
+    def __init__(self, path: str = DEFAULT_URL_CACHE, ttl: int = 30 * 86400, failed_ttl: int = 86400):
+        self.path = path
+        self.ttl = ttl
+        self.failed_ttl = failed_ttl
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS resolved_urls (
+                                url TEXT PRIMARY KEY,
+                                final_url TEXT,
+                                status INTEGER,
+                                content_length INTEGER,
+                                checked REAL NOT NULL)''')
+        self.conn.commit()
+
+    def get_many(self, urls: Iterable[str]) -> Dict[str, ResolvedUrl]:
+        """Fresh cache entries for the given URLs."""
+        found = {}
+        now = time.time()
+        urls = list(urls)
+        for i in range(0, len(urls), 500):  # Stay under sqlite's bound-parameter limit
+            batch = urls[i:i + 500]
+            cursor = self.conn.execute(
+                'SELECT url, final_url, status, content_length, checked FROM resolved_urls '
+                f'WHERE url IN ({",".join("?" * len(batch))})', batch)
+            for url, final_url, status, content_length, checked in cursor:
+                ttl = self.ttl if final_url else self.failed_ttl
+                if now - checked < ttl:
+                    found[url] = ResolvedUrl(url, final_url, status, content_length)
+        return found
+
+    def put_many(self, resolved: List[ResolvedUrl]) -> None:
+        now = time.time()
+        self.conn.executemany('INSERT OR REPLACE INTO resolved_urls VALUES (?, ?, ?, ?, ?)',
+                              [(r.url, r.final_url, r.status, r.content_length, now) for r in resolved])
+        self.conn.commit()
+
+    def close(self) -> None:
+        self.conn.close()
+
+def resolve_urls(urls: List[str], cache: Optional[ResolvedUrlCache] = None,
+                 workers: int = DEFAULT_RESOLVE_WORKERS) -> Dict[str, ResolvedUrl]:
+    """
+    Resolve a batch of source URLs concurrently, consulting and filling the cache.
+    """
+    unique_urls = set(url for url in urls if url and is_valid_url(url))
+    results = cache.get_many(unique_urls) if cache is not None else {}
+    misses = [url for url in unique_urls if url not in results]
+
+    if misses:
+        with wacsession.ProgressBar(total=len(misses), unit='url', desc='Resolving URLs') as pbar, \
+             concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            fresh = []
+            for resolved in executor.map(get_final_url, misses):
+                fresh.append(resolved)
+                pbar.update(1)
+        if cache is not None:
+            cache.put_many(fresh)
+        results.update((r.url, r) for r in fresh)
+
+    return results
 
 def is_valid_url(url: str) -> bool:
     """Check if the URL is well-formed."""
@@ -64,99 +172,758 @@ def is_valid_url(url: str) -> bool:
     except ValueError:
         return False
 
-def download_image(url: str, filename: str) -> Optional[str]:
-    """Download the image from the URL and save it as the given filename."""
+def response_validator(response: requests.Response) -> Optional[str]:
+    """The If-Range validator of a response: its ETag if that is strong, else its Last-Modified date, or None."""
+    etag = response.headers.get('ETag')
+    if etag and not etag.startswith('W/'):
+        return etag
+    return response.headers.get('Last-Modified')
+
+def fetch_range(url: str, write, start: int = 0, end: Optional[int] = None, restart=None,
+                attempts: int = DEFAULT_DOWNLOAD_ATTEMPTS, validator: Optional[str] = None,
+                on_validator=None) -> Optional[int]:
+    """
+    GET url from byte start up to byte end (inclusive; None for the end of the file), passing each block
+    to write. After a dropped connection or a short read the transfer resumes with a Range request from
+    the last byte received, up to attempts connections in all. The length received is checked against
+    Content-Range/Content-Length.
+
+    Range requests carry If-Range with validator (the ETag or Last-Modified of the bytes already written)
+    when it is known, so a file that changed in between comes back whole rather than spliced. Whenever the
+    server answers a Range request with the whole file (it changed, or the server ignores Range), restart()
+    is called and the download starts over from byte 0. Without restart, or for a bounded range (end set),
+    that is a failure. on_validator, if given, is called with the validator of the file being received
+    whenever it is first learned or changes.
+    Returns the position after the last byte received, or None if the download failed.
+    """
+    position = start
+    expected_end = end
+    for attempt in range(attempts):
+        headers = {}
+        if position > 0 or end is not None:
+            headers['Range'] = f"bytes={position}-{'' if end is None else end}"
+            if validator:
+                headers['If-Range'] = validator
+        try:
+            with wacsession.get_policy().request(wacsession.get_session('images'), 'GET', url, hedge=True,
+                                                 allow_redirects=True, timeout=DEFAULT_TIMEOUT, stream=True,
+                                                 headers=headers) as response:
+                if response.status_code == 416:
+                    # Nothing left to send: fine if we already have the whole file
+                    m = re.match(r'bytes \*/(\d+)', response.headers.get('Content-Range', ''))
+                    if m and end is None and position == int(m.group(1)):
+                        return position
+                response.raise_for_status()
+                if response.status_code == 206:
+                    m = re.match(r'bytes (\d+)-(\d+)/', response.headers.get('Content-Range', ''))
+                    if not m or int(m.group(1)) != position:
+                        logger.error(f"Unexpected Content-Range {response.headers.get('Content-Range')!r} from {url}")
+                        return None
+                    expected_end = int(m.group(2))
+                else:
+                    if position > 0 or end is not None:
+                        if restart is None or end is not None:
+                            logger.error(f"{url} sent the whole file in answer to a ranged request")
+                            return None
+                        logger.info(f"{url} sent the whole file (it changed, or ignores Range), starting over")
+                        restart()
+                        start = position = 0
+                    length = response.headers.get('Content-Length')
+                    # Content-Length counts encoded bytes, which iter_content decodes
+                    expected_end = int(length) - 1 if length and not response.headers.get('Content-Encoding') else None
+                received_validator = response_validator(response) or (validator if response.status_code == 206 else None)
+                if received_validator != validator or attempt == 0:
+                    validator = received_validator
+                    if on_validator is not None:
+                        on_validator(validator)
+                for block in response.iter_content(chunk_size=1024 * 1024):
+                    write(block)
+                    position += len(block)
+            if expected_end is None or position == expected_end + 1:
+                return position
+            logger.warning(f"Short read from {url}: {position - start} of {expected_end + 1 - start} bytes, resuming")
+        except requests.HTTPError as e:
+            logger.error(f"Error occurred while downloading the image: {e}")
+            return None
+        except requests.RequestException as e:
+            logger.warning(f"Download of {url} interrupted after {position - start} bytes, resuming: {e}")
+        time.sleep(min(30, 2 ** attempt))
+    logger.error(f"Giving up on {url} after {attempts} attempts ({position - start} bytes received)")
+    return None
+
+def counting(write, stats: Optional['IOStats'] = None):
+    """Wrap a write function so the bytes it writes to the working directory are added to stats."""
+    if stats is None:
+        return write
+
+    def counted(block: bytes) -> None:
+        write(block)
+        stats.add(written=len(block))
+    return counted
+
+def download_parallel(url: str, path: str, size: int, ranges: int = DEFAULT_PARALLEL_RANGES,
+                      stats: Optional['IOStats'] = None) -> bool:
+    """
+    Download a file of known size into path as `ranges` byte ranges fetched at the same time, each
+    resuming on its own after failures. Returns False if any range failed, the server does not do ranges,
+    or the ranges came from different versions of the file.
+    """
+    with open(path, 'wb') as f:
+        f.truncate(size)
+    step = -(-size // ranges)
+    bounds = [(start, min(start + step, size) - 1) for start in range(0, size, step)]
+    validators = set()
+
+    def fetch(bound):
+        start, end = bound
+        with open(path, 'r+b') as f:
+            f.seek(start)
+            return fetch_range(url, counting(f.write, stats), start, end, on_validator=validators.add) == end + 1
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(bounds)) as executor:
+        complete = all(executor.map(wacsession.in_current_scope(fetch), bounds))
+    if len(validators - {None}) > 1:
+        logger.warning(f"{url} changed during the parallel download")
+        return False
+    return complete
+
+def download_image(url: str, filename: str, parallel_threshold: Optional[int] = None,
+                   parallel_ranges: int = DEFAULT_PARALLEL_RANGES, stats: Optional['IOStats'] = None) -> Optional[str]:
+    """
+    Download the image from the URL and save it as the given filename.
+
+    Bytes go to filename.part first, and the download resumes with Range requests after failures,
+    including from a .part file left by an earlier run. The file's validator (see fetch_range) is kept in
+    filename.part.validator, so a .part file is only resumed if the file has not changed since; one without
+    a validator is started over. The file is renamed into place only once its length checks out. Images larger than parallel_threshold bytes (if set, and if a HEAD request reports
+    the size) are fetched as parallel_ranges ranges at once. Bytes written are added to stats, if given.
+    """
     if not url:
         logger.debug("URL is empty or None. Skipping.")
         return None        
     if not is_valid_url(url):
-        logger.error("Invalid URL: ", url)
+        logger.error(f"Invalid URL: {url}")
         return None
-    try:
-        response = requests.get(url, allow_redirects=True, timeout=10)
-        response.raise_for_status()
-        with open(filename, 'wb') as f:
-            f.write(response.content)
-        return filename
-    except requests.RequestException as e:
-        logger.error(f"Error occurred while downloading the image: {e}")
+    part = filename + '.part'
+    validator_file = part + '.validator'
+
+    if parallel_threshold:
+        head = get_final_url(url)
+        if head.final_url and head.content_length and head.content_length > parallel_threshold:
+            if download_parallel(head.final_url, part, head.content_length, parallel_ranges, stats):
+                os.replace(part, filename)
+                return filename
+            logger.info(f"Parallel download of {url} failed, falling back to a single connection")
+            os.remove(part)
+
+    validator = None
+    if os.path.exists(part):
+        try:
+            with open(validator_file) as vf:
+                validator = vf.read().strip() or None
+        except FileNotFoundError:
+            pass
+        if validator is None:
+            logger.info(f"Cannot tell whether {url} changed since {part} was written, starting over")
+            os.remove(part)
+
+    def save_validator(value: Optional[str]) -> None:
+        if value:
+            with open(validator_file, 'w') as vf:
+                vf.write(value)
+        elif os.path.exists(validator_file):
+            os.remove(validator_file)
+
+    with open(part, 'ab') as f:
+        def restart():
+            f.seek(0)
+            f.truncate()
+        received = fetch_range(url, counting(f.write, stats), f.tell(), restart=restart,
+                               validator=validator, on_validator=save_validator)
+    if received is None:
+        return None  # The .part file is kept, so the next run resumes it
+    os.replace(part, filename)
+    save_validator(None)
+    return filename
+
+class IOStats:
+    """
+    Thread-safe tally of where image bytes went on their way to Commons, for comparing file and stream modes.
+
+    written and read are counted block by block as this tool writes and reads files in the working directory.
+    pywikibot reads the file itself for a file-mode upload, which cannot be observed from here, so upload_read
+    is the size of each file uploaded that way: an estimate.
+    """
+    def __init__(self):
+        self.uploaded = 0      # Bytes sent to Commons
+        self.written = 0       # Bytes written to the working directory (measured)
+        self.read = 0          # Bytes read back from the working directory (measured)
+        self.upload_read = 0   # Bytes pywikibot read from the working directory to upload them (estimated)
+        self.memory = 0        # Bytes that stayed in an in-memory buffer
+        self.spilled = 0       # Bytes spilled to the spool directory (tmpfs)
+        self._lock = threading.Lock()
+
+    def add(self, **counts: int) -> None:
+        with self._lock:
+            for name, count in counts.items():
+                setattr(self, name, getattr(self, name) + count)
+
+    def report(self) -> str:
+        """One-line summary, normalised to local I/O per GB uploaded."""
+        gb_uploaded = self.uploaded / 1024 ** 3
+        per_gb = (lambda n: f"{n / 1024 ** 2 / gb_uploaded:.0f} MB/GB") if gb_uploaded else (lambda n: "n/a")
+        return (f"Uploaded {self.uploaded / 1024 ** 2:.1f} MB; "
+                f"working dir written {self.written / 1024 ** 2:.1f} MB ({per_gb(self.written)}), "
+                f"read {self.read / 1024 ** 2:.1f} MB ({per_gb(self.read)}), "
+                f"plus an estimated {self.upload_read / 1024 ** 2:.1f} MB read for uploads ({per_gb(self.upload_read)}); "
+                f"tmpfs spill {self.spilled / 1024 ** 2:.1f} MB ({per_gb(self.spilled)}), "
+                f"in memory {self.memory / 1024 ** 2:.1f} MB")
+
+def download_to_buffer(url: str,
+                       spool_threshold: int = DEFAULT_SPOOL_THRESHOLD,
+                       spool_dir: Optional[str] = DEFAULT_SPOOL_DIR) -> Optional[Tuple[BinaryIO, int, str]]:
+    """
+    Stream the image at url into a spooled buffer without touching the working directory.
+
+    The buffer stays in memory up to spool_threshold bytes and spills to a file in spool_dir
+    (tmpfs by default) above that. Returns the buffer rewound to the start, its size and SHA1.
+    """
+    if not url or not is_valid_url(url):
+        logger.debug(f"Invalid or empty URL, skipping: {url}")
+        return None
+    buffer = tempfile.SpooledTemporaryFile(max_size=spool_threshold, dir=spool_dir)
+    sha1 = [hashlib.sha1()]
+
+    def write(block: bytes) -> None:
+        buffer.write(block)
+        sha1[0].update(block)
+
+    def restart() -> None:
+        buffer.seek(0)
+        buffer.truncate()
+        sha1[0] = hashlib.sha1()
+
+    # Resumes with Range requests after dropped connections, see fetch_range
+    size = fetch_range(url, write, restart=restart)
+    if size is None:
+        buffer.close()
+        return None
+    buffer.seek(0)
+    return buffer, size, sha1[0].hexdigest()
+
+class UploadThrottle:
+    """
+    Adaptive pacing shared by all upload workers.
+
+    Uploads are spaced at least `delay` seconds apart. The delay doubles whenever Commons answers
+    with maxlag or a rate limit, and decays back towards min_delay as uploads succeed.
+    """
+    def __init__(self, min_delay: float = 0.0, max_delay: float = 300.0):
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.delay = min_delay
+        self._next_slot = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self) -> None:
+        """Block until this worker's upload slot comes up."""
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.delay
+        if slot > now:
+            time.sleep(slot - now)
+
+    def backoff(self, retry_after: float = 0.0) -> None:
+        """Slow down after a maxlag or throttle response."""
+        with self._lock:
+            self.delay = min(self.max_delay, max(self.delay * 2, 1.0, retry_after))
+            self._next_slot = max(self._next_slot, time.monotonic() + max(self.delay, retry_after))
+            logger.info(f"Commons asked us to slow down, upload delay now {self.delay:.1f}s")
+
+    def success(self) -> None:
+        """Ease off the delay after a clean upload."""
+        with self._lock:
+            self.delay = max(self.min_delay, self.delay * 0.9)
+            if self.delay < 0.1:
+                self.delay = self.min_delay
+
+class CommonsUploader:
+    """
+    Upload engine holding one authenticated Commons session for a whole run.
+
+    Files larger than chunk_threshold go up in chunk_size pieces. Each chunk is its own API request,
+    and pywikibot retries a failed request (up to config.max_retries) without restarting the file.
+    spool_threshold and spool_dir control the in-memory buffers used by stream mode, and images above
+    parallel_threshold bytes are downloaded as parallel_ranges ranges at once in file mode.
+    """
+    def __init__(self,
+                 site: Optional[pywikibot.site.BaseSite] = None,
+                 throttle: Optional[UploadThrottle] = None,
+                 chunk_threshold: int = DEFAULT_CHUNK_THRESHOLD,
+                 chunk_size: int = DEFAULT_CHUNK_SIZE,
+                 spool_threshold: int = DEFAULT_SPOOL_THRESHOLD,
+                 spool_dir: Optional[str] = DEFAULT_SPOOL_DIR,
+                 parallel_threshold: Optional[int] = None,
+                 parallel_ranges: int = DEFAULT_PARALLEL_RANGES,
+                 max_attempts: int = 3):
+        self.site = site if site is not None else pywikibot.Site('commons', 'commons')
+        self.site.login()
+        # Load what every row needs (module info for SHA-1 lookups, site extensions and allowed file types,
+        # the CSRF token) once here, so the first rows do not race to fetch it and it is not charged to
+        # their request budget
+        self.site.allimages(sha1='0' * 40, total=1)
+        self.site.siteinfo.get('extensions')
+        self.site.siteinfo.get('fileextensions')
+        self.site.tokens['csrf']
+        self.throttle = throttle if throttle is not None else UploadThrottle()
+        self.chunk_threshold = chunk_threshold
+        self.chunk_size = chunk_size
+        self.spool_threshold = spool_threshold
+        self.spool_dir = spool_dir
+        self.parallel_threshold = parallel_threshold
+        self.parallel_ranges = parallel_ranges
+        self.max_attempts = max_attempts
+
+    def find_duplicate(self, sha1_hash: str) -> Optional[str]:
+        """Return the title of a file already on Wikimedia Commons with this SHA1 hash, if any."""
+        for page in self.site.allimages(sha1=sha1_hash, total=1):
+            if page.exists():
+                return page.title()
         return None
 
-def file_exists_on_commons(filename: str) -> bool:
-    """Check if the file already exists on Wikimedia Commons using SHA1 hash."""
-    site = pywikibot.Site('commons', 'commons')
-    sha1_hash = hashlib.sha1(open(filename, 'rb').read()).hexdigest()
-    return any(page.exists() for page in site.allimages(sha1=sha1_hash))
+    def upload(self, filepath: str, filename: str, description: str, edit_summary: str) -> bool:
+        """
+        Upload the file to Wikimedia Commons, aborting on any upload warning (name taken, duplicate, etc.)
+        """
+        if not filepath:
+            logger.debug("Missing filepath, skipping")
+            return False
+
+        filepage = pywikibot.FilePage(self.site, filename)
+        chunk_size = self.chunk_size if os.path.getsize(filepath) > self.chunk_threshold else 0
 
-def upload_to_commons(filepath: str, filename: str, description: str, edit_summary: str) -> None:
+        for attempt in range(1, self.max_attempts + 1):
+            self.throttle.wait()
+            try:
+                uploaded = filepage.upload(filepath,
+                                           comment=edit_summary,
+                                           text=description,
+                                           chunk_size=chunk_size,
+                                           ignore_warnings=False,
+                                           report_success=False)
+            except UploadError as e:
+                logger.info(f"Upload of {filename} aborted: {e}")
+                return False
+            except MaxlagTimeoutError:
+                self.throttle.backoff()
+                continue
+            except APIError as e:
+                if e.code not in THROTTLE_ERROR_CODES:
+                    raise
+                self.throttle.backoff()
+                continue
+            self.throttle.success()
+            return uploaded
+
+        logger.error(f"Giving up on {filename} after {self.max_attempts} throttled attempts")
+        return False
+
+    def _post(self, params: dict, mime: Optional[dict] = None) -> dict:
+        """
+        Submit one upload API request, retrying it on maxlag/throttle responses.
+        Returns the 'upload' part of the response.
+        """
+        for attempt in range(1, self.max_attempts + 1):
+            self.throttle.wait()
+            try:
+                request = Request(site=self.site, parameters=dict(params, token=self.site.tokens['csrf']), mime=mime)
+                result = request.submit()['upload']
+            except MaxlagTimeoutError:
+                self.throttle.backoff()
+                continue
+            except APIError as e:
+                if e.code not in THROTTLE_ERROR_CODES:
+                    raise
+                self.throttle.backoff()
+                continue
+            self.throttle.success()
+            return result
+        raise UploadError('throttled', f"Gave up after {self.max_attempts} throttled attempts")
+
+    def upload_stream(self, buffer: BinaryIO, size: int, filename: str, description: str, edit_summary: str) -> bool:
+        """
+        Upload straight from an open buffer, aborting on any upload warning.
+
+        Buffers larger than chunk_threshold are stashed in chunk_size pieces, each retried on its own,
+        and then published from the stash.
+        """
+        mimetype = (mimetypes.guess_type(filename)[0] or 'application/octet-stream').split('/')
+        params = {'action': 'upload', 'filename': filename, 'comment': edit_summary, 'text': description}
+        try:
+            if size <= self.chunk_threshold:
+                result = self._post(params, mime={'file': (buffer.read(), mimetype, {'filename': filename})})
+            else:
+                filekey = None
+                offset = 0
+                while offset < size:
+                    buffer.seek(offset)
+                    chunk = buffer.read(self.chunk_size)
+                    chunk_params = {'action': 'upload', 'stash': 1, 'filename': filename,
+                                    'filesize': size, 'offset': offset}
+                    if filekey:
+                        chunk_params['filekey'] = filekey
+                    result = self._post(chunk_params, mime={'chunk': (chunk, mimetype, {'filename': filename})})
+                    if result.get('result') == 'Warning' and offset == 0:
+                        logger.info(f"Upload of {filename} aborted: {result.get('warnings')}")
+                        return False
+                    filekey = result.get('filekey', filekey)
+                    offset = int(result.get('offset', offset + len(chunk)))
+                result = self._post(dict(params, filekey=filekey))
+        except UploadError as e:
+            logger.info(f"Upload of {filename} aborted: {e}")
+            return False
+
+        if result.get('result') != 'Success':
+            logger.info(f"Upload of {filename} aborted: {result.get('warnings', result)}")
+            return False
+        return True
+
+class UploadLedger:
     """
-    Upload the file to Wikimedia Commons using UploadRobot.
+    Local sqlite record of what happened to each CSV row, keyed by record_id and source URL.
+
+    Rows that ended up uploaded, duplicate or skipped are finished and are not touched again on a rerun;
+    failed rows are retried.
     """
+    UPLOADED = 'uploaded'
+    DUPLICATE = 'duplicate'
+    FAILED = 'failed'
+    SKIPPED = 'skipped'
+    FINISHED = (UPLOADED, DUPLICATE, SKIPPED)
+
+    FIELDS = ['record_id', 'source_url', 'sha1', 'commons_title', 'status', 'timestamp']
+
+    def __init__(self, path: str = DEFAULT_LEDGER):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS uploads (
+                                record_id TEXT NOT NULL,
+                                source_url TEXT NOT NULL,
+                                sha1 TEXT,
+                                commons_title TEXT,
+                                status TEXT NOT NULL,
+                                timestamp TEXT NOT NULL,
+                                PRIMARY KEY (record_id, source_url))''')
+        self.conn.commit()
+
+    def finished_keys(self) -> Set[Tuple[str, str]]:
+        """All (record_id, source_url) pairs that need no further work, loaded in one query."""
+        placeholders = ','.join('?' * len(self.FINISHED))
+        cursor = self.conn.execute(f'SELECT record_id, source_url FROM uploads WHERE status IN ({placeholders})',
+                                   self.FINISHED)
+        return set(cursor.fetchall())
+
+    def record(self, record_id: str, source_url: str, status: str,
+               sha1: Optional[str] = None, commons_title: Optional[str] = None) -> None:
+        """Insert or replace the outcome for a row."""
+        timestamp = datetime.now(timezone.utc).isoformat(timespec='seconds')
+        self.conn.execute('INSERT OR REPLACE INTO uploads VALUES (?, ?, ?, ?, ?, ?)',
+                          (record_id, source_url or '', sha1, commons_title, status, timestamp))
+        self.conn.commit()
+
+    def summary(self) -> Dict[str, int]:
+        """Count of ledger rows per status."""
+        return dict(self.conn.execute('SELECT status, COUNT(*) FROM uploads GROUP BY status').fetchall())
+
+    def export_csv(self, output_file: Optional[str] = None) -> None:
+        """Write the whole ledger as CSV to output_file, or stdout."""
+        output_stream = sys.stdout if output_file is None else open(output_file, 'w', newline='', encoding='utf-8')
+        writer = csv.writer(output_stream)
+        writer.writerow(self.FIELDS)
+        writer.writerows(self.conn.execute(f'SELECT {", ".join(self.FIELDS)} FROM uploads ORDER BY timestamp'))
+        if output_file is not None:
+            output_stream.close()
+
+    def close(self) -> None:
+        self.conn.close()
+
+@dataclass
+class RowResult:
+    record_id: str
+    source_url: str
+    status: str
+    message: str
+    sha1: Optional[str] = None
+    commons_title: Optional[str] = None
+
+def sha1_of_file(filepath: str, stats: Optional[IOStats] = None) -> str:
+    """SHA1 hex digest of a file, read in blocks. Bytes read are added to stats, if given."""
+    sha1 = hashlib.sha1()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            sha1.update(block)
+            if stats is not None:
+                stats.add(read=len(block))
+    return sha1.hexdigest()
+
+def process_row(uploader: CommonsUploader, row: List[str], download_url: Optional[str] = None,
+                stream: bool = False, stats: Optional[IOStats] = None) -> RowResult:
+    """
+    Download, dedupe and upload a single CSV row, charging its requests to the row's record_id
+    if a request budget is installed.
+    """
+    with wacsession.budget_scope(row[0]):
+        return _process_row(uploader, row, download_url, stream, stats)
+
+def _process_row(uploader: CommonsUploader, row: List[str], download_url: Optional[str] = None,
+                 stream: bool = False, stats: Optional[IOStats] = None) -> RowResult:
+    """
+    Download, dedupe and upload a single CSV row. Runs inside a worker thread.
+    download_url, if given, is the already-resolved form of the row's source URL.
+    With stream, the image goes through a spooled buffer instead of a file in the working directory.
+    """
+    record_id, url, filename, edit_summary, description = row
+    stats = stats if stats is not None else IOStats()
+
+    # Check if url or filename is None or empty
+    if not url or not filename:
+        logger.debug(f"Skipping record {record_id} due to missing url or filename.")
+        return RowResult(record_id, url, UploadLedger.SKIPPED, "Skipping, empty URL or filename")
+
+    if stream:
+        download = download_to_buffer(download_url or url, uploader.spool_threshold, uploader.spool_dir)
+        if not download:
+            return RowResult(record_id, url, UploadLedger.FAILED, f"Download failed for {filename}.")
+        buffer, size, sha1_hash = download
+        with buffer:
+            if size > uploader.spool_threshold:
+                stats.add(spilled=size)
+            else:
+                stats.add(memory=size)
+            existing_title = uploader.find_duplicate(sha1_hash)
+            if existing_title:
+                return RowResult(record_id, url, UploadLedger.DUPLICATE,
+                                 f"File {filename} already exists on Wikimedia Commons.", sha1_hash, existing_title)
+            if uploader.upload_stream(buffer, size, filename, description, edit_summary):
+                stats.add(uploaded=size)
+                return RowResult(record_id, url, UploadLedger.UPLOADED,
+                                 f"Uploaded {filename} to Wikimedia Commons.", sha1_hash, 'File:' + filename)
+            return RowResult(record_id, url, UploadLedger.FAILED, f"Upload of {filename} did not complete.", sha1_hash)
+
+    filepath = download_image(download_url or url, filename, uploader.parallel_threshold, uploader.parallel_ranges, stats)
     if not filepath:
-        logger.debug(f"Missing filepath, skipping")
-        return
+        return RowResult(record_id, url, UploadLedger.FAILED, f"Download failed for {filename}.")
+    try:
+        size = os.path.getsize(filepath)
+        sha1_hash = sha1_of_file(filepath, stats)
+        existing_title = uploader.find_duplicate(sha1_hash)
+        if existing_title:
+            return RowResult(record_id, url, UploadLedger.DUPLICATE,
+                             f"File {filename} already exists on Wikimedia Commons.", sha1_hash, existing_title)
+        if uploader.upload(filepath, filename, description, edit_summary):
+            stats.add(uploaded=size, upload_read=size)  # pywikibot read the file again to upload it
+            return RowResult(record_id, url, UploadLedger.UPLOADED,
+                             f"Uploaded {filename} to Wikimedia Commons.", sha1_hash, 'File:' + filename)
+        return RowResult(record_id, url, UploadLedger.FAILED, f"Upload of {filename} did not complete.", sha1_hash)
+    finally:
+        if os.path.exists(filepath):
+            os.remove(filepath)
 
-    # TODO: Don't open a site each time, pass it in via parameter
-    site = pywikibot.Site('commons', 'commons')
-
-    with open('/dev/null', 'w') as f:
-        # UploadRobot is noisy, and I cannot shut off its description output, so this is a fix
-        # sys.stdout = f
-        # sys.stderr = f
-
-        # When always is set to True, ignore_warning or aborts must be set to True.
-        upload_bot = UploadRobot([filepath],
-                                 description=description,
-                                 use_filename=filename,
-                                 keep_filename=True,
-                                 verify_description=False,
-                                 summary=edit_summary,
-                                 target_site=site,
-                                 always=True,
-                                 aborts=True   # Alternative is to set ignore_warning=True,
-                                 )
-        upload_bot.run()
-
-    # Reset standard output
-    sys.stdout = sys.__stdout__    
-    sys.stderr = sys.__stderr__    
-
-def process_csv(csv_file: str) -> None:
+def read_columnar(path: str, workers: int = DEFAULT_READ_WORKERS) -> List[List[str]]:
     """
-    Process each row of the CSV file and upload images.
+    Read rows from a Parquet (.parquet) or Arrow IPC (.arrow) file written by the generator.
+
+    The file is memory-mapped and only the upload columns are read. Parquet row groups are decoded in
+    parallel. Requires pyarrow (pip install pyarrow).
     """
-    with open(csv_file, 'r', newline='', encoding='utf-8') as file:
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        logger.error(f"Reading {path} needs pyarrow: pip install pyarrow")
+        sys.exit(1)
+
+    if path.endswith('.parquet'):
+        parquet_file = pq.ParquetFile(path, memory_map=True)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            tables = list(executor.map(lambda i: parquet_file.read_row_group(i, columns=CSV_COLUMNS),
+                                       range(parquet_file.num_row_groups)))
+        table = pa.concat_tables(tables) if tables else parquet_file.schema_arrow.empty_table().select(CSV_COLUMNS)
+    else:
+        with pa.memory_map(path, 'r') as source:
+            table = pa.ipc.open_file(source).read_all().select(CSV_COLUMNS)
+
+    columns = [table.column(name).to_pylist() for name in CSV_COLUMNS]
+    return [[value or '' for value in row] for row in zip(*columns)]
+
+def read_rows(path: str) -> List[List[str]]:
+    """
+    Read upload rows (record_id, source_image_url, commons_filename, edit_summary, description)
+    from a CSV file, or from a Parquet/Arrow file by extension.
+    """
+    if path.endswith(COLUMNAR_EXTENSIONS):
+        return read_columnar(path)
+    with open(path, 'r', newline='', encoding='utf-8') as file:
         reader = csv.reader(file)
         next(reader)  # Skip the header row
-        with tqdm.tqdm(total=len(list(reader)), unit='record') as pbar:
-            file.seek(0)  # Reset the file pointer to the beginning
-            next(reader)  # Skip the header row again
-            for row in reader:
-                record_id, url, filename, edit_summary, description = row
-                pbar.set_description(f"Processing {record_id}")
-    
-                # Check if url or filename is None or empty
-                if not url or not filename:
-                    pbar.set_description(f"Skipping, empty URL or filename")
-                    logger.debug(f"Skipping record {record_id} due to missing url or filename.")
-                    continue  # Skip this record and move to the next one
-        
-                filepath = download_image(url, filename)
-                if filepath and not file_exists_on_commons(filepath):
-                    upload_to_commons(filepath, filename, description, edit_summary)
-                    pbar.set_description(f"Uploaded {filename} to Wikimedia Commons.")
-                else:
-                    pbar.set_description(f"File {filename} already exists on Wikimedia Commons or download failed.")
-                if filepath and os.path.exists(filepath):
-                    os.remove(filepath)
-                pbar.update(1) 
+        return list(reader)
+
+def _charge_commons(response, *args, **kwargs):
+    wacsession.charge(response.url)
+
+def install_budget(budget: Optional[wacsession.RequestBudget]) -> None:
+    """
+    Install a request budget for uploads. pywikibot has its own session, so its Commons API calls are
+    charged through a response hook on that session.
+    """
+    wacsession.set_budget(budget)
+    hooks = pywikibot_http.session.hooks['response']
+    if budget is not None and _charge_commons not in hooks:
+        hooks.append(_charge_commons)
+
+def process_csv(csv_file: str,
+                workers: int = DEFAULT_WORKERS,
+                uploader: Optional[CommonsUploader] = None,
+                ledger: Optional[UploadLedger] = None,
+                url_cache: Optional[ResolvedUrlCache] = None,
+                resolve: bool = False,
+                stream: bool = False,
+                **uploader_options) -> Optional[IOStats]:
+    """
+    Process each row of the CSV file and upload images.
+
+    Rows the ledger already lists as finished are dropped before any network activity.
+    With resolve, the remaining source URLs are first resolved in one concurrent HEAD pass: dead links
+    are recorded as failed and dropped, and the rest are downloaded straight from their final URL.
+    Up to `workers` rows are in flight at once, so downloads of some files overlap uploads of others.
+    With stream, images are uploaded from spooled buffers and never written to the working directory.
+    Returns the local I/O tally for the rows that were processed.
+
+    If no uploader is passed in, one is created (and logged in) from uploader_options only once
+    there is something left to upload.
+    """
+    rows = read_rows(csv_file)
+
+    if ledger is not None:
+        finished = ledger.finished_keys()
+        pending = [row for row in rows if (row[0], row[1]) not in finished]
+        logger.info(f"Ledger: {len(rows) - len(pending)} of {len(rows)} rows already finished")
+        rows = pending
+
+    final_urls = {}
+    if resolve and rows:
+        resolved = resolve_urls([row[1] for row in rows], url_cache)
+        live_rows = []
+        for row in rows:
+            record_id, url = row[0], row[1]
+            if url and not (url in resolved and resolved[url].final_url):
+                status = resolved[url].status if url in resolved else 'invalid URL'
+                logger.info(f"Dropping {record_id}: {url} is dead ({status})")
+                if ledger is not None:
+                    ledger.record(record_id, url, UploadLedger.FAILED)
+                continue
+            if url:
+                final_urls[url] = resolved[url].final_url
+            live_rows.append(row)
+        rows = live_rows
+
+    if not rows:
+        return None
+
+    if uploader is None:
+        uploader = CommonsUploader(**uploader_options)
+
+    stats = IOStats()
+    with wacsession.ProgressBar(total=len(rows), unit='record') as pbar, \
+         concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(process_row, uploader, row, final_urls.get(row[1]), stream, stats) for row in rows]
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                result = future.result()
+                pbar.set_description(result.message)
+                if ledger is not None:
+                    ledger.record(result.record_id, result.source_url, result.status,
+                                  result.sha1, result.commons_title)
+            except Exception as e:
+                logger.error(f"Error occurred while processing a record: {e}")
+            pbar.update(1)
+
+    logger.info(stats.report())
+    wacsession.log_stats()
+    return stats
 
 def main() -> None:
     parser = argparse.ArgumentParser(description="Upload images to Wikimedia Commons from a CSV file.")
-    parser.add_argument("csv_file", help="Path to the CSV file containing the image URLs, filenames, and descriptions.")
+    parser.add_argument("csv_file", nargs="?", help="Path to the CSV file containing the image URLs, filenames, and descriptions. "
+                                                    "A .parquet or .arrow file from the generator also works.")
+    parser.add_argument("-w", "--workers", dest="workers", type=int, default=DEFAULT_WORKERS,
+                        help=f"Number of uploads kept in flight (default: {DEFAULT_WORKERS})")
+    parser.add_argument("--min-delay", dest="min_delay", type=float, default=0.0,
+                        help="Minimum seconds between uploads; grows automatically on maxlag/throttling (default: 0)")
+    parser.add_argument("--chunk-size", dest="chunk_size", type=int, default=DEFAULT_CHUNK_SIZE,
+                        help=f"Chunk size in bytes for large files (default: {DEFAULT_CHUNK_SIZE})")
+    parser.add_argument("--chunk-threshold", dest="chunk_threshold", type=int, default=DEFAULT_CHUNK_THRESHOLD,
+                        help=f"Files larger than this many bytes use chunked upload (default: {DEFAULT_CHUNK_THRESHOLD})")
+    parser.add_argument("-l", "--ledger", dest="ledger_file", default=DEFAULT_LEDGER,
+                        help=f"sqlite ledger of finished rows (default: {DEFAULT_LEDGER})")
+    parser.add_argument("-r", "--resolve", action="store_true",
+                        help="Resolve source URLs with concurrent HEAD requests before uploading, dropping dead links")
+    parser.add_argument("--url-cache", dest="url_cache_file", default=DEFAULT_URL_CACHE,
+                        help=f"sqlite cache of resolved source URLs (default: {DEFAULT_URL_CACHE})")
+    parser.add_argument("--stream", action="store_true",
+                        help="Upload from spooled in-memory buffers instead of files in the working directory")
+    parser.add_argument("--spool-threshold", dest="spool_threshold", type=int, default=DEFAULT_SPOOL_THRESHOLD,
+                        help=f"Stream mode: images larger than this many bytes spill to --spool-dir (default: {DEFAULT_SPOOL_THRESHOLD})")
+    parser.add_argument("--spool-dir", dest="spool_dir", default=DEFAULT_SPOOL_DIR,
+                        help=f"Stream mode: directory for spilled images, ideally tmpfs (default: {DEFAULT_SPOOL_DIR})")
+    parser.add_argument("--parallel-threshold", dest="parallel_threshold", type=int,
+                        help="Download images larger than this many bytes as several ranges at once (not with --stream)")
+    parser.add_argument("--parallel-ranges", dest="parallel_ranges", type=int, default=DEFAULT_PARALLEL_RANGES,
+                        help=f"Ranges per image above --parallel-threshold (default: {DEFAULT_PARALLEL_RANGES})")
+    parser.add_argument("--hedge-after", dest="hedge_after", type=float,
+                        help="Send a duplicate image request if the first has not answered after this many seconds")
+    parser.add_argument("--budget", dest="budget", action="append", metavar="HOST=N",
+                        help="Fail the run if any row needs more than N network requests to HOST, e.g. commons.wikimedia.org=2")
+    parser.add_argument("--report", action="store_true", help="Print a per-status summary of the ledger and exit")
+    parser.add_argument("--export", dest="export_file", metavar="FILE",
+                        help="Export the ledger as CSV to FILE ('-' for stdout) and exit")
     args = parser.parse_args()
 
-    process_csv(args.csv_file)
+    ledger = UploadLedger(args.ledger_file)
+    if args.report or args.export_file:
+        if args.report:
+            for status, count in sorted(ledger.summary().items()):
+                print(f"{status}\t{count}")
+        if args.export_file:
+            ledger.export_csv(None if args.export_file == '-' else args.export_file)
+        ledger.close()
+        return
+
+    if not args.csv_file:
+        parser.print_usage()
+        logger.error('Requires a CSV file')
+        sys.exit(1)
+
+    wacsession.set_policy(wacsession.RequestPolicy(hedge_after=args.hedge_after))
+    budget = wacsession.RequestBudget(wacsession.RequestBudget.parse(args.budget)) if args.budget else None
+    if budget is not None:
+        install_budget(budget)
+    # One keep-alive connection per worker to each image host
+    wacsession.configure(pool_maxsize=max(args.workers, DEFAULT_RESOLVE_WORKERS))
+    url_cache = ResolvedUrlCache(args.url_cache_file) if args.resolve else None
+    process_csv(args.csv_file, workers=args.workers, ledger=ledger,
+                url_cache=url_cache, resolve=args.resolve, stream=args.stream,
+                spool_threshold=args.spool_threshold, spool_dir=args.spool_dir,
+                parallel_threshold=args.parallel_threshold, parallel_ranges=args.parallel_ranges,
+                throttle=UploadThrottle(min_delay=args.min_delay),
+                chunk_threshold=args.chunk_threshold,
+                chunk_size=args.chunk_size)
+    ledger.close()
+    if url_cache is not None:
+        url_cache.close()
+    if budget is not None and not budget.check():
+        sys.exit(2)
 
 if __name__ == "__main__":
     main()
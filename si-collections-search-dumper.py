@@ -5,8 +5,7 @@
 
 from bs4 import BeautifulSoup
 # from urllib.request import urlopen
-import requests
-import requests_cache
+import wacsession
 import sys
 from tqdm import tqdm
 import argparse
@@ -19,11 +18,15 @@ logging.basicConfig(
 
 url=''
 
+def collections_session():
+    '''Shared, cached session for collections.si.edu'''
+    return wacsession.get_session('sicollections', cache_name='sicollections_cache', expire_after=259200) # 3 days
+
 def scrape_siid_by_url_recursive(inurl: str, bar) -> list:
     '''Take the result of a collections.si.edu search and get all the multi-page'''
     bar.update(1)
     logging.debug(inurl)
-    page = requests.get(inurl)
+    page = collections_session().get(inurl)
     html = page.text
     soup = BeautifulSoup(html, "html.parser")
 
@@ -35,7 +38,7 @@ def scrape_siid_by_url_recursive(inurl: str, bar) -> list:
 
 def scrape_siid_by_url(inurl: str) -> list:
     '''Scrape page given URL string'''
-    page = requests.get(inurl)
+    page = collections_session().get(inurl)
     html = page.text
     soup = BeautifulSoup(html, "html.parser")
     return scrape_siid(soup)
@@ -84,6 +87,8 @@ def process_scrape(url, output_file) -> None:
     if output_file is not None:
         output_stream.close()        
 
+    wacsession.log_stats()
+
     
 def main():
     parser = argparse.ArgumentParser(description="Process a list of identifiers")
@@ -110,8 +115,6 @@ def main():
         logging.error('Requires at least one URL')
 
 if __name__ == "__main__":
-
-    requests_cache.install_cache('sicollections_cache', backend='sqlite', expire_after=259200) # 3 days
     logging.getLogger().setLevel(logging.INFO)
     main()
 
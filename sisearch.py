@@ -0,0 +1,75 @@
+# Translate collections.si.edu search URLs into Smithsonian Open Access API search queries
+#
+# A search URL such as
+#   https://collections.si.edu/search/results.htm?q=&fq=data_source%3A%22NMNH+-+Botany+Dept.%22&fq=place:%22Kelantan%22&media.CC0=true
+# becomes the API query
+#   data_source:"NMNH - Botany Dept." AND place:"Kelantan"
+# which the generator can page through 1000 records at a time (--search), getting the full records from
+# the same responses instead of scraping 20 IDs per HTML page and looking each one up again.
+# media.CC0=true (only records with CC0 media) has no query syntax in the API, whose records can also carry
+# media under other terms, so the generator applies it to the records it gets back (has_cc0_media).
+# URLs with filters that have no API equivalent are left to the HTML scraper (si-collections-search-dumper.py).
+
+import logging
+from typing import Optional
+from urllib.parse import urlparse, parse_qsl
+
+# Facets of the collections.si.edu search that are indexed under the same name by the API
+API_FACETS = {
+    'data_source', 'unit_code', 'object_type', 'topic', 'place', 'culture', 'date', 'name', 'set_name',
+    'language', 'online_media_type', 'tax_kingdom', 'tax_phylum', 'tax_division', 'tax_class',
+    'tax_order', 'tax_family', 'tax_genus',
+}
+
+# Facets with a fixed API translation
+FACET_TRANSLATIONS = {
+    ('online_visual_material', 'true'): 'online_media_type:"Images"',
+}
+
+# Parameters that only change how results are shown, not which records match
+PRESENTATION_PARAMS = {'view', 'dsort', 'page', 'start', 'edan_local'}
+
+def collections_url_to_api_query(url: str) -> Optional[str]:
+    """
+    Return the Open Access API search query for a collections.si.edu search URL, or None (with the reason
+    logged) if the URL uses a filter that cannot be translated and has to be scraped instead.
+    """
+    parsed = urlparse(url)
+    if not parsed.netloc.endswith('collections.si.edu') or not parsed.path.startswith('/search'):
+        logging.info(f'Not a collections.si.edu search URL: {url}')
+        return None
+
+    terms = []
+    for param, value in parse_qsl(parsed.query, keep_blank_values=True):
+        if param == 'q':
+            if value.strip():
+                terms.append(value.strip() if len(value.split()) == 1 else f'({value.strip()})')
+        elif param == 'fq':
+            facet, _, facet_value = value.partition(':')
+            bare = facet_value.strip('"')
+            if (facet, bare) in FACET_TRANSLATIONS:
+                terms.append(FACET_TRANSLATIONS[(facet, bare)])
+            elif facet in API_FACETS and bare:
+                terms.append('%s:"%s"' % (facet, bare.replace('"', '\\"')))
+            else:
+                logging.info(f'Search filter {value!r} has no API equivalent')
+                return None
+        elif param == 'media.CC0':
+            # Not part of the query: see requires_cc0_media
+            if value != 'true':
+                logging.info(f'media.CC0={value} has no API equivalent')
+                return None
+        elif param not in PRESENTATION_PARAMS:
+            logging.info(f'Search parameter {param}={value!r} has no API equivalent')
+            return None
+
+    return ' AND '.join(terms) if terms else '*'
+
+def requires_cc0_media(url: str) -> bool:
+    """Whether a collections.si.edu search URL only asks for records with CC0 media (media.CC0=true)."""
+    return ('media.CC0', 'true') in parse_qsl(urlparse(url).query)
+
+def has_cc0_media(record: dict) -> bool:
+    """Whether an API record (the 'response' of a content or search result) has at least one CC0 media item."""
+    media = record.get('content', {}).get('descriptiveNonRepeating', {}).get('online_media', {}).get('media', [])
+    return any(isinstance(m, dict) and m.get('usage', {}).get('access') == 'CC0' for m in media)
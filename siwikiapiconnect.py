@@ -1,6 +1,12 @@
 import subprocess
 import os
+import sys
 import argparse
+import sisearch
+
+# Generator exit statuses meaning "no API search for this, scrape it instead": the URL has filters the API
+# cannot express (3), or the unit has no api: search_url in the config (4)
+SCRAPE_INSTEAD = {3, 4}
 
 # Create an argument parser
 parser = argparse.ArgumentParser(description="Script to upload files to Wikimedia Commons based on a Smithsonian Collections search result from https://collections.si.edu/", epilog="""
@@ -24,32 +30,60 @@ args = parser.parse_args()
 # Execute the first Python script with the specified parameters
 # subprocess.run(["python", "si-collections-search-dumper.py", "-o", f"{args.file_base}.txt", args.search_url])
 
+# Most search URLs translate into an API search, which returns the full records along with the IDs,
+# so the scrape and the per-object lookups are skipped. Anything else is scraped as before.
+api_search = sisearch.collections_url_to_api_query(args.search_url) is not None
+
 ##### Generate object IDs
 
 # Define the output file name
 output_txt_file = f"{args.file_base}.txt"
 
+# A CSV left by an earlier run must not be uploaded if this run produces none
+if os.path.exists(f"{args.file_base}.csv"):
+    print(f"Removing '{args.file_base}.csv' from an earlier run")
+    os.remove(f"{args.file_base}.csv")
+
+if api_search:
+    # One generator run produces both the ID list and the CSV
+    print("Fetching object IDs and metadata through the API search")
+    result = subprocess.run(["python", "wikiapiconnector-generator.py", "-c", args.config_file, "-s", args.search_url,
+                             "--ids-output", output_txt_file, "-o", f"{args.file_base}.csv", "-u", args.unit_string])
+    if result.returncode in SCRAPE_INSTEAD:
+        print("This search cannot be run through the API, scraping the search pages instead")
+        api_search = False
+    elif result.returncode != 0:
+        sys.exit(f"Error: wikiapiconnector-generator.py failed (exit status {result.returncode}), not uploading")
+
 # Check if the output file already exists
-if os.path.exists(output_txt_file):
+if api_search:
+    pass  # IDs already fetched
+elif os.path.exists(output_txt_file):
     user_response = input(f"Warning: Output file '{output_txt_file}' already exists. Do you want to overwrite it? (y/N): ")
 
     if user_response.lower() == "y":
         # Execute the first Python script with the specified parameters
-        subprocess.run(["python", "si-collections-search-dumper.py", "-o", output_txt_file, args.search_url])
+        if subprocess.run(["python", "si-collections-search-dumper.py", "-o", output_txt_file, args.search_url]).returncode != 0:
+            sys.exit("Error: si-collections-search-dumper.py failed, not uploading")
     else:
         print("Operation canceled.")
 else:
     # Execute the first Python script with the specified parameters
-    subprocess.run(["python", "si-collections-search-dumper.py", "-o", output_txt_file, args.search_url])
+    if subprocess.run(["python", "si-collections-search-dumper.py", "-o", output_txt_file, args.search_url]).returncode != 0:
+        sys.exit("Error: si-collections-search-dumper.py failed, not uploading")
 
 ##### Image file and metadata collection
 
 # Check if the input file for the second script exists
-if not os.path.exists(f"{args.file_base}.txt"):
+if api_search:
+    pass  # Already generated along with the IDs
+elif not os.path.exists(f"{args.file_base}.txt"):
     print(f"Error: Input file '{args.file_base}.txt' does not exist.")
 else:
     # Execute the second Python script with the specified parameters
-    subprocess.run(["python", "wikiapiconnector-generator.py", "-c", args.config_file, "-i", f"{args.file_base}.txt", "-o", f"{args.file_base}.csv", "-u", args.unit_string])
+    result = subprocess.run(["python", "wikiapiconnector-generator.py", "-c", args.config_file, "-i", f"{args.file_base}.txt", "-o", f"{args.file_base}.csv", "-u", args.unit_string])
+    if result.returncode != 0:
+        sys.exit(f"Error: wikiapiconnector-generator.py failed (exit status {result.returncode}), not uploading")
 
 ##### Upload
 
@@ -0,0 +1,383 @@
+# Shared fixtures: the hyphen-named tools loaded as modules, and local stand-ins for the Smithsonian
+# Open Access API (EDAN) and the Commons (MediaWiki) API, so tests never touch the network.
+
+import hashlib
+import importlib.util
+import json
+import os
+import sys
+import tempfile
+import threading
+from collections import namedtuple
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+# pywikibot keeps its API cache and throttle file next to user-config.py: give it an empty one out of the tree
+PYWIKIBOT_DIR = tempfile.mkdtemp(prefix='pywikibot-')
+open(os.path.join(PYWIKIBOT_DIR, 'user-config.py'), 'w').close()
+os.environ['PYWIKIBOT_DIR'] = PYWIKIBOT_DIR
+
+import wacsession
+
+FakeRequest = namedtuple('FakeRequest', 'method path query headers body')
+
+def load_script(filename: str, module_name: str):
+    '''Import one of the hyphen-named tool scripts as a module (once per test session)'''
+    if module_name not in sys.modules:
+        spec = importlib.util.spec_from_file_location(module_name, os.path.join(ROOT, filename))
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[module_name] = module
+        spec.loader.exec_module(module)
+    return sys.modules[module_name]
+
+@pytest.fixture(scope='session')
+def generator():
+    return load_script('wikiapiconnector-generator.py', 'wikiapiconnector_generator')
+
+@pytest.fixture(scope='session')
+def uploader():
+    module = load_script('commons-upload-csv.py', 'commons_upload_csv')
+    module.pywikibot.config.put_throttle = 0  # No pause between uploads to a local fake
+    return module
+
+@pytest.fixture(autouse=True)
+def isolated(tmp_path, monkeypatch):
+    '''Run each test in its own directory (the tools keep their sqlite caches in the working directory)
+    with fresh shared sessions, budget and policy'''
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(wacsession, '_sessions', {})
+    monkeypatch.setattr(wacsession, '_settings', dict(wacsession._settings))
+    monkeypatch.setattr(wacsession, '_budget', None)
+    monkeypatch.setattr(wacsession, '_policy', wacsession.RequestPolicy(backoff_base=0.01))
+    generator = sys.modules.get('wikiapiconnector_generator')
+    if generator is not None:
+        monkeypatch.setattr(generator, '_key_pools', {})
+        monkeypatch.setattr(generator, '_limiters', {})
+        monkeypatch.setattr(generator, '_unit_specs', {})
+    yield tmp_path
+    for session in wacsession._sessions.values():
+        session.close()
+
+class FakeServer:
+    """
+    Local HTTP server that answers every request with handle(request) -> (status, headers, body)
+    and keeps the requests it saw. host is the loopback address to listen on; a distinct one (127.0.0.2)
+    gives a server its own host name in per-host request budgets.
+    """
+    def __init__(self, handle, host: str = '127.0.0.1'):
+        self.handle = handle
+        self.requests = []
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def respond(self):
+                url = urlparse(self.path)
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0) or 0))
+                request = FakeRequest(self.command, url.path, parse_qs(url.query), dict(self.headers), body)
+                server.requests.append(request)
+                status, headers, data = server.handle(request)
+                if isinstance(data, (dict, list)):
+                    data = json.dumps(data).encode('utf-8')
+                    headers = {'Content-Type': 'application/json', **headers}
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                if self.command != 'HEAD':
+                    self.wfile.write(data)
+
+            do_GET = do_POST = do_HEAD = respond
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, 0), Handler)
+        self.url = 'http://%s:%d' % (host, self.httpd.server_address[1])
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+def edan_record(identifier: str, title: str, image_url: str = None, access: str = 'CC0') -> dict:
+    '''A content record shaped like the Open Access API's, with one image when image_url is given'''
+    media = [{'usage': {'access': access},
+              'resources': [{'label': 'High-resolution JPEG', 'url': image_url}]}] if image_url else []
+    return {
+        'id': 'edanmdm-' + identifier,
+        'title': title,
+        'url': 'edanmdm:' + identifier,
+        'content': {
+            'descriptiveNonRepeating': {
+                'record_ID': identifier,
+                'record_link': 'https://collections.si.edu/search/detail/edanmdm:' + identifier,
+                'metadata_usage': {'access': 'CC0'},
+                'online_media': {'mediaCount': len(media), 'media': media},
+            },
+            'freetext': {'name': [{'label': 'Artist', 'content': 'Unknown'}]},
+        },
+    }
+
+class FakeEdan(FakeServer):
+    """
+    Open Access API stand-in: /content/edanmdm:ID and /search over a dict of identifier -> record,
+    and /images/NAME serving image bytes. Content responses carry an ETag (If-None-Match gets a 304)
+    and count down X-RateLimit-Remaining from quota.
+    """
+    def __init__(self, records: dict = None, images: dict = None, quota: int = 1000, host: str = '127.0.0.1'):
+        self.records = dict(records or {})
+        self.images = dict(images or {})
+        self.quota = quota
+        super().__init__(self.answer, host)
+
+    def answer(self, request):
+        if request.path.startswith('/content/edanmdm:'):
+            self.quota -= 1
+            quota = {'X-RateLimit-Remaining': str(self.quota)}
+            record = self.records.get(request.path[len('/content/edanmdm:'):])
+            if record is None:
+                return 404, quota, {'status': 404, 'responseCode': 0}
+            etag = '"%x"' % (hash(json.dumps(record, sort_keys=True)) & 0xffffffff,)
+            if request.headers.get('If-None-Match') == etag:
+                return 304, {'ETag': etag, **quota}, b''
+            return 200, {'ETag': etag, **quota}, {'status': 200, 'responseCode': 1, 'response': record}
+        if request.path == '/search':
+            start, rows = int(request.query['start'][0]), int(request.query['rows'][0])
+            page = list(self.records.values())[start:start + rows]
+            return 200, {}, {'status': 200, 'response': {'rows': page, 'rowCount': len(self.records)}}
+        if request.path.startswith('/images/') and request.path[len('/images/'):] in self.images:
+            return 200, {'Content-Type': 'image/jpeg'}, self.images[request.path[len('/images/'):]]
+        return 404, {}, b'not found'
+
+    def content_requests(self):
+        return [r for r in self.requests if r.path.startswith('/content/')]
+
+def _module(path: str, prefix: str = '', parameters=(), **extra) -> dict:
+    return {'name': path.rsplit('+', 1)[-1], 'classname': path, 'path': path, 'group': 'action', 'prefix': prefix,
+            'parameters': list(parameters), **extra}
+
+def _submodules(name: str, modules: list, prefix: str = 'query+', **extra) -> dict:
+    return {'name': name, 'type': modules, 'submodules': {m: prefix + m for m in modules}, 'multi': True, **extra}
+
+def _choice(name: str, values: list) -> dict:
+    return {'name': name, 'type': values, 'multi': True}
+
+# Just enough API module metadata for pywikibot to build its requests
+PARAMINFO = {m['path']: m for m in [
+    _module('main', parameters=[_submodules('action', ['query', 'paraminfo', 'upload', 'wbgetentities', 'wbeditentity'], ''),
+                                {'name': 'format', 'type': ['json']}]),
+    _module('paraminfo', parameters=[{'name': 'modules', 'type': 'string', 'multi': True}]),
+    _module('query', parameters=[_submodules('prop', ['info', 'imageinfo'], limit=50),
+                                 _submodules('list', ['allimages'], limit=50),
+                                 _submodules('meta', ['siteinfo', 'userinfo', 'tokens'], limit=50),
+                                 _submodules('generator', ['allimages']),
+                                 {'name': 'titles', 'type': 'string', 'multi': True}]),
+    _module('query+allimages', 'ai', [{'name': 'sha1', 'type': 'string'},
+                                      {'name': 'limit', 'type': 'limit', 'max': 500, 'highmax': 5000}], generator=True),
+    _module('query+info', 'in', [_choice('prop', ['protection'])]),
+    _module('query+imageinfo', 'ii', [_choice('prop', ['timestamp', 'user', 'comment', 'url', 'size', 'sha1']),
+                                      {'name': 'limit', 'type': 'limit', 'max': 500, 'highmax': 5000}]),
+    _module('query+tokens', parameters=[_choice('type', ['csrf', 'login'])]),
+    _module('query+userinfo', 'ui', [_choice('prop', ['blockinfo', 'groups', 'hasmsg', 'ratelimits', 'rights'])]),
+    _module('query+siteinfo', 'si', [_choice('prop', ['general', 'namespaces', 'namespacealiases', 'extensions',
+                                                      'fileextensions'])]),
+    _module('upload', parameters=[{'name': n, 'type': 'string'} for n in
+                                  ['filename', 'comment', 'text', 'file', 'filekey', 'stash', 'offset', 'filesize',
+                                   'chunk', 'ignorewarnings', 'url']]),
+]}
+
+NAMESPACES = {-2: 'Media', -1: 'Special', 0: '', 1: 'Talk', 2: 'User', 3: 'User talk', 4: 'Project',
+              5: 'Project talk', 6: 'File', 7: 'File talk', 8: 'MediaWiki', 9: 'MediaWiki talk', 10: 'Template',
+              11: 'Template talk', 12: 'Help', 13: 'Help talk', 14: 'Category', 15: 'Category talk'}
+
+CSRF_TOKEN = 'fake-token+\\'
+
+class FakeCommons(FakeServer):
+    """
+    MediaWiki API stand-in for Commons, at /w/api.php: site info, a logged-in bot user, tokens, SHA-1
+    lookups, uploads, and the structured data calls SDCWriter makes (title lookups, wbgetentities,
+    wbeditentity). pages maps file titles to page ids, and uploads adds to it. statements holds each
+    MediaInfo entity's statements.
+    """
+    USER = 'WacBot'
+
+    def __init__(self, pages: dict = None, host: str = '127.0.0.1'):
+        self.pages = dict(pages or {})
+        self.sha1s = {}      # sha1 -> file title
+        self.uploads = []    # (title, content, text, comment)
+        self.statements = {}
+        self.edits = []
+        super().__init__(self.answer, host)
+
+    def site(self):
+        '''A pywikibot site for this wiki, logged in as USER'''
+        import pywikibot
+        family = pywikibot.family.AutoFamily('wactest', self.url + '/w/api.php')
+        return pywikibot.Site(code='wactest', fam=family, user=self.USER)
+
+    @staticmethod
+    def params(request) -> dict:
+        params = {k: v[0] for k, v in request.query.items()}
+        content_type = request.headers.get('Content-Type', '')
+        if request.method != 'POST':
+            return params
+        if content_type.startswith('multipart/'):
+            message = BytesParser(policy=HTTP).parsebytes(b'Content-Type: ' + content_type.encode() + b'\r\n\r\n'
+                                                          + request.body)
+            for part in message.iter_parts():
+                name = part.get_param('name', header='content-disposition')
+                params[name] = part.get_payload(decode=True) if part.get_filename() else part.get_content()
+        else:
+            params.update({k: v[0] for k, v in parse_qs(request.body.decode('utf-8')).items()})
+        return params
+
+    def file_page(self, title: str) -> dict:
+        sha1 = next((h for h, t in self.sha1s.items() if t == title), None)
+        return {'pageid': self.pages[title], 'ns': 6, 'title': title, 'imagerepository': 'local',
+                'imageinfo': [{'sha1': sha1, 'timestamp': '2026-01-01T00:00:00Z', 'user': self.USER}]}
+
+    def query(self, params: dict) -> dict:
+        result = {}
+        for meta in params.get('meta', '').split('|'):
+            if meta == 'siteinfo':
+                info = {
+                    'general': {'mainpage': 'Main Page', 'base': self.url + '/wiki/Main_Page', 'sitename': 'Fake Commons',
+                                'generator': 'MediaWiki 1.39.0', 'case': 'first-letter', 'lang': 'en',
+                                'server': self.url, 'articlepath': '/wiki/$1', 'scriptpath': '/w',
+                                'script': '/w/index.php', 'wikiid': 'wactest', 'time': '2026-01-01T00:00:00Z',
+                                'timezone': 'UTC', 'uploadsenabled': '', 'maxuploadsize': 2 ** 32,
+                                'minuploadchunksize': 1024},
+                    'namespaces': {str(i): {'id': i, 'case': 'first-letter', '*': name, 'canonical': name,
+                                            'content': i == 0} for i, name in NAMESPACES.items()},
+                    'namespacealiases': [],
+                    'extensions': [],
+                    'fileextensions': [{'ext': e} for e in ['jpg', 'jpeg', 'png', 'tif', 'tiff']],
+                }
+                result.update({p: info[p] for p in params.get('siprop', 'general').split('|') if p in info})
+            elif meta == 'userinfo':
+                result['userinfo'] = {'id': 1, 'name': self.USER, 'groups': ['bot', 'user'],
+                                      'rights': ['upload', 'bot', 'writeapi', 'edit'], 'messages': False}
+            elif meta == 'tokens':
+                result['tokens'] = {'csrftoken': CSRF_TOKEN, 'logintoken': 'fake-login+\\'}
+        if params.get('generator') == 'allimages':
+            title = self.sha1s.get(params.get('gaisha1'))
+            if title:
+                result['pages'] = {str(self.pages[title]): self.file_page(title)}
+        if 'titles' in params:
+            pages = [{'pageid': self.pages[t], 'ns': 6, 'title': t} if t in self.pages
+                     else {'ns': 6, 'title': t, 'missing': True} for t in params['titles'].split('|')]
+            result['pages'] = pages if params.get('formatversion') == '2' else {
+                str(p.get('pageid', -n - 1)): p for n, p in enumerate(pages)}
+        return {'batchcomplete': True, 'query': result}
+
+    def upload(self, params: dict) -> dict:
+        title = 'File:' + params['filename'][:1].upper() + params['filename'][1:].replace('_', ' ')
+        if title in self.pages and not params.get('ignorewarnings'):
+            return {'upload': {'result': 'Warning', 'warnings': {'exists': params['filename']}, 'filekey': 'k'}}
+        content = params['file']
+        sha1 = hashlib.sha1(content).hexdigest()
+        self.pages[title] = 1000 + len(self.pages)
+        self.sha1s[sha1] = title
+        self.uploads.append((title, content, params.get('text'), params.get('comment')))
+        return {'upload': {'result': 'Success', 'filename': title[len('File:'):],
+                           'imageinfo': {'sha1': sha1, 'size': len(content), 'timestamp': '2026-01-01T00:00:00Z',
+                                         'user': self.USER}}}
+
+    def answer(self, request):
+        params = self.params(request)
+        action = params.get('action')
+        if action == 'paraminfo':
+            return 200, {}, {'paraminfo': {'modules': [PARAMINFO[m] for m in params['modules'].split('|')
+                                                       if m in PARAMINFO]}}
+        if action == 'query':
+            return 200, {}, self.query(params)
+        if action in ('upload', 'wbeditentity') and params.get('token') != CSRF_TOKEN:
+            return 200, {}, {'error': {'code': 'badtoken', 'info': 'Invalid CSRF token.'}}
+        if action == 'upload':
+            return 200, {}, self.upload(params)
+        if action == 'wbgetentities':
+            return 200, {}, {'entities': {mid: {'id': mid, 'statements': self.statements.get(mid, [])}
+                                          for mid in params['ids'].split('|')}}
+        if action == 'wbeditentity':
+            claims = json.loads(params['data'])['claims']
+            self.edits.append((params['id'], claims))
+            entity = self.statements.setdefault(params['id'], {})
+            for claim in claims:
+                entity.setdefault(claim['mainsnak']['property'], []).append(claim)
+            return 200, {}, {'success': 1, 'entity': {'id': params['id']}}
+        return 200, {}, {'error': {'code': 'unknown_action', 'info': f'Unrecognized action {action!r}'}}
+
+def requests_fetch(url, method='GET', params=None, data=None, **kwargs):
+    '''Same call signature as pywikibot.comms.http.fetch, for pointing SDCWriter at a fake API'''
+    import requests
+    return requests.request(method, url, params=params, data=data, timeout=10)
+
+@pytest.fixture
+def fake_edan():
+    server = FakeEdan()
+    yield server
+    server.close()
+
+@pytest.fixture
+def fake_commons():
+    server = FakeCommons()
+    yield server
+    server.close()
+
+def write_config(path, edan_url: str, requests_per_hour: int = None) -> str:
+    '''A one-unit config (identifiers tm_...) whose API is the fake EDAN server'''
+    config = {'units': [{'unit': {
+        'name': 'Test Museum',
+        'id_pattern': '^tm_[0-9.]+',
+        'api': {
+            'api_url': edan_url + '/content/edanmdm:{}?api_key={}',
+            'search_url': edan_url + '/search?q={}&start={}&rows={}&api_key={}',
+            'requests_per_hour': requests_per_hour,
+            'api_key': True,
+            'api_key_string': 'TESTKEY',
+        },
+        'generic': {
+            'permission': {'jsonpath': '$.response.content.descriptiveNonRepeating.metadata_usage.access',
+                           'values': ['CC0']},
+            'edit_summary': 'Uploaded with Wiki API Connector',
+        },
+        'commons_template': {
+            'type': 'Information',
+            'selector_path': ['jsonpath', 'static', 'append'],
+            'categories': '[[Category:Test Museum]]',
+            'append': '{{Uploaded with Wiki API Connector}}',
+            'commons_filename_format': 'title, identifier',
+            'fields': {
+                '_image': {'jsonpath': "$.response.content.descriptiveNonRepeating.online_media.media[*]"
+                                       ".resources[?(@.label == 'High-resolution JPEG')].url"},
+                'title': {'jsonpath': '$.response.title'},
+                'description': {'jsonpath': '$.response.title'},
+                'source': {'jsonpath': '$.response.content.descriptiveNonRepeating.record_link',
+                           'append': '{{Smithsonian}}'},
+                'author': {'static': '{{Institution:Test Museum}}'},
+            },
+        },
+        'commons_wikibase': {
+            'selector_path': ['jsonpath', 'static'],
+            'statements': {
+                'P7851': {'jsonpath': '$.response.content.descriptiveNonRepeating.record_ID'},
+                'P275': {'static': 'Q6938433', 'entity-type': 'item'},
+                'P2093': {'jsonpath': '$.response.title'},
+            },
+        },
+    }}]}
+    import yaml
+    filename = str(path / 'config.yml')
+    with open(filename, 'w') as f:
+        yaml.safe_dump(config, f)
+    return filename
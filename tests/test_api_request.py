@@ -0,0 +1,48 @@
+from datetime import timedelta
+
+from conftest import FakeEdan, edan_record, write_config
+
+class CountingLimiter:
+    def __init__(self):
+        self.waits = 0
+
+    def wait(self):
+        self.waits += 1
+
+def test_only_fresh_cache_entries_skip_pacing(generator, tmp_path):
+    edan = FakeEdan({'tm_1.1': edan_record('tm_1.1', 'One')})
+    try:
+        si_unit = generator.SIunit.from_yaml(write_config(tmp_path, edan.url), 'Test Museum')
+        si_unit.limiter = CountingLimiter()
+
+        assert si_unit.api_lookup('tm_1.1')['response']['title'] == 'One'
+        assert (si_unit.limiter.waits, len(edan.content_requests())) == (1, 1)
+
+        # Fresh entry: answered from the cache, not paced
+        si_unit.api_lookup('tm_1.1')
+        assert (si_unit.limiter.waits, len(edan.content_requests())) == (1, 1)
+        assert si_unit.is_cached('tm_1.1', fresh=True)
+
+        # Expired entry: still "contained" in the cache, but fetched again, so it is paced like a miss
+        si_unit.session.cache.reset_expiration(timedelta(seconds=-1))
+        assert si_unit.is_cached('tm_1.1') and not si_unit.is_cached('tm_1.1', fresh=True)
+        si_unit.api_lookup('tm_1.1')
+        assert (si_unit.limiter.waits, len(edan.content_requests())) == (2, 2)
+    finally:
+        edan.close()
+
+def test_plan_counts_expired_entries_as_misses(generator, tmp_path):
+    edan = FakeEdan({'tm_1.1': edan_record('tm_1.1', 'One'), 'tm_1.2': edan_record('tm_1.2', 'Two')})
+    try:
+        si_unit = generator.SIunit.from_yaml(write_config(tmp_path, edan.url, requests_per_hour=3600), 'Test Museum')
+        si_unit.limiter = CountingLimiter()
+        si_unit.api_lookup('tm_1.1')
+        si_unit.api_lookup('tm_1.2')
+        si_unit.session.cache.reset_expiration(timedelta(seconds=-1))
+        si_unit.api_lookup('tm_1.1')  # Revalidated, so fresh again; tm_1.2 stays expired
+        si_unit.limiter.interval = 1.0
+
+        plan = generator.plan_run(['tm_1.1', 'tm_1.2', 'tm_1.3'], lambda identifier: si_unit)
+        assert (plan.cached, plan.misses, plan.seconds) == (['tm_1.1'], ['tm_1.2', 'tm_1.3'], 2.0)
+    finally:
+        edan.close()
@@ -0,0 +1,117 @@
+import re
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+class RangeServer:
+    """
+    Serves one file at /image.jpg with an ETag, honouring Range (and If-Range) unless honour_range is off.
+    The next `drops` responses are cut short after drop_after bytes of body, and the connection closed.
+    """
+    def __init__(self, content: bytes, etag: str = '"v1"', honour_range: bool = True):
+        self.content = content
+        self.etag = etag
+        self.honour_range = honour_range
+        self.drops = 0
+        self.drop_after = 0
+        self.requests = []  # Headers of each request
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                server.requests.append(dict(self.headers))
+                content, status, headers = server.content, 200, {}
+                m = re.match(r'bytes=(\d+)-(\d*)$', self.headers.get('Range', ''))
+                if_range = self.headers.get('If-Range')
+                if m and server.honour_range and if_range in (None, server.etag):
+                    first = int(m.group(1))
+                    last = int(m.group(2)) if m.group(2) else len(content) - 1
+                    status, content = 206, content[first:last + 1]
+                    headers['Content-Range'] = f'bytes {first}-{last}/{len(server.content)}'
+                self.send_response(status)
+                self.send_header('ETag', server.etag)
+                self.send_header('Content-Length', str(len(content)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                if server.drops:
+                    server.drops -= 1
+                    content = content[:server.drop_after]
+                    self.close_connection = True
+                self.wfile.write(content)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%d/image.jpg' % (self.httpd.server_address[1],)
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+MB = 1024 * 1024  # fetch_range writes whole blocks of this size, so a drop loses the partial block
+CONTENT = bytes(range(256)) * (10 * MB // 256)
+
+@pytest.fixture
+def range_server():
+    server = RangeServer(CONTENT)
+    yield server
+    server.close()
+
+def leave_part(filename, content, validator=None):
+    '''What an interrupted earlier run leaves behind'''
+    with open(filename + '.part', 'wb') as f:
+        f.write(content)
+    if validator is not None:
+        with open(filename + '.part.validator', 'w') as f:
+            f.write(validator)
+
+def read(filename):
+    with open(filename, 'rb') as f:
+        return f.read()
+
+def test_part_file_is_resumed_with_if_range(uploader, range_server, tmp_path):
+    leave_part('image.jpg', CONTENT[:1000], '"v1"')
+    assert uploader.download_image(range_server.url, 'image.jpg') == 'image.jpg'
+    assert read('image.jpg') == CONTENT
+    assert range_server.requests[0]['Range'] == 'bytes=1000-' and range_server.requests[0]['If-Range'] == '"v1"'
+    assert not (tmp_path / 'image.jpg.part.validator').exists()
+
+def test_server_ignoring_range_starts_over(uploader, range_server):
+    range_server.honour_range = False
+    leave_part('image.jpg', CONTENT[:1000], '"v1"')
+    assert uploader.download_image(range_server.url, 'image.jpg') == 'image.jpg'
+    assert read('image.jpg') == CONTENT and len(range_server.requests) == 1
+
+def test_changed_file_is_fetched_whole(uploader, range_server):
+    leave_part('image.jpg', b'old version of the file', '"v0"')
+    assert uploader.download_image(range_server.url, 'image.jpg') == 'image.jpg'
+    assert read('image.jpg') == CONTENT
+
+def test_part_file_without_validator_starts_over(uploader, range_server):
+    leave_part('image.jpg', b'bytes of unknown origin')
+    assert uploader.download_image(range_server.url, 'image.jpg') == 'image.jpg'
+    assert read('image.jpg') == CONTENT and 'Range' not in range_server.requests[0]
+
+def test_dropped_connection_resumes(uploader, range_server):
+    range_server.drops, range_server.drop_after = 1, 3 * MB + 5000
+    assert uploader.download_image(range_server.url, 'image.jpg') == 'image.jpg'
+    assert read('image.jpg') == CONTENT
+    assert [(r.get('Range'), r.get('If-Range')) for r in range_server.requests] == \
+        [(None, None), (f'bytes={3 * MB}-', '"v1"')]
+
+def test_failed_download_leaves_a_resumable_part_file(uploader, range_server, monkeypatch):
+    monkeypatch.setattr(uploader.time, 'sleep', lambda seconds: None)  # No backoff between attempts
+    range_server.drops, range_server.drop_after = uploader.DEFAULT_DOWNLOAD_ATTEMPTS, MB + 5000
+    assert uploader.download_image(range_server.url, 'image.jpg') is None
+    assert read('image.jpg.part') == CONTENT[:MB * uploader.DEFAULT_DOWNLOAD_ATTEMPTS]
+    assert read('image.jpg.part.validator') == b'"v1"'
+
+    assert uploader.download_image(range_server.url, 'image.jpg') == 'image.jpg'
+    assert read('image.jpg') == CONTENT
+    assert range_server.requests[-1]['If-Range'] == '"v1"'
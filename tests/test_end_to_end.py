@@ -0,0 +1,108 @@
+import csv
+import time
+
+import wacsession
+from conftest import FakeCommons, FakeEdan, FakeServer, edan_record, write_config
+
+IDENTIFIERS = ['tm_1.1', 'tm_1.2', 'tm_1.3']
+IMAGES = {identifier + '.jpg': b'\xff\xd8 image of ' + identifier.encode() for identifier in IDENTIFIERS}
+
+# Per record: one content lookup, one image download, one duplicate check and one upload
+BUDGET = {'127.0.0.1': 1, '127.0.0.2': 1, '127.0.0.3': 2}
+
+class FakeImages(FakeServer):
+    """
+    Image delivery stand-in (/ids/download?id=NAME, like ids.si.edu), on its own loopback address so its
+    requests are budgeted separately from the API's
+    """
+    def __init__(self, images: dict):
+        self.images = images
+        super().__init__(self.answer, host='127.0.0.2')
+
+    def answer(self, request):
+        name = request.query.get('id', [''])[0]
+        if request.path != '/ids/download' or name not in self.images:
+            return 404, {}, b'not found'
+        return 200, {'Content-Type': 'image/jpeg'}, self.images[name]
+
+def run_generator(generator, config, identifiers, output='rows.csv'):
+    budget = wacsession.RequestBudget(BUDGET)
+    wacsession.set_budget(budget)
+    written = generator.process_identifiers(identifiers, config, None, output,
+                                            transform_cache=generator.TransformCache())
+    return written, budget
+
+def run_uploader(uploader, site, csv_file='rows.csv'):
+    budget = wacsession.RequestBudget(BUDGET)
+    uploader.install_budget(budget)
+    commons_uploader = uploader.CommonsUploader(site=site, throttle=uploader.UploadThrottle())
+    uploader.process_csv(csv_file, workers=2, uploader=commons_uploader, ledger=uploader.UploadLedger())
+    return budget
+
+def test_generate_and_upload_within_budget(generator, uploader, tmp_path):
+    images = FakeImages(IMAGES)
+    edan = FakeEdan({i: edan_record(i, 'Object ' + i, images.url + '/ids/download?id=' + i + '.jpg') for i in IDENTIFIERS})
+    commons = FakeCommons(host='127.0.0.3')
+    try:
+        config = write_config(tmp_path, edan.url)
+        written, budget = run_generator(generator, config, IDENTIFIERS)
+        assert written == set(IDENTIFIERS)
+        assert budget.check(), budget.violations()
+        assert {record_id: per_record['127.0.0.1'] for record_id, per_record in budget.counts.items()} == \
+            dict.fromkeys(IDENTIFIERS, 1)
+
+        # A second run is answered from the cache: nothing is charged
+        _, budget = run_generator(generator, config, IDENTIFIERS, 'again.csv')
+        assert budget.counts == {} and len(edan.content_requests()) == 3
+
+        budget = run_uploader(uploader, commons.site())
+        assert budget.check(), budget.violations()
+        assert sorted(content for _, content, _, _ in commons.uploads) == sorted(IMAGES.values())
+        with open('rows.csv', newline='') as f:
+            filenames = {row['record_id']: row['commons_filename'] for row in csv.DictReader(f)}
+        assert {title for title, _, _, _ in commons.uploads} == {'File:' + f.replace('_', ' ') for f in filenames.values()}
+    finally:
+        images.close()
+        edan.close()
+        commons.close()
+
+def test_budget_flags_records_over_their_limit(generator, tmp_path):
+    edan = FakeEdan({i: edan_record(i, 'Object ' + i) for i in IDENTIFIERS})
+    try:
+        config = write_config(tmp_path, edan.url)
+        si_unit = generator.SIunit.from_yaml(config, 'Test Museum')
+        budget = wacsession.RequestBudget(BUDGET)
+        wacsession.set_budget(budget)
+        # Expired entries are fetched again, so looking a record up twice with expiry in between costs two requests
+        with wacsession.budget_scope('tm_1.1'):
+            si_unit.api_lookup('tm_1.1')
+            si_unit.session.cache.clear()
+            si_unit.api_lookup('tm_1.1')
+        assert not budget.check()
+        assert budget.violations() == [('tm_1.1', '127.0.0.1', 2, 1)]
+    finally:
+        edan.close()
+
+def test_hedged_requests_are_charged_to_the_record():
+    arrivals = []
+
+    def handle(request):
+        arrivals.append(request.path)
+        if len(arrivals) == 1:
+            time.sleep(1.0)  # Only the first copy is slow, so the hedge wins
+        return 200, {'Content-Type': 'image/jpeg'}, IMAGES['tm_1.1.jpg']
+    images = FakeServer(handle, host='127.0.0.2')
+    try:
+        budget = wacsession.RequestBudget({'127.0.0.2': 2})
+        wacsession.set_budget(budget)
+        policy = wacsession.RequestPolicy(hedge_after=0.1)
+        with wacsession.budget_scope('tm_1.1'):
+            response = policy.request(wacsession.get_session(), 'GET', images.url + '/ids/download?id=tm_1.1.jpg', hedge=True)
+        assert response.content == IMAGES['tm_1.1.jpg'] and len(arrivals) == 2
+        # Both copies ran on hedge pool threads, and both were charged to tm_1.1 (the slow one once it answers)
+        deadline = time.monotonic() + 5
+        while budget.counts.get('tm_1.1', {}).get('127.0.0.2', 0) < 2 and time.monotonic() < deadline:
+            time.sleep(0.05)
+        assert budget.counts == {'tm_1.1': {'127.0.0.2': 2}}
+    finally:
+        images.close()
@@ -0,0 +1,63 @@
+from datetime import timedelta
+
+from conftest import FakeEdan, edan_record, write_config
+
+class CountingLimiter:
+    instances = []
+
+    def __init__(self, requests_per_hour=None):
+        self.waits = 0
+        CountingLimiter.instances.append(self)
+
+    def wait(self):
+        self.waits += 1
+
+def test_prefetch_paces_expired_entries(generator, tmp_path, monkeypatch, caplog):
+    edan = FakeEdan({i: edan_record(i, i) for i in ['tm_1.1', 'tm_1.2', 'tm_1.3']}, quota=10000)
+    try:
+        config = write_config(tmp_path, edan.url, requests_per_hour=1000)
+        si_unit = generator.SIunit.from_yaml(config, 'Test Museum')
+        si_unit.limiter = generator.RateLimiter()  # Setup lookups need no pacing
+        si_unit.api_lookup('tm_1.1')
+        si_unit.api_lookup('tm_1.2')
+        si_unit.session.cache.reset_expiration(timedelta(seconds=-1))
+        si_unit.api_lookup('tm_1.1')  # Revalidated, so fresh again; tm_1.2 stays expired
+
+        monkeypatch.setattr(generator, 'RateLimiter', CountingLimiter)
+        CountingLimiter.instances = []
+        caplog.set_level('INFO')
+        generator.prefetch(['tm_1.1', 'tm_1.2', 'tm_1.3'], config, 'Test Museum', quota_share=0.5)
+    finally:
+        edan.close()
+
+    assert '1 fetched, 1 expired and refreshed, 1 already cached, 0 failed' in caplog.text
+    # The expired record and the miss were both paced against the prefetch share
+    assert sum(limiter.waits for limiter in CountingLimiter.instances) == 2
+    # The 304 for tm_1.2 carried the latest quota count, and the key pool took it
+    assert si_unit.key_pool.remaining() == edan.quota
+    assert [r.headers.get('If-None-Match') is not None for r in edan.content_requests()] == [False, False, True, True, False]
+
+def test_prefetch_stays_paused_until_the_quota_resets(generator, tmp_path, monkeypatch, caplog):
+    edan = FakeEdan({i: edan_record(i, i) for i in ['tm_1.1', 'tm_1.2', 'tm_1.3']}, quota=400)
+    try:
+        config = write_config(tmp_path, edan.url, requests_per_hour=1000)
+        si_unit = generator.SIunit.from_yaml(config, 'Test Museum')
+        si_unit.limiter = generator.RateLimiter()
+        si_unit.api_lookup('tm_1.1')  # 399 left, under the 500 reserved for other runs
+
+        # No reset time is sent, so the count holds for ApiKeyPool.DEFAULT_RESET seconds of (simulated) waiting
+        pauses = []
+        real_time = generator.time.time
+        monkeypatch.setattr(generator.time, 'time', lambda: real_time() + sum(pauses))
+        monkeypatch.setattr(generator.time, 'sleep', pauses.append)
+        monkeypatch.setattr(generator, 'RateLimiter', CountingLimiter)
+        caplog.set_level('INFO')
+        generator.prefetch(['tm_1.1', 'tm_1.2', 'tm_1.3'], config, 'Test Museum', quota_share=0.5)
+    finally:
+        edan.close()
+
+    assert '2 fetched, 0 expired and refreshed, 1 already cached, 0 failed' in caplog.text
+    # Each record waited out a whole reset period, as each response brought back a count under the reserve
+    per_reset = -(-generator.ApiKeyPool.DEFAULT_RESET // generator.PREFETCH_PAUSE)
+    assert pauses == [generator.PREFETCH_PAUSE] * (2 * per_reset)
+    assert len(edan.content_requests()) == 3
@@ -0,0 +1,51 @@
+import time
+
+class StubBackend:
+    '''Stands in for Wikidata: keeps the batches it was asked, and knows Q-numbers for some names'''
+    def __init__(self, known: dict):
+        self.known = known
+        self.batches = []
+
+    def __call__(self, names):
+        self.batches.append(list(names))
+        # Like wikidata_reconcile_backend: an ambiguous name maps to None, and a miss may be left out
+        return {name: self.known[name] for name in names if name in self.known}
+
+NAMES = ['Cassatt, Mary', 'Homer, Winslow', 'Smith, John', 'Unknown Artist', 'Whistler, James McNeill']
+KNOWN = {'Cassatt, Mary': 'Q173223', 'Homer, Winslow': 'Q325298', 'Smith, John': None,
+         'Whistler, James McNeill': 'Q184422'}
+
+def test_names_are_resolved_in_batches_and_misses_are_cached(generator, tmp_path):
+    backend = StubBackend(KNOWN)
+    reconciler = generator.Reconciler(str(tmp_path / 'index.sqlite'), backend=backend, batch_size=2)
+    reconciler.prepare(NAMES + NAMES[:2])
+    assert backend.batches == [NAMES[0:2], NAMES[2:4], NAMES[4:5]]
+    assert reconciler.lookup_many(NAMES) == {**KNOWN, 'Unknown Artist': None}
+
+    # The ambiguous name and the miss are in the index too, so nothing is asked again, even after a restart
+    reconciler.prepare(NAMES)
+    reopened = generator.Reconciler(str(tmp_path / 'index.sqlite'), backend=backend, batch_size=2)
+    reopened.prepare(NAMES)
+    assert len(backend.batches) == 3 and reopened.lookups == 0
+    assert reopened.lookup_many(NAMES) == {**KNOWN, 'Unknown Artist': None}
+
+def test_expired_names_are_looked_up_again(generator, tmp_path, monkeypatch):
+    backend = StubBackend(KNOWN)
+    reconciler = generator.Reconciler(str(tmp_path / 'index.sqlite'), backend=backend, ttl=3600, batch_size=10)
+    reconciler.prepare(NAMES[:3])
+
+    now = time.time()
+    monkeypatch.setattr(generator.time, 'time', lambda: now + 1800)
+    reconciler.prepare(NAMES)  # Only the names not seen yet
+    assert backend.batches == [NAMES[:3], NAMES[3:]]
+
+    backend.known = {**KNOWN, 'Unknown Artist': 'Q1'}
+    monkeypatch.setattr(generator.time, 'time', lambda: now + 3600 + 60)
+    reconciler.prepare(NAMES)  # The first three are past the TTL, the last two are not
+    assert backend.batches[2:] == [NAMES[:3]]
+    assert reconciler.lookup('Unknown Artist') is None
+
+    monkeypatch.setattr(generator.time, 'time', lambda: now + 1800 + 3600 + 60)
+    reconciler.prepare(NAMES)
+    assert backend.batches[3:] == [NAMES[3:]]
+    assert reconciler.lookup('Unknown Artist') == 'Q1'
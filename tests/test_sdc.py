@@ -0,0 +1,59 @@
+import csv
+
+from conftest import FakeEdan, edan_record, requests_fetch, write_config
+
+def claim_values(claims):
+    return {c['mainsnak']['property']: c['mainsnak']['datavalue'] for c in claims}
+
+def test_statement_json_is_typed(generator):
+    statement_json = generator.SDCWriter.statement_json
+    item = statement_json({'property': 'P275', 'datatype': 'wikibase-item',
+                           'datavalue': {'entity-type': 'item', 'numeric-id': '6938433'}})
+    assert item['mainsnak']['datavalue'] == {'type': 'wikibase-entityid',
+                                             'value': {'entity-type': 'item', 'numeric-id': 6938433, 'id': 'Q6938433'}}
+    # Text that looks like JSON stays text: nothing is decoded
+    for text in ['{not json', '"quoted" title', '{"a": 1}']:
+        claim = statement_json({'property': 'P2093', 'datatype': 'string', 'datavalue': [text]})
+        assert claim['mainsnak']['datavalue'] == {'type': 'string', 'value': text}
+    assert statement_json({'property': 'P2093', 'datatype': 'string', 'datavalue': []}) is None
+
+def test_write_sdc_from_generated_csv(generator, fake_commons, tmp_path):
+    edan = FakeEdan({
+        'tm_1.1': edan_record('tm_1.1', 'Plain title'),
+        'tm_1.2': edan_record('tm_1.2', '{Brace} title'),
+        'tm_1.3': edan_record('tm_1.3', '"Quoted" title'),
+    })
+    try:
+        config = write_config(tmp_path, edan.url)
+        fake_commons.pages = {'File:One.jpg': 11, 'File:Two.jpg': 12, 'File:Three.jpg': 13}
+        fake_commons.statements = {'M13': {'P275': [{'mainsnak': {'property': 'P275'}}]}}
+        with open('rows.csv', 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=generator.CSV_COLUMNS)
+            writer.writeheader()
+            for record_id, filename in [('tm_1.1', 'One.jpg'), ('tm_1.2', 'Two.jpg'), ('tm_1.3', 'Three.jpg'),
+                                        ('tm_1.1', 'Missing.jpg')]:
+                writer.writerow({'record_id': record_id, 'commons_filename': filename})
+
+        sdc_writer = generator.SDCWriter(api_url=fake_commons.url + '/w/api.php', fetch=requests_fetch)
+        results = generator.write_sdc('rows.csv', config, None, writer=sdc_writer)
+    finally:
+        edan.close()
+
+    assert results == {'File:One.jpg': 3, 'File:Two.jpg': 3, 'File:Three.jpg': 2, 'File:Missing.jpg': -1}
+    edits = dict(fake_commons.edits)
+    assert claim_values(edits['M12'])['P2093'] == {'type': 'string', 'value': '{Brace} title'}
+    assert claim_values(edits['M11'])['P7851'] == {'type': 'string', 'value': 'tm_1.1'}
+    assert claim_values(edits['M11'])['P275']['value']['id'] == 'Q6938433'
+    assert 'P275' not in claim_values(edits['M13'])  # Existing statements are never overwritten
+    # One content lookup per record, even though tm_1.1 has two files
+    assert len(edan.content_requests()) == 3
+
+def test_bad_statement_skips_only_that_statement(generator, fake_commons):
+    fake_commons.pages = {'File:One.jpg': 11}
+    sdc_writer = generator.SDCWriter(api_url=fake_commons.url + '/w/api.php', fetch=requests_fetch)
+    results = sdc_writer.write({'File:One.jpg': [
+        {'property': 'P275', 'datatype': 'wikibase-item', 'datavalue': {'numeric-id': 'not a number'}},
+        {'property': 'P7851', 'datatype': 'string', 'datavalue': ['tm_1.1']},
+    ]})
+    assert results == {'File:One.jpg': 1}
+    assert list(claim_values(fake_commons.edits[0][1])) == ['P7851']
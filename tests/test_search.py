@@ -0,0 +1,68 @@
+import csv
+
+import pytest
+import yaml
+
+import sisearch
+from conftest import FakeEdan, edan_record, write_config
+
+SEARCH_URL = 'https://collections.si.edu/search/results.htm?q=&fq=data_source%3A%22Test+Museum%22'
+
+def record_ids(filename):
+    with open(filename, newline='') as f:
+        return {row['record_id'] for row in csv.DictReader(f)}
+
+def search_edan():
+    return FakeEdan({
+        'tm_1.1': edan_record('tm_1.1', 'Open', 'https://ids.si.edu/ids/download?id=tm_1.1.jpg'),
+        'tm_1.2': edan_record('tm_1.2', 'Restricted', 'https://ids.si.edu/ids/download?id=tm_1.2.jpg',
+                              access='Usage conditions apply'),
+        'tm_1.3': edan_record('tm_1.3', 'No media'),
+        'tm_1.4': edan_record('tm_1.4', 'Also open', 'https://ids.si.edu/ids/download?id=tm_1.4.jpg'),
+    })
+
+def test_cc0_media_filter_is_applied_to_search_results(generator, tmp_path):
+    assert sisearch.collections_url_to_api_query(SEARCH_URL + '&media.CC0=true') == 'data_source:"Test Museum"'
+    assert sisearch.requires_cc0_media(SEARCH_URL + '&media.CC0=true')
+    assert not sisearch.requires_cc0_media(SEARCH_URL)
+
+    edan = search_edan()
+    try:
+        config = write_config(tmp_path, edan.url)
+        assert generator.process_search(SEARCH_URL + '&media.CC0=true', config, 'Test Museum', 'cc0.csv', 'cc0.txt')
+        assert generator.process_search(SEARCH_URL, config, 'Test Museum', 'all.csv')
+    finally:
+        edan.close()
+    assert record_ids('cc0.csv') == {'tm_1.1', 'tm_1.4'}
+    with open('cc0.txt') as f:
+        assert f.read().split() == ['tm_1.1', 'tm_1.4']
+    assert record_ids('all.csv') == {'tm_1.1', 'tm_1.2', 'tm_1.3', 'tm_1.4'}
+
+def test_search_is_sharded(generator, tmp_path):
+    edan = search_edan()
+    try:
+        config = write_config(tmp_path, edan.url)
+        for index in range(2):
+            generator.process_search(SEARCH_URL, config, 'Test Museum', f'shard{index}.csv', f'shard{index}.txt',
+                                     shard=(index, 2))
+    finally:
+        edan.close()
+    shards = []
+    for index in range(2):
+        with open(f'shard{index}.txt') as f:
+            shards.append(set(f.read().split()))
+        assert all(generator.in_shard(identifier, (index, 2)) for identifier in shards[index])
+    assert not shards[0] & shards[1] and shards[0] | shards[1] == {'tm_1.1', 'tm_1.2', 'tm_1.3', 'tm_1.4'}
+
+def test_unit_without_search_url_exits_for_the_scraper(generator, tmp_path):
+    config = write_config(tmp_path, 'http://127.0.0.1:9')
+    with open(config) as f:
+        spec = yaml.safe_load(f)
+    for unit in spec['units']:
+        del unit['unit']['api']['search_url']
+    with open(config, 'w') as f:
+        yaml.safe_dump(spec, f)
+    # Exit status 4 tells siwikiapiconnect.py to scrape the search instead
+    with pytest.raises(SystemExit) as exit_info:
+        generator.process_search(SEARCH_URL, config, 'Test Museum', 'rows.csv')
+    assert exit_info.value.code == 4
@@ -0,0 +1,24 @@
+import csv
+
+from conftest import FakeEdan, edan_record, write_config
+
+def read_ids(filename):
+    with open(filename, newline='') as f:
+        return [row['record_id'] for row in csv.DictReader(f)]
+
+def test_records_without_rows_are_retried(generator, tmp_path, monkeypatch):
+    edan = FakeEdan({i: edan_record(i, 'Title ' + i, 'https://ids.si.edu/ids/deliveryService?id=' + i)
+                     for i in ['tm_1.1', 'tm_1.2', 'tm_1.3']})
+    try:
+        config = write_config(tmp_path, edan.url)
+        items_to_csv_rows = generator.SIunit.items_to_csv_rows
+        broken = lambda self, identifier, item_list: [] if identifier == 'tm_1.2' else items_to_csv_rows(self, identifier, item_list)
+        monkeypatch.setattr(generator.SIunit, 'items_to_csv_rows', broken)
+        generator.sync_search('*', config, 'Test Museum', 'first.csv', 'manifest.sqlite', None, transform_cache=None)
+        assert read_ids('first.csv') == ['tm_1.1', 'tm_1.3']
+
+        monkeypatch.setattr(generator.SIunit, 'items_to_csv_rows', items_to_csv_rows)
+        generator.sync_search('*', config, 'Test Museum', 'second.csv', 'manifest.sqlite', None, transform_cache=None)
+        assert read_ids('second.csv') == ['tm_1.2']
+    finally:
+        edan.close()
@@ -0,0 +1,62 @@
+import concurrent.futures
+import multiprocessing
+
+from jsonpath_ng import parse
+
+from conftest import edan_record, write_config
+
+def test_compiled_columns_match_jsonpath_ng(generator):
+    expression = '$.a[*]'
+    records = [{'a': value} for value in [None, 0, '', {}, [], False, 5, True, 'text', {'b': 1}, [1, 2], [[3]], 'xy']]
+    jsonpath_expr = parse(expression)
+    assert generator.compile_column(expression)(records) == \
+        [[match.value for match in jsonpath_expr.find(r)] for r in records]
+
+def test_failed_record_does_not_spoil_the_batch(generator, tmp_path):
+    si_unit = generator.SIunit.from_yaml(write_config(tmp_path, 'http://127.0.0.1:9'), 'Test Museum')
+    si_unit.spec['commons_template']['fields']['accession'] = {
+        'jsonpath': '$.response.content.descriptiveNonRepeating.record_ID', 'formatstring': 'No. %d'}
+    si_unit.transform_cache = generator.TransformCache()
+    records = {'tm_1': {'response': edan_record('tm_1', 'One')},
+               'tm_2': {'response': edan_record('tm_2', 'Two')},
+               'tm_3': {'response': edan_record('tm_3', 'Three')}}
+    records['tm_1']['response']['content']['descriptiveNonRepeating']['record_ID'] = 1
+    records['tm_3']['response']['content']['descriptiveNonRepeating']['record_ID'] = 3
+
+    object_dicts = si_unit.records_to_commonsdicts(list(records.values()), si_unit.spec['commons_template'], list(records))
+    # 'No. %d' % 'tm_2' fails for that record only
+    assert [d and d['accession'] for d in object_dicts] == ['No. 1', None, 'No. 3']
+    assert object_dicts[0]['title'] == ['One']
+
+    assert [rows and len(rows) for rows in si_unit.transform_records(records).values()] == [1, None, 1]
+
+    rows = si_unit.records_to_commons_csv_entries(records)
+    assert rows['tm_2'] == [] and len(rows['tm_1']) == len(rows['tm_3']) == 1
+    # The failure is not cached: fixing the record (or the config) makes it go through next time
+    records['tm_2']['response']['content']['descriptiveNonRepeating']['record_ID'] = 2
+    assert len(si_unit.records_to_commons_csv_entries(records)['tm_2']) == 1
+
+def transform_in_pool(generator, si_unit, records):
+    # Fork, so the workers see the generator module the tests loaded
+    with concurrent.futures.ProcessPoolExecutor(max_workers=2, mp_context=multiprocessing.get_context('fork'),
+                                                initializer=generator._init_transform_worker,
+                                                initargs=([si_unit.spec], None)) as executor:
+        return si_unit.records_to_commons_csv_entries(records, executor)
+
+def test_transform_processes_reuse_and_fill_the_cache(generator, tmp_path):
+    si_unit = generator.SIunit.from_yaml(write_config(tmp_path, 'http://127.0.0.1:9'), 'Test Museum')
+    si_unit.transform_cache = generator.TransformCache()
+    records = {f'tm_{n}': {'response': edan_record(f'tm_{n}', f'Object {n}', f'https://ids.si.edu/ids/download?id=tm_{n}.jpg')}
+               for n in range(5)}
+    field_count = len(si_unit.field_hashes())
+    first = transform_in_pool(generator, si_unit, records)
+    assert si_unit.transform_cache.fields_evaluated == 5 * field_count
+
+    # A categories change invalidates the rows, but the field values the workers computed were stored here
+    si_unit.spec['commons_template']['categories'] = '[[Category:Test Museum objects]]'
+    second = transform_in_pool(generator, si_unit, records)
+    assert si_unit.transform_cache.fields_evaluated == 5 * field_count
+    assert si_unit.transform_cache.fields_reused == 5 * field_count
+    assert si_unit.transform_cache.templates_reused == 5
+    assert all('Test Museum objects' in rows[0]['description'] for rows in second.values())
+    assert all('Test Museum objects' not in rows[0]['description'] for rows in first.values())
@@ -0,0 +1,27 @@
+import os
+
+import wacsession
+from conftest import FakeEdan, edan_record, load_script, write_config
+
+def test_imported_entries_are_cache_hits(generator, tmp_path, monkeypatch):
+    wac_cache = load_script('wac-cache.py', 'wac_cache')
+    edan = FakeEdan({'tm_1.1': edan_record('tm_1.1', 'One'), 'tm_1.2': edan_record('tm_1.2', 'Two')})
+    try:
+        config = write_config(tmp_path, edan.url)
+        si_unit = generator.SIunit.from_yaml(config, 'Test Museum')
+        si_unit.api_lookup('tm_1.1')
+        si_unit.api_lookup('tm_1.2')
+        unit = wac_cache.load_unit(config, 'Test Museum')
+        bundle = wac_cache.export_bundle('siapi_cache', str(tmp_path / 'one.wacbundle'), unit, ['tm_1.1'])
+
+        # A second machine: empty working directory, fresh sessions
+        os.mkdir(tmp_path / 'other')
+        monkeypatch.chdir(tmp_path / 'other')
+        monkeypatch.setattr(wacsession, '_sessions', {})
+        assert wac_cache.import_bundle(bundle) == 1
+        si_unit = generator.SIunit.from_yaml(config, 'Test Museum')
+        assert si_unit.is_cached('tm_1.1', fresh=True) and not si_unit.is_cached('tm_1.2')
+        assert si_unit.api_lookup('tm_1.1')['response']['title'] == 'One'
+        assert len(edan.content_requests()) == 2
+    finally:
+        edan.close()
@@ -0,0 +1,56 @@
+import threading
+import time
+
+import wacsession
+from conftest import FakeServer
+
+def slow_server(delays):
+    '''Answers /N after delays[N - 1] seconds (the Nth request to arrive), instantly once delays run out'''
+    arrivals = []
+
+    def handle(request):
+        arrivals.append(request.path)
+        if len(arrivals) <= len(delays):
+            time.sleep(delays[len(arrivals) - 1])
+        return 200, {}, b'ok'
+    return FakeServer(handle)
+
+def test_hedge_pool_follows_configured_pool_size():
+    wacsession.configure(pool_maxsize=3)
+    policy = wacsession.RequestPolicy(hedge_after=0.1)
+    assert policy.hedge_pool()._max_workers == 6
+
+def test_slow_request_is_hedged():
+    server = slow_server([2.0])
+    try:
+        policy = wacsession.RequestPolicy(hedge_after=0.1)
+        started = time.monotonic()
+        response = policy.request(wacsession.get_session(), 'GET', server.url + '/image', hedge=True)
+        assert response.status_code == 200 and time.monotonic() - started < 1.5
+        assert len(server.requests) == 2
+    finally:
+        server.close()
+
+def test_queued_request_is_not_hedged():
+    wacsession.configure(pool_maxsize=1)
+    server = slow_server([])
+    try:
+        policy = wacsession.RequestPolicy(hedge_after=0.2)
+        release = threading.Event()
+        blockers = [policy.hedge_pool().submit(release.wait) for _ in range(2)]  # Every hedge thread busy
+        threading.Timer(0.5, release.set).start()
+        response = policy.request(wacsession.get_session(), 'GET', server.url + '/image', hedge=True)
+        assert response.status_code == 200 and all(b.result() for b in blockers)
+        # Half a second queued is longer than hedge_after, but the request itself was fast: no duplicate
+        assert len(server.requests) == 1
+    finally:
+        server.close()
+
+def test_wikidata_session_identifies_the_tool():
+    server = FakeServer(lambda request: (200, {}, b'ok'))
+    try:
+        wacsession.get_session('wikidata').post(server.url + '/sparql', data={'query': 'ASK {}'})
+    finally:
+        server.close()
+    assert server.requests[0].headers['User-Agent'] == wacsession.USER_AGENT
+    assert wacsession.USER_AGENT.startswith('WikiAPIConnector/' + wacsession.TOOL_VERSION + ' (')
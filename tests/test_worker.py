@@ -0,0 +1,78 @@
+import json
+import threading
+import time
+from http.server import ThreadingHTTPServer
+
+import pytest
+import requests
+
+from conftest import FakeEdan, edan_record, load_script, write_config
+
+TOKEN = 'test-token'
+AUTH = {'Authorization': 'Bearer ' + TOKEN}
+
+@pytest.fixture
+def worker_server(generator, uploader, monkeypatch, tmp_path):
+    '''A worker (its job thread not started) behind its HTTP API, with the tools it loads already imported'''
+    wac_worker = load_script('wac-worker.py', 'wac_worker')
+    monkeypatch.setattr(wac_worker, 'load_script', load_script)
+    worker = wac_worker.Worker('config.yml', str(tmp_path / 'wac-jobs'))
+    server = ThreadingHTTPServer(('127.0.0.1', 0), wac_worker.handler_for(worker, TOKEN))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield worker, 'http://127.0.0.1:%d/jobs' % (server.server_address[1],)
+    server.shutdown()
+    server.server_close()
+    wac_worker.wacsession.set_progress_listener(None)
+
+def post(url, body, content_type='application/json', headers=AUTH):
+    return requests.post(url, data=json.dumps(body) if not isinstance(body, bytes) else body,
+                         headers={'Content-Type': content_type, **headers}, timeout=10)
+
+def test_requests_need_the_token(worker_server):
+    worker, url = worker_server
+    assert requests.get(url, timeout=10).status_code == 401
+    assert requests.get(url, headers={'Authorization': 'Bearer wrong'}, timeout=10).status_code == 401
+    assert post(url, {'type': 'identifiers', 'identifiers': ['tm_1.1']}, headers={}).status_code == 401
+    assert requests.get(url, headers=AUTH, timeout=10).json() == []
+    assert worker.jobs == {}
+
+def test_only_json_and_csv_bodies_are_accepted(worker_server):
+    worker, url = worker_server
+    # What a cross-site form or fetch without a preflight can send
+    for content_type in ['text/plain', 'application/x-www-form-urlencoded', 'multipart/form-data; boundary=x']:
+        assert post(url, {'type': 'upload', 'csv': 'rows.csv'}, content_type).status_code == 415
+    assert worker.jobs == {}
+    assert post(url, {'type': 'upload', 'csv': 'rows.csv'}, 'application/json; charset=utf-8').status_code == 202
+
+def test_job_paths_stay_inside_the_jobs_directory(worker_server, tmp_path):
+    worker, url = worker_server
+    for request in [{'type': 'upload', 'csv': '../rows.csv'},
+                    {'type': 'upload', 'csv': str(tmp_path / 'rows.csv')},
+                    {'type': 'identifiers', 'identifiers': ['tm_1.1'], 'output': '/etc/cron.d/wac'},
+                    {'type': 'search', 'url': 'https://collections.si.edu/search/results.htm?q=x', 'config': '../config.yml'},
+                    {'type': 'identifiers', 'identifiers': ['tm_1.1'], 'output': ['list.csv']}]:
+        response = post(url, request)
+        assert response.status_code == 400, request
+    assert worker.jobs == {}
+
+    job = post(url, {'type': 'identifiers', 'identifiers': ['tm_1.1'], 'output': 'sub/../out.csv'}).json()
+    assert worker.jobs[job['id']].request['output'] == str((tmp_path / 'wac-jobs' / 'out.csv').resolve())
+
+def test_job_reports_its_own_progress(worker_server, tmp_path):
+    worker, url = worker_server
+    edan = FakeEdan({'tm_1.1': edan_record('tm_1.1', 'One'), 'tm_1.2': edan_record('tm_1.2', 'Two')})
+    try:
+        write_config(tmp_path / 'wac-jobs', edan.url)
+        unrelated = worker.generator.tqdm(total=5, desc='Not a job')  # Another thread's bar is not reported
+        job = post(url, {'type': 'identifiers', 'identifiers': ['tm_1.1', 'tm_1.2'], 'config': 'config.yml'}).json()
+        worker.thread.start()
+        deadline = time.monotonic() + 30
+        while worker.jobs[job['id']].state in ('queued', 'running') and time.monotonic() < deadline:
+            time.sleep(0.05)
+        unrelated.close()
+        report = requests.get(f"{url}/{job['id']}", headers=AUTH, timeout=10).json()
+    finally:
+        edan.close()
+    assert report['state'] == 'done', report
+    assert {'stage': 'Processing', 'done': 2, 'total': 2} in report['progress']
+    assert all(bar['stage'] != 'Not a job' for bar in report['progress'])
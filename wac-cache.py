@@ -0,0 +1,231 @@
+# Export, import and compact the HTTP caches used by the Wiki API Connector tools
+#
+# A bundle is a gzip-compressed JSON Lines file: a header line, one line per cached response (URL with API
+# keys scrubbed, status, headers, timestamps and the SHA-256 of the body), and one line per distinct body,
+# stored once and addressed by its SHA-256. The default bundle name is derived from its contents, so the
+# same export always produces the same file and bundles can be shared and deduplicated by name.
+#
+# Examples:
+#   python wac-cache.py export -c config.yml -u "Smithsonian American Art Museum"
+#   python wac-cache.py export -c config.yml -u "Smithsonian American Art Museum" -i saam.txt -o saam.wacbundle
+#   python wac-cache.py import siapi_cache-1a2b3c4d5e6f.wacbundle
+#   python wac-cache.py compact --expired
+
+import argparse
+import base64
+import gzip
+import hashlib
+import json
+import logging
+import os
+import re
+import sys
+from datetime import datetime
+
+import yaml
+from requests.structures import CaseInsensitiveDict
+from requests_cache.models import CachedRequest, CachedResponse
+
+import wacsession
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(levelname)s:%(message)s'
+)
+
+BUNDLE_FORMAT = 'wac-cache-bundle'
+BUNDLE_VERSION = 1
+DEFAULT_CACHE = 'siapi_cache'
+SCRUBBED_HEADERS = {'set-cookie', 'x-api-key', 'authorization'}
+
+def open_cache(cache_name: str):
+    '''Open a cached session by name, with API keys left out of cache keys as the tools do'''
+    return wacsession.get_session(cache_name, cache_name=cache_name, ignored_parameters=['api_key'])
+
+def load_unit(config_file: str, unit_name: str) -> dict:
+    '''Return the unit spec called unit_name from a YAML config file'''
+    with open(config_file) as stream:
+        for o in yaml.safe_load(stream).get('units', []):
+            if o['unit']['name'] == unit_name:
+                return o['unit']
+    logging.error(f'No unit named {unit_name} in {config_file}')
+    sys.exit(1)
+
+def unit_url(unit: dict, identifier: str) -> str:
+    '''API URL for an identifier, with a placeholder key (the key is not part of the cache key)'''
+    return unit['api']['api_url'].format(identifier, 'REDACTED')
+
+def unit_id_regex(unit: dict):
+    '''Regex that pulls the identifier back out of a cached API URL for this unit'''
+    prefix, _, rest = unit['api']['api_url'].partition('{}')
+    return re.compile(re.escape(prefix) + r'([^?&/]+)' + re.escape(rest.split('{}')[0]))
+
+def select_keys(session, unit: dict = None, identifiers: list = None) -> list:
+    '''
+    Cache keys to export: those for the identifiers if given, else those whose URL belongs to the unit
+    (by api_url and id_pattern) if given, else every key in the cache
+    '''
+    cache = session.cache
+    if identifiers:
+        keys = [wacsession.cache_key(session, unit_url(unit, i)) for i in identifiers]
+        return [k for k in keys if cache.contains(key=k)]
+    if unit is None:
+        return list(cache.responses.keys())
+
+    id_regex = unit_id_regex(unit)
+    id_pattern = re.compile(unit['id_pattern']) if unit.get('id_pattern') else None
+    keys = []
+    for key, response in cache.responses.items():
+        m = id_regex.match(response.url or '')
+        if m and (id_pattern is None or id_pattern.match(m.group(1))):
+            keys.append(key)
+    return keys
+
+def entry_for(response) -> dict:
+    '''Bundle line for one cached response, with keys scrubbed from the URL and sensitive headers dropped'''
+    return {
+        'url': wacsession.redact(response.url),
+        'status': response.status_code,
+        'reason': response.reason,
+        'encoding': response.encoding,
+        'headers': {k: v for k, v in response.headers.items() if k.lower() not in SCRUBBED_HEADERS},
+        'created_at': response.created_at.isoformat() if response.created_at else None,
+        'expires': response.expires.isoformat() if response.expires else None,
+        'sha256': hashlib.sha256(response.content or b'').hexdigest(),
+    }
+
+def export_bundle(cache_name: str, output_file: str = None, unit: dict = None, identifiers: list = None) -> str:
+    '''
+    Write the selected entries of a cache to a bundle and return its filename. Without output_file the
+    bundle is named <cache>-<first 12 hex of its content hash>.wacbundle.
+    '''
+    session = open_cache(cache_name)
+    cache = session.cache
+    entries = []
+    bodies = {}
+    for key in select_keys(session, unit, identifiers):
+        response = cache.get_response(key)
+        if response is None:
+            continue
+        entry = entry_for(response)
+        entries.append(entry)
+        bodies[entry['sha256']] = response.content or b''
+
+    entries.sort(key=lambda e: e['url'])
+    lines = [json.dumps(e, sort_keys=True) for e in entries]
+    lines += [json.dumps({'blob': digest, 'body': base64.b64encode(bodies[digest]).decode('ascii')})
+              for digest in sorted(bodies)]
+    content_hash = hashlib.sha256('\n'.join(lines).encode('utf-8')).hexdigest()
+    header = json.dumps({'format': BUNDLE_FORMAT, 'version': BUNDLE_VERSION, 'cache': cache_name,
+                         'entries': len(entries), 'blobs': len(bodies), 'sha256': content_hash})
+
+    output_file = output_file or f'{cache_name}-{content_hash[:12]}.wacbundle'
+    # mtime=0 keeps the compressed bytes identical for identical contents
+    with open(output_file + '.tmp', 'wb') as raw, gzip.GzipFile(fileobj=raw, mode='wb', mtime=0) as f:
+        f.write('\n'.join([header] + lines).encode('utf-8') + b'\n')
+    os.replace(output_file + '.tmp', output_file)
+    logging.info(f'Exported {len(entries)} responses ({len(bodies)} distinct bodies) from {cache_name} to {output_file}')
+    return output_file
+
+def import_bundle(bundle_file: str, cache_name: str = None) -> int:
+    '''
+    Load a bundle into a cache (by default the one it was exported from). Bodies are checked against their
+    SHA-256, and an entry already cached more recently than the bundle's copy is kept. Returns the number imported.
+    '''
+    with gzip.open(bundle_file, 'rt', encoding='utf-8') as f:
+        header = json.loads(f.readline())
+        if header.get('format') != BUNDLE_FORMAT or header.get('version') != BUNDLE_VERSION:
+            logging.error(f'{bundle_file} is not a version {BUNDLE_VERSION} cache bundle')
+            sys.exit(1)
+        entries, bodies = [], {}
+        for line in f:
+            item = json.loads(line)
+            if 'blob' in item:
+                body = base64.b64decode(item['body'])
+                if hashlib.sha256(body).hexdigest() != item['blob']:
+                    logging.error(f"{bundle_file}: body {item['blob'][:12]} is corrupt, skipping it")
+                    continue
+                bodies[item['blob']] = body
+            else:
+                entries.append(item)
+
+    session = open_cache(cache_name or header['cache'])
+    cache = session.cache
+    imported = skipped = 0
+    for entry in entries:
+        if entry['sha256'] not in bodies:
+            skipped += 1
+            continue
+        created_at = datetime.fromisoformat(entry['created_at']) if entry['created_at'] else None
+        key = wacsession.cache_key(session, entry['url'])  # The key the tools will look the URL up by
+        existing = cache.get_response(key)
+        if existing is not None and created_at is not None and existing.created_at and existing.created_at >= created_at:
+            skipped += 1
+            continue
+        cache.responses[key] = CachedResponse(
+            content=bodies[entry['sha256']],
+            status_code=entry['status'],
+            reason=entry['reason'],
+            encoding=entry['encoding'],
+            url=entry['url'],
+            headers=CaseInsensitiveDict(entry['headers']),
+            request=CachedRequest(method='GET', url=entry['url'], headers=CaseInsensitiveDict()),
+            created_at=created_at,
+            expires=datetime.fromisoformat(entry['expires']) if entry['expires'] else None,
+        )
+        imported += 1
+    logging.info(f'Imported {imported} responses from {bundle_file} into {cache_name or header["cache"]}, '
+                 f'kept {skipped} newer or incomplete')
+    return imported
+
+def compact(cache_name: str, expired: bool = False) -> None:
+    '''Optionally drop expired responses, prune dangling redirects and VACUUM the sqlite file'''
+    cache = open_cache(cache_name).cache
+    before = os.path.getsize(cache.db_path) if os.path.exists(cache.db_path) else 0
+    count = cache.responses.count(expired=True)
+    cache.delete(expired=expired)  # Also prunes redirects and vacuums
+    after = os.path.getsize(cache.db_path) if os.path.exists(cache.db_path) else 0
+    logging.info(f'{cache_name}: {count} -> {cache.responses.count(expired=True)} responses, '
+                 f'{before / 1e6:.1f} MB -> {after / 1e6:.1f} MB')
+
+def main():
+    parser = argparse.ArgumentParser(description="Export, import and compact the Wiki API Connector HTTP caches")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = subparsers.add_parser("export", help="Write cache entries to a compressed bundle")
+    export_parser.add_argument("--cache", default=DEFAULT_CACHE, help=f"Cache name (default: {DEFAULT_CACHE})")
+    export_parser.add_argument("-c", "--config", dest="config_file", help="Configuration file in YAML format")
+    export_parser.add_argument("-u", "--unit", dest="unit_string", help="Only export records of this unit")
+    export_parser.add_argument("-i", "--input", dest="input_file",
+                               help="Only export these identifiers (one per line), needs -c and -u")
+    export_parser.add_argument("-o", "--output", dest="output_file",
+                               help="Bundle file (default: <cache>-<content hash>.wacbundle)")
+
+    import_parser = subparsers.add_parser("import", help="Load bundles into a cache")
+    import_parser.add_argument("bundles", nargs="+", metavar="BUNDLE")
+    import_parser.add_argument("--cache", help="Cache name (default: the cache the bundle came from)")
+
+    compact_parser = subparsers.add_parser("compact", help="Vacuum a cache, optionally dropping expired entries")
+    compact_parser.add_argument("--cache", default=DEFAULT_CACHE, help=f"Cache name (default: {DEFAULT_CACHE})")
+    compact_parser.add_argument("--expired", action="store_true", help="Delete expired responses first")
+
+    args = parser.parse_args()
+
+    if args.command == "export":
+        if (args.unit_string or args.input_file) and not (args.config_file and args.unit_string):
+            logging.error('Selecting by unit or identifiers needs -c and -u')
+            sys.exit(1)
+        unit = load_unit(args.config_file, args.unit_string) if args.unit_string else None
+        identifiers = None
+        if args.input_file:
+            with open(args.input_file) as f:
+                identifiers = [line.strip() for line in f if line.strip()]
+        export_bundle(args.cache, args.output_file, unit, identifiers)
+    elif args.command == "import":
+        for bundle in args.bundles:
+            import_bundle(bundle, args.cache)
+    else:
+        compact(args.cache, args.expired)
+
+if __name__ == "__main__":
+    main()
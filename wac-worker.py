@@ -0,0 +1,328 @@
+# Long-running worker for the Wiki API Connector tools, taking jobs over a local HTTP API
+#
+# A single run of the generator or uploader spends most of a small job starting up: importing pywikibot,
+# parsing config.yml, opening the sqlite caches, logging in to Commons and setting up TLS connections.
+# The worker pays for that once. The generator and uploader are loaded as modules, and the HTTP sessions,
+# API key pools and rate limiters, caches, reconciliation index and Commons login stay warm between jobs.
+# config.yml is parsed again only when it changes on disk.
+#
+# Jobs run one at a time in submission order, so they share the API quota and the upload throttle the
+# same way successive command-line runs would.
+#
+# Every request needs the worker's token (--token, or the one generated and logged at startup), and job
+# submissions must be JSON or CSV, so a web page cannot submit jobs through the browser. File paths in a
+# job are relative to the jobs directory and cannot leave it.
+#
+# Examples:
+#   python wac-worker.py -c config.yml --token "$WAC_TOKEN"
+#   curl -H "Authorization: Bearer $WAC_TOKEN" -H 'Content-Type: application/json' \
+#        -d '{"type": "search", "url": "https://collections.si.edu/search/results.htm?...", "unit": "..."}' localhost:8765/jobs
+#   curl -H "Authorization: Bearer $WAC_TOKEN" -H 'Content-Type: application/json' \
+#        -d '{"type": "identifiers", "identifiers": ["saam_1916.8.1"], "upload": true}' localhost:8765/jobs
+#   curl -H "Authorization: Bearer $WAC_TOKEN" -H 'Content-Type: text/csv' --data-binary @wacfile.csv localhost:8765/jobs
+#   curl -H "Authorization: Bearer $WAC_TOKEN" localhost:8765/jobs/3
+
+import argparse
+import collections
+import hmac
+import importlib.util
+import itertools
+import json
+import logging
+import os
+import queue
+import secrets
+import sys
+import threading
+import time
+import traceback
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import wacsession
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(levelname)s:%(message)s'
+)
+
+DEFAULT_HOST = '127.0.0.1'  # Local only by default
+JOB_PATHS = ('output', 'config', 'csv')  # Job fields naming files, which must stay inside the jobs directory
+DEFAULT_PORT = 8765
+DEFAULT_JOBS_DIR = 'wac-jobs'
+JOB_LOG_LINES = 50  # Most recent log lines kept per job
+
+def load_script(filename: str, module_name: str):
+    '''Import one of the hyphen-named tool scripts as a module'''
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), filename)
+    spec = importlib.util.spec_from_file_location(module_name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[module_name] = module  # dataclasses and pickling (the transform pool) look modules up by name
+    spec.loader.exec_module(module)
+    return module
+
+class Job:
+    """
+    One submitted job: its request, state (queued, running, done, failed), output file, progress bars and
+    recent log lines
+    """
+    def __init__(self, job_id: int, request: dict):
+        self.id = job_id
+        self.request = request
+        self.state = 'queued'
+        self.error = None
+        self.output = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.log = collections.deque(maxlen=JOB_LOG_LINES)
+        self.bars = []
+
+    def progress(self) -> list:
+        return [{'stage': bar.desc, 'done': bar.n, 'total': bar.total} for bar in self.bars]
+
+    def to_dict(self, progress: list = None) -> dict:
+        return {
+            'id': self.id,
+            'type': self.request.get('type'),
+            'state': self.state,
+            'error': self.error,
+            'output': self.output,
+            'submitted': self.submitted,
+            'started': self.started,
+            'finished': self.finished,
+            'progress': progress if progress is not None else [],
+            'log': list(self.log),
+        }
+
+class JobLogHandler(logging.Handler):
+    """Copies log records emitted by the worker thread into the running job's log"""
+    def __init__(self, worker: 'Worker'):
+        super().__init__(level=logging.INFO)
+        self.worker = worker
+        self.setFormatter(logging.Formatter('%(levelname)s:%(message)s'))
+
+    def emit(self, record: logging.LogRecord) -> None:
+        job = self.worker.current
+        if job is not None and record.thread == self.worker.thread.ident:
+            job.log.append(wacsession.redact(self.format(record)))
+
+class Worker:
+    """
+    Runs jobs from a queue in a single thread that owns the warm state. sqlite connections (transform
+    cache, reconciliation index, upload ledger, URL cache) are opened there on first use, since sqlite
+    connections stay with the thread that opened them.
+    """
+    def __init__(self, config_file: str, jobs_dir: str = DEFAULT_JOBS_DIR, upload_workers: int = None):
+        self.config_file = config_file
+        self.jobs_dir = jobs_dir
+        self.generator = load_script('wikiapiconnector-generator.py', 'wikiapiconnector_generator')
+        self.uploader_module = load_script('commons-upload-csv.py', 'commons_upload_csv')
+        self.upload_workers = upload_workers or self.uploader_module.DEFAULT_WORKERS
+        wacsession.configure(pool_maxsize=max(self.upload_workers, self.uploader_module.DEFAULT_RESOLVE_WORKERS))
+        self.jobs = {}
+        self.queue = queue.Queue()
+        self.current = None
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._warm = {}
+        os.makedirs(jobs_dir, exist_ok=True)
+        self.thread = threading.Thread(target=self.run, name='wac-worker', daemon=True)
+        logging.getLogger().addHandler(JobLogHandler(self))
+        wacsession.set_progress_listener(self.track_bar)
+
+    def in_jobs_dir(self, path) -> str:
+        '''path resolved against the jobs directory; ValueError if it is not a string or leads outside it'''
+        if not isinstance(path, str) or not path:
+            raise ValueError(f'{path!r} is not a file name')
+        jobs_dir = os.path.realpath(self.jobs_dir)
+        resolved = os.path.realpath(os.path.join(jobs_dir, path))
+        if os.path.commonpath([jobs_dir, resolved]) != jobs_dir:
+            raise ValueError(f'{path} is outside the jobs directory')
+        return resolved
+
+    def check(self, request: dict) -> dict:
+        '''The request with its file paths resolved inside the jobs directory (ValueError if one is not)'''
+        return {**request, **{name: self.in_jobs_dir(request[name]) for name in JOB_PATHS if name in request}}
+
+    def submit(self, request: dict) -> Job:
+        with self._lock:
+            job = Job(next(self._ids), request)
+            self.jobs[job.id] = job
+        self.queue.put(job)
+        return job
+
+    def track_bar(self, bar) -> None:
+        '''Progress listener: bars created by the worker thread belong to the running job'''
+        job = self.current
+        if job is not None and threading.current_thread() is self.thread:
+            job.bars.append(bar)
+
+    def warm(self, name: str, factory):
+        '''Object created on first use in the worker thread and kept for later jobs'''
+        if name not in self._warm:
+            self._warm[name] = factory()
+        return self._warm[name]
+
+    def run(self) -> None:
+        while True:
+            job = self.queue.get()
+            self.current = job
+            job.state, job.started = 'running', time.time()
+            try:
+                self.run_job(job)
+                job.state = 'done'
+            except SystemExit as e:
+                # The tools exit on bad input (unknown unit, untranslatable search URL); only the job fails
+                job.state, job.error = 'failed', f'exited with status {e.code}'
+            except KeyError as e:
+                logging.error(f'Job {job.id} is missing {e}')
+                job.state, job.error = 'failed', f'missing {e}'
+            except ValueError as e:
+                logging.error(str(e))
+                job.state, job.error = 'failed', str(e)
+            except Exception as e:
+                logging.error(traceback.format_exc())
+                job.state, job.error = 'failed', wacsession.redact(str(e))
+            job.finished = time.time()
+            logging.info(f"Job {job.id} {job.state} in {job.finished - job.started:.1f} s")
+            self.current = None
+
+    def run_job(self, job: Job) -> None:
+        request = job.request
+        config_file = request.get('config', self.config_file)
+        unit = request.get('unit')  # Without a unit, identifiers are routed by id_pattern
+        kind = request.get('type')
+        generator = self.generator
+        options = dict(transform_cache=self.warm('transform_cache', generator.TransformCache),
+                       reconciler=self.warm('reconciler', generator.Reconciler))
+
+        if kind in ('search', 'identifiers'):
+            job.output = request.get('output') or os.path.join(self.jobs_dir, f'{job.id}.csv')
+            if kind == 'search':
+                ids_file = os.path.join(self.jobs_dir, f'{job.id}.txt')
+                if not generator.process_search(request['url'], config_file, unit, job.output, ids_file, **options):
+                    raise ValueError('This search URL cannot be translated into an API search; scrape it with '
+                                     'si-collections-search-dumper.py and submit the identifiers')
+            else:
+                generator.process_identifiers(list(request['identifiers']), config_file, unit, job.output, **options)
+            if request.get('upload'):
+                self.upload(job.output, request)
+        elif kind == 'upload':
+            job.output = request['csv']
+            self.upload(job.output, request)
+        else:
+            raise ValueError(f'Unknown job type {kind!r}: use search, identifiers or upload')
+
+    def upload(self, csv_file: str, request: dict) -> None:
+        if not os.path.exists(csv_file):
+            logging.info(f'{csv_file} was not written (no rows), nothing to upload')
+            return
+        uploader_module = self.uploader_module
+        uploader = self.warm('uploader', lambda: uploader_module.CommonsUploader(throttle=uploader_module.UploadThrottle()))
+        uploader_module.process_csv(csv_file, workers=self.upload_workers, uploader=uploader,
+                                    ledger=self.warm('ledger', uploader_module.UploadLedger),
+                                    url_cache=self.warm('url_cache', uploader_module.ResolvedUrlCache),
+                                    resolve=request.get('resolve', False), stream=request.get('stream', False))
+
+def handler_for(worker: Worker, token: str):
+    class JobHandler(BaseHTTPRequestHandler):
+        """
+        POST /jobs      submit a job (Content-Type: application/json, or text/csv with a CSV to upload)
+        GET  /jobs      list all jobs
+        GET  /jobs/<id> one job, with its progress and recent log lines
+
+        Every request must carry Authorization: Bearer <token>.
+        """
+        def send_json(self, status: int, body) -> None:
+            data = json.dumps(body, indent=1).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def authorized(self) -> bool:
+            if hmac.compare_digest(self.headers.get('Authorization', '').encode('utf-8'),
+                                   f'Bearer {token}'.encode('utf-8')):
+                return True
+            self.send_json(401, {'error': 'missing or wrong token'})
+            return False
+
+        def do_GET(self) -> None:
+            if not self.authorized():
+                return
+            parts = self.path.strip('/').split('/')
+            if parts == ['jobs']:
+                self.send_json(200, [job.to_dict() for job in list(worker.jobs.values())])
+            elif len(parts) == 2 and parts[0] == 'jobs' and parts[1].isdigit() and int(parts[1]) in worker.jobs:
+                job = worker.jobs[int(parts[1])]
+                self.send_json(200, job.to_dict(job.progress()))
+            else:
+                self.send_json(404, {'error': 'not found'})
+
+        def do_POST(self) -> None:
+            if not self.authorized():
+                return
+            if self.path.strip('/') != 'jobs':
+                self.send_json(404, {'error': 'not found'})
+                return
+            content_type = self.headers.get('Content-Type', '').split(';')[0].strip().lower()
+            if content_type not in ('application/json', 'text/csv'):
+                self.send_json(415, {'error': 'Content-Type must be application/json or text/csv'})
+                return
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            if content_type == 'text/csv':
+                csv_file = os.path.join(worker.jobs_dir, f'upload-{time.time_ns()}.csv')
+                with open(csv_file, 'wb') as f:
+                    f.write(body)
+                request = {'type': 'upload', 'csv': csv_file}
+            else:
+                try:
+                    request = json.loads(body)
+                except ValueError:
+                    self.send_json(400, {'error': 'body is not JSON'})
+                    return
+                if not isinstance(request, dict) or request.get('type') not in ('search', 'identifiers', 'upload'):
+                    self.send_json(400, {'error': 'type must be search, identifiers or upload'})
+                    return
+                try:
+                    request = worker.check(request)
+                except ValueError as e:
+                    self.send_json(400, {'error': str(e)})
+                    return
+            job = worker.submit(request)
+            self.send_json(202, job.to_dict())
+
+        def log_message(self, format: str, *args) -> None:
+            logging.debug(format % args)
+
+    return JobHandler
+
+def main():
+    parser = argparse.ArgumentParser(description="Keep the Wiki API Connector tools warm and run jobs from a local HTTP API")
+    parser.add_argument("-c", "--config", dest="config_file", default='config.yml',
+                        help="Default configuration file for jobs (default: config.yml)")
+    parser.add_argument("--host", default=DEFAULT_HOST, help=f"Address to listen on (default: {DEFAULT_HOST})")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help=f"Port to listen on (default: {DEFAULT_PORT})")
+    parser.add_argument("--jobs-dir", dest="jobs_dir", default=DEFAULT_JOBS_DIR,
+                        help=f"Directory for job outputs and uploaded CSVs (default: {DEFAULT_JOBS_DIR})")
+    parser.add_argument("-w", "--workers", dest="workers", type=int, help="Uploads kept in flight per upload job")
+    parser.add_argument("--token", default=os.environ.get('WAC_WORKER_TOKEN'),
+                        help="Token clients must send as 'Authorization: Bearer TOKEN' (default: $WAC_WORKER_TOKEN, "
+                             "or a random one, logged at startup)")
+    args = parser.parse_args()
+
+    token = args.token or secrets.token_urlsafe(24)
+    worker = Worker(args.config_file, args.jobs_dir, args.workers)
+    worker.thread.start()
+    server = ThreadingHTTPServer((args.host, args.port), handler_for(worker, token))
+    logging.info(f"Worker listening on http://{args.host}:{args.port}/jobs")
+    if not args.token:
+        logging.info(f"Send 'Authorization: Bearer {token}' with every request")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logging.info('Worker stopped')
+
+if __name__ == "__main__":
+    main()
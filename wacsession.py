@@ -0,0 +1,456 @@
+# Shared HTTP transport for the Wiki API Connector tools
+#
+# Every tool (search dumper, generator, uploader) gets its sessions from here instead of calling
+# module-level requests.get, so TCP/TLS connections to api.si.edu, collections.si.edu and ids.si.edu
+# are kept alive and reused. Each named session has per-host connection pools and a default timeout.
+# RequestPolicy adds retries with jittered backoff, hedged requests and per-host circuit breakers on top.
+
+import logging
+import os
+import random
+import re
+import threading
+import time
+import concurrent.futures
+from contextlib import contextmanager, nullcontext
+
+import requests
+import requests_cache
+import tqdm
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlparse
+
+from typing import Dict, List, Optional, Tuple
+
+DEFAULT_POOL_CONNECTIONS = 10   # Number of per-host pools kept per session
+DEFAULT_POOL_MAXSIZE = 16       # Keep-alive connections kept per host
+DEFAULT_TIMEOUT = (5, 30)       # (connect, read) seconds
+
+# Wikimedia asks API and SPARQL clients to identify themselves with a tool name, version and contact
+# (https://meta.wikimedia.org/wiki/User-Agent_policy); WAC_CONTACT (an email or user page) overrides the contact
+TOOL_VERSION = '1.0'
+USER_AGENT = 'WikiAPIConnector/%s (%s) python-requests/%s' % (
+    TOOL_VERSION, os.environ.get('WAC_CONTACT', 'https://commons.wikimedia.org/wiki/Category:Wiki_API_Connector_Upload'),
+    requests.__version__)
+SESSION_HEADERS = {'wikidata': {'User-Agent': USER_AGENT}}  # Extra headers of named sessions
+
+_settings = {
+    'pool_connections': DEFAULT_POOL_CONNECTIONS,
+    'pool_maxsize': DEFAULT_POOL_MAXSIZE,
+    'timeout': DEFAULT_TIMEOUT,
+}
+_sessions = {}
+_lock = threading.Lock()
+
+class RequestBudget:
+    """
+    Counts network requests per endpoint (host) per record, and flags records that exceed a budget,
+    e.g. {'api.si.edu': 1, 'commons.wikimedia.org': 2}.
+
+    Work for a record is wrapped in budget.record(record_id) (per thread). Cache hits are free and are not
+    counted, but conditional revalidations are.
+    """
+    def __init__(self, limits: Dict[str, int]):
+        self.limits = dict(limits)
+        self.counts = {}            # record_id -> {host: requests}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def record(self, record_id: str):
+        previous = getattr(self._local, 'record_id', None)
+        self._local.record_id = record_id
+        try:
+            yield
+        finally:
+            self._local.record_id = previous
+
+    def current(self) -> Optional[str]:
+        """The record this thread's requests are charged to, if any."""
+        return getattr(self._local, 'record_id', None)
+
+    def count(self, url: str) -> None:
+        record_id = self.current()
+        if record_id is None:
+            return  # Run-level requests (logins, searches) are not charged to a record
+        host = urlparse(url).hostname
+        with self._lock:
+            per_record = self.counts.setdefault(record_id, {})
+            per_record[host] = per_record.get(host, 0) + 1
+
+    def violations(self) -> List[Tuple[str, str, int, int]]:
+        """(record_id, host, requests, limit) for every record over its budget."""
+        return [(record_id, host, n, self.limits[host])
+                for record_id, per_record in self.counts.items()
+                for host, n in per_record.items()
+                if host in self.limits and n > self.limits[host]]
+
+    def check(self) -> bool:
+        """Log a per-endpoint summary and any violations. Returns True if every record stayed in budget."""
+        hosts = sorted({host for per_record in self.counts.values() for host in per_record})
+        for host in hosts:
+            values = [per_record.get(host, 0) for per_record in self.counts.values()]
+            logging.info(f"Budget {host}: {sum(values)} requests over {len(values)} records, "
+                         f"max {max(values)} per record (limit {self.limits.get(host, 'none')})")
+        violations = self.violations()
+        for record_id, host, n, limit in violations:
+            logging.error(f"Request budget exceeded for {record_id}: {n} requests to {host}, limit {limit}")
+        return not violations
+
+    @staticmethod
+    def parse(specs: List[str]) -> Dict[str, int]:
+        """Parse command line budgets of the form HOST=N."""
+        limits = {}
+        for spec in specs or []:
+            host, _, n = spec.partition('=')
+            limits[host.strip()] = int(n)
+        return limits
+
+_budget = None
+
+def set_budget(budget: Optional[RequestBudget]) -> None:
+    """Install a request budget that every shared session charges its network requests to."""
+    global _budget
+    _budget = budget
+
+def budget_scope(record_id: str):
+    """Charge requests made in this block to record_id, if a budget is installed."""
+    return _budget.record(record_id) if _budget is not None else nullcontext()
+
+def in_current_scope(fn):
+    """
+    Wrap fn to charge its requests to this thread's current record, for running it on another thread
+    (budget scopes are per thread, so pool threads would otherwise charge nobody).
+    """
+    record_id = _budget.current() if _budget is not None else None
+
+    def run(*args, **kwargs):
+        with budget_scope(record_id):
+            return fn(*args, **kwargs)
+    return run
+
+_progress_listener = None
+
+def set_progress_listener(listener) -> None:
+    """Call listener(bar) with every ProgressBar the tools create (the worker uses this to report job progress)."""
+    global _progress_listener
+    _progress_listener = listener
+
+class ProgressBar(tqdm.tqdm):
+    """The tools' progress bars: a tqdm bar that is announced to the progress listener, if one is set."""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if _progress_listener is not None:
+            _progress_listener(self)
+
+def charge(url: str) -> None:
+    """Charge a request made outside the shared sessions (e.g. pywikibot's) to the current record."""
+    if _budget is not None:
+        _budget.count(url)
+
+class _DefaultTimeoutMixin:
+    """Apply the configured timeout to every request that does not set its own, and charge it to the budget."""
+    default_timeout = DEFAULT_TIMEOUT
+
+    def request(self, method, url, *args, **kwargs):
+        kwargs.setdefault('timeout', self.default_timeout)
+        response = super().request(method, url, *args, **kwargs)
+        if not getattr(response, 'from_cache', False) or getattr(response, 'revalidated', False):
+            charge(url)
+        return response
+
+class PooledSession(_DefaultTimeoutMixin, requests.Session):
+    pass
+
+class CachedPooledSession(_DefaultTimeoutMixin, requests_cache.CachedSession):
+    """
+    Cached session that counts how each response was served.
+
+    Expired entries are kept rather than discarded. When they carry ETag or Last-Modified validators,
+    requests_cache revalidates them with a conditional request, and a 304 Not Modified refreshes the entry
+    without downloading the body. Those count as cheap 'revalidated' hits rather than misses.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cache_stats = {'hits': 0, 'revalidated': 0, 'misses': 0}
+        self._stats_lock = threading.Lock()
+
+    def request(self, method, url, *args, **kwargs):
+        response = super().request(method, url, *args, **kwargs)
+        if getattr(response, 'revalidated', False):
+            outcome = 'revalidated'
+        elif getattr(response, 'from_cache', False):
+            outcome = 'hits'
+        else:
+            outcome = 'misses'
+        with self._stats_lock:
+            self.cache_stats[outcome] += 1
+        return response
+
+def configure(pool_connections: Optional[int] = None,
+              pool_maxsize: Optional[int] = None,
+              timeout=None) -> None:
+    """
+    Set pool sizes and the default timeout for sessions created after this call.
+    timeout may be a number or a (connect, read) tuple.
+    """
+    if pool_connections:
+        _settings['pool_connections'] = pool_connections
+    if pool_maxsize:
+        _settings['pool_maxsize'] = pool_maxsize
+    if timeout:
+        _settings['timeout'] = timeout
+
+def get_session(name: str = 'default',
+                cache_name: Optional[str] = None,
+                expire_after: Optional[int] = None,
+                **cache_options) -> requests.Session:
+    """
+    Return the shared session called name, creating it on first use.
+
+    With cache_name, the session is a requests_cache sqlite cache of that name, expiring after expire_after
+    seconds; cache hits never touch the connection pools. cache_options (e.g. ignored_parameters)
+    are passed on to requests_cache.
+    """
+    with _lock:
+        if name not in _sessions:
+            if cache_name:
+                session = CachedPooledSession(cache_name, backend='sqlite', expire_after=expire_after, **cache_options)
+            else:
+                session = PooledSession()
+            session.default_timeout = _settings['timeout']
+            session.headers.update(SESSION_HEADERS.get(name, {}))
+            adapter = HTTPAdapter(pool_connections=_settings['pool_connections'],
+                                  pool_maxsize=_settings['pool_maxsize'])
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _sessions[name] = session
+        return _sessions[name]
+
+def cache_key(session: requests_cache.CachedSession, url: str) -> str:
+    """
+    The key a cached session stores a GET of url under. requests_cache puts the effective TLS verify setting
+    in its keys, and that comes from REQUESTS_CA_BUNDLE when it is set, so a key built from the bare request
+    (as cache.contains(url=...) does) would miss.
+    """
+    request = session.prepare_request(requests.Request('GET', url))
+    verify = session.merge_environment_settings(request.url, {}, None, None, None)['verify']
+    return session.cache.create_key(request, verify=verify)
+
+def cached_response(session: requests_cache.CachedSession, url: str):
+    """The cached response for a GET of url, expired or not, or None."""
+    return session.cache.get_response(cache_key(session, url))
+
+def stats() -> Dict[str, Dict[str, float]]:
+    """
+    Connection reuse per host across all shared sessions:
+    {'api.si.edu': {'requests': 120, 'connections': 2, 'reuse': 0.98}, ...}
+    """
+    hosts = {}
+    for session in list(_sessions.values()):
+        adapter = session.get_adapter('https://')
+        pools = adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            entry = hosts.setdefault(pool.host, {'requests': 0, 'connections': 0})
+            entry['requests'] += pool.num_requests
+            entry['connections'] += pool.num_connections
+    for entry in hosts.values():
+        entry['reuse'] = 1 - entry['connections'] / entry['requests'] if entry['requests'] else 0.0
+    return hosts
+
+def cache_stats() -> Dict[str, Dict[str, int]]:
+    """
+    Cache outcomes per cached session: {'siapi': {'hits': 90, 'revalidated': 8, 'misses': 2}, ...}
+    """
+    return {name: dict(session.cache_stats) for name, session in list(_sessions.items())
+            if isinstance(session, CachedPooledSession)}
+
+def log_stats() -> None:
+    """Log the connection reuse and cache stats at INFO level."""
+    for host, entry in sorted(stats().items()):
+        logging.info(f"{host}: {entry['requests']} requests over {entry['connections']} connections "
+                     f"({entry['reuse']:.0%} reused)")
+    for name, entry in sorted(cache_stats().items()):
+        logging.info(f"{name} cache: {entry['hits']} hits, {entry['revalidated']} revalidated (304), "
+                     f"{entry['misses']} misses")
+
+_SECRET_PARAMS = re.compile(r'((?:api_key|apikey|key|token)=)[^&\s\'"]+', re.IGNORECASE)
+
+def redact(text: str) -> str:
+    """Mask API keys and tokens in URLs or error messages before they are logged."""
+    return _SECRET_PARAMS.sub(r'\1REDACTED', text)
+
+class CircuitOpenError(requests.RequestException):
+    """Raised when a host's circuit breaker is open and the caller asked not to wait."""
+
+class CircuitBreaker:
+    """
+    Per-host circuit breaker.
+
+    After `threshold` consecutive failures the circuit opens for `cooldown` seconds, and callers pause
+    instead of sending more doomed requests. Once the cooldown passes, requests flow again; another
+    failure straight away re-opens it with a doubled cooldown (up to max_cooldown).
+    """
+    def __init__(self, threshold: int = 5, cooldown: float = 30.0, max_cooldown: float = 600.0):
+        self.threshold = threshold
+        self.base_cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self._failures = {}     # host -> consecutive failures
+        self._open_until = {}   # host -> monotonic time
+        self._cooldown = {}     # host -> current cooldown
+        self._lock = threading.Lock()
+
+    def wait(self, host: str, block: bool = True) -> None:
+        """Pause until the circuit for host is closed (or raise CircuitOpenError if not block)."""
+        with self._lock:
+            remaining = self._open_until.get(host, 0) - time.monotonic()
+        if remaining > 0:
+            if not block:
+                raise CircuitOpenError(f"Circuit open for {host}, {remaining:.0f}s remaining")
+            logging.warning(f"{host} is failing, pausing {remaining:.0f}s before retrying")
+            time.sleep(remaining)
+
+    def success(self, host: str) -> None:
+        with self._lock:
+            self._failures[host] = 0
+            self._cooldown.pop(host, None)
+
+    def failure(self, host: str) -> None:
+        with self._lock:
+            self._failures[host] = self._failures.get(host, 0) + 1
+            if self._failures[host] >= self.threshold:
+                reopening = host in self._cooldown
+                cooldown = min(self.max_cooldown, self._cooldown[host] * 2) if reopening else self.base_cooldown
+                self._cooldown[host] = cooldown
+                self._open_until[host] = time.monotonic() + cooldown
+                self._failures[host] = self.threshold - 1  # One more failure after the pause re-opens it
+                logging.warning(f"Circuit breaker opened for {host} for {cooldown:.0f}s")
+
+class RequestPolicy:
+    """
+    Unified request policy: per-host circuit breaker, retries with jittered exponential backoff on
+    connection errors, timeouts and 5xx responses, and optional hedged duplicate requests.
+
+    Other responses (including 4xx such as 404 and 429) are returned to the caller as-is. Timeouts come
+    from the session's (connect, read) default unless passed explicitly.
+    """
+    RETRY_STATUS = {500, 502, 503, 504}
+
+    def __init__(self,
+                 max_attempts: int = 4,
+                 backoff_base: float = 1.0,
+                 backoff_cap: float = 60.0,
+                 hedge_after: Optional[float] = None,
+                 breaker: Optional[CircuitBreaker] = None):
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.hedge_after = hedge_after
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+        self._hedge_pool = None
+        self._hedge_lock = threading.Lock()
+
+    def backoff(self, attempt: int) -> float:
+        """Full-jitter exponential backoff delay for the given (1-based) attempt."""
+        return random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** (attempt - 1)))
+
+    def request(self, session: requests.Session, method: str, url: str,
+                hedge: bool = False, **kwargs) -> requests.Response:
+        """
+        Send a request under this policy. With hedge (and hedge_after set), a duplicate request is sent if the
+        first has not answered within hedge_after seconds, and whichever answers first wins.
+        Raises the last exception if every attempt failed at the transport level.
+        """
+        host = urlparse(url).hostname
+        last_error = None
+        for attempt in range(1, self.max_attempts + 1):
+            self.breaker.wait(host)
+            response = None
+            try:
+                if hedge and self.hedge_after:
+                    response = self._hedged(session, method, url, **kwargs)
+                else:
+                    response = session.request(method, url, **kwargs)
+            except requests.RequestException as e:
+                last_error = e
+                logging.debug(f"{method} {redact(url)} failed (attempt {attempt}): {redact(str(e))}")
+            else:
+                if response.status_code not in self.RETRY_STATUS:
+                    self.breaker.success(host)
+                    return response
+                logging.debug(f"{method} {redact(url)} returned {response.status_code} (attempt {attempt})")
+            self.breaker.failure(host)
+            if attempt < self.max_attempts:
+                if response is not None:
+                    response.close()
+                time.sleep(self.backoff(attempt))
+
+        if response is not None:
+            return response
+        raise last_error
+
+    def hedge_pool(self) -> concurrent.futures.ThreadPoolExecutor:
+        """
+        Threads for hedged requests, created on first use so configure() has been called by then. A hedged
+        request takes up to two threads, so there are two per keep-alive connection (pool_maxsize), which is
+        also how many requests the tools keep in flight.
+        """
+        with self._hedge_lock:
+            if self._hedge_pool is None:
+                self._hedge_pool = concurrent.futures.ThreadPoolExecutor(max_workers=2 * _settings['pool_maxsize'],
+                                                                         thread_name_prefix='hedge')
+            return self._hedge_pool
+
+    def _hedged(self, session: requests.Session, method: str, url: str, **kwargs) -> requests.Response:
+        """
+        Race the request against a duplicate started hedge_after seconds after the first one began; close the
+        loser. Time the first request spends queued for a thread does not count, so a busy pool does not
+        turn every request into two.
+        """
+        pool = self.hedge_pool()
+        started = threading.Event()
+
+        @in_current_scope
+        def send():
+            started.set()
+            return session.request(method, url, **kwargs)
+
+        first = pool.submit(send)
+        started.wait()
+        done, _ = concurrent.futures.wait([first], timeout=self.hedge_after)
+        if done:
+            return first.result()
+        logging.debug(f"Hedging slow request to {redact(url)}")
+        second = pool.submit(send)
+        pending = {first, second}
+        error = None
+        while pending:
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                try:
+                    winner = future.result()
+                except requests.RequestException as e:
+                    error = e
+                    continue
+                for loser in pending:
+                    loser.add_done_callback(lambda f: f.exception() is None and f.result().close())
+                return winner
+        raise error
+
+_policy = None
+
+def get_policy() -> RequestPolicy:
+    """The process-wide request policy, shared so all callers see the same circuit breakers."""
+    global _policy
+    with _lock:
+        if _policy is None:
+            _policy = RequestPolicy()
+        return _policy
+
+def set_policy(policy: RequestPolicy) -> None:
+    global _policy
+    with _lock:
+        _policy = policy
@@ -15,14 +15,23 @@
 from dataclasses import dataclass, field, asdict
 import yaml
 import requests
-import requests_cache
+import wacsession
+from wacsession import ProgressBar as tqdm  # tqdm, reported to the worker when run as a job
+import sisearch
 import json
 import re
 import os
 import sys
 import time
+import random
+import hashlib
+import sqlite3
+import threading
+import copy
+import functools
+import unicodedata
 from datetime import datetime, timedelta
-from urllib.parse import urlparse, parse_qs
+from urllib.parse import urlparse, parse_qs, quote
 from io import StringIO
 import csv
 import pprint as pp
@@ -34,13 +43,12 @@ from pywikibot.specialbots import UploadRobot
 from jsonpath_ng import jsonpath
 from jsonpath_ng.ext import parse
 
-from typing import List, Dict
+from typing import List, Dict, Optional, Tuple
 import logging
 
 import argparse
 import concurrent.futures
 
-from tqdm import tqdm
 
 commons_templates = {}
 
@@ -117,6 +125,252 @@ def extract_filename_without_extension(url: str) -> str:
 
     return fragment
 
+class RateLimiter:
+    """
+    Spaces out API requests so a shared key stays under its hourly quota.
+    One instance is shared by every unit that talks to the same API; requests_per_hour of None means no limit.
+    """
+    def __init__(self, requests_per_hour: int = None):
+        self.interval = 3600.0 / requests_per_hour if requests_per_hour else 0.0
+        self._next_slot = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self) -> None:
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+class ApiKeyPool:
+    """
+    Spreads API requests over several keys (e.g. api.data.gov keys), tracking each key's remaining quota
+    from the X-RateLimit-* response headers. A key that is exhausted or gets a 429 is taken out of rotation
+    until its reset time. Keys are referred to by position only, so they never end up in logs.
+    """
+    DEFAULT_RESET = 3600  # api.data.gov uses a rolling hour and does not always send X-RateLimit-Reset
+
+    def __init__(self, keys: List[str]):
+        self.keys = list(keys)
+        self._remaining = [None] * len(self.keys)     # None until the API tells us
+        self._counted_until = [0.0] * len(self.keys)  # time.time() when the quota resets, making the count stale
+        self._resting_until = [0.0] * len(self.keys)  # time.time() when the key is usable again
+        self._turn = 0
+        self._lock = threading.Lock()
+
+    def available(self) -> bool:
+        now = time.time()
+        return any(until <= now for until in self._resting_until)
+
+    def acquire(self) -> str:
+        '''
+        Return the usable key with the most quota left, waiting for a reset if every key is exhausted
+        '''
+        while True:
+            with self._lock:
+                now = time.time()
+                usable = [n for n in range(len(self.keys)) if self._resting_until[n] <= now]
+                if usable:
+                    # Highest known remaining quota wins; unknown counts as plenty. Ties go round-robin.
+                    self._turn += 1
+                    best = max(usable, key=lambda n: (float('inf') if self._remaining[n] is None else self._remaining[n],
+                                                      -((n - self._turn) % len(self.keys))))
+                    return self.keys[best]
+                wake = min(self._resting_until)
+            logging.info(f"All {len(self.keys)} API keys exhausted, waiting until {datetime.fromtimestamp(wake):%H:%M:%S}")
+            time.sleep(max(0.0, wake - time.time()))
+
+    def remaining(self) -> int:
+        '''
+        Quota left over all keys as last reported by the API, or None if no key has reported since its quota
+        last reset
+        '''
+        now = time.time()
+        known = [r for r, until in zip(self._remaining, self._counted_until) if r is not None and until > now]
+        return sum(known) if known else None
+
+    def reset_time(self, reset: str = None) -> float:
+        '''
+        time.time() at which a quota reset header says the quota refills, DEFAULT_RESET from now if there is none
+        '''
+        try:
+            reset = float(reset)
+            # X-RateLimit-Reset may be an epoch time rather than a number of seconds
+            return reset if reset > 1e9 else time.time() + reset
+        except (TypeError, ValueError):
+            return time.time() + self.DEFAULT_RESET
+
+    def update(self, key: str, response: requests.Response) -> None:
+        '''
+        Record quota information from a response made with key. Revalidated cache entries count: the
+        conditional request used quota, and its 304 headers are merged into the cached response.
+        '''
+        if getattr(response, 'from_cache', False) and not getattr(response, 'revalidated', False):
+            return
+        n = self.keys.index(key)
+        headers = response.headers
+        with self._lock:
+            if 'X-RateLimit-Remaining' in headers:
+                try:
+                    self._remaining[n] = int(headers['X-RateLimit-Remaining'])
+                    self._counted_until[n] = self.reset_time(headers.get('X-RateLimit-Reset'))
+                except ValueError:
+                    pass
+            if response.status_code == 429 or self._remaining[n] == 0:
+                self._resting_until[n] = self.reset_time(headers.get('Retry-After') or headers.get('X-RateLimit-Reset'))
+                self._remaining[n] = None
+                logging.info(f"API key #{n + 1} of {len(self.keys)} out of quota, resting it until "
+                             f"{datetime.fromtimestamp(self._resting_until[n]):%H:%M:%S}")
+
+_key_pools = {}
+
+def key_pool_for(keys) -> ApiKeyPool:
+    """
+    Shared ApiKeyPool for a set of keys, so units configured with the same keys track one quota
+    """
+    keys = tuple([keys] if isinstance(keys, str) else keys)
+    if keys not in _key_pools:
+        _key_pools[keys] = ApiKeyPool(keys)
+    return _key_pools[keys]
+
+_limiters = {}
+
+def limiter_for(scope: tuple, requests_per_hour: int = None) -> RateLimiter:
+    """
+    Shared RateLimiter for a quota (scope, e.g. a tuple of API keys) at a rate, so units created at different
+    times in one process (e.g. by successive jobs in wac-worker.py) keep pacing against the same quota
+    """
+    if (scope, requests_per_hour) not in _limiters:
+        _limiters[(scope, requests_per_hour)] = RateLimiter(requests_per_hour)
+    return _limiters[(scope, requests_per_hour)]
+
+def unit_requests_per_hour(spec: dict) -> int:
+    """
+    Sustained request rate for a unit: its per-key quota times the number of keys in its pool
+    """
+    api = spec.get('api', {})
+    if not api.get('requests_per_hour'):
+        return None
+    keys = api.get('api_key_string', [])
+    return api['requests_per_hour'] * (len(keys) if isinstance(keys, list) and keys else 1)
+
+def shared_api_session() -> requests.Session:
+    """
+    Cached HTTP session shared by all SIunits, so units reuse one connection pool and one cache
+    """
+    # The API key is left out of cache keys and stored URLs, so keys never reach the cache file
+    return wacsession.get_session('siapi', cache_name='siapi_cache', expire_after=86400,
+                                  ignored_parameters=['api_key'])
+
+_unit_specs = {}  # filename -> (mtime, size, specs)
+
+def load_unit_specs(filename: str) -> list:
+    """
+    Read a YAML config file and return the list of unit specification dicts in it
+
+    The parsed file is kept until it changes on disk, so a long-running process (wac-worker.py) only
+    parses it again after an edit. Callers get their own copy of the specs.
+    """
+    stat = os.stat(filename)
+    cached = _unit_specs.get(filename)
+    if cached is None or cached[:2] != (stat.st_mtime_ns, stat.st_size):
+        _incoming_dict = {}
+        with open(filename, "r") as stream:
+            try:
+                _incoming_dict = dict(yaml.safe_load(stream))
+            except yaml.YAMLError as exc:
+                logging.error(exc) # TODO: raise properly
+        if cached is not None:
+            logging.info(f"{filename} changed, reloaded its units")
+        cached = (stat.st_mtime_ns, stat.st_size, [o['unit'] for o in _incoming_dict.get('units', [])])
+        _unit_specs[filename] = cached
+    return copy.deepcopy(cached[2])
+
+# Column extraction for the batch transform
+#   Plain paths of the form $.a.b[*].c[?(@.label == 'X')].d, which covers nearly every field in our configs,
+#   are compiled into steps applied to a flat list of (row, value) nodes for a whole batch of records at once,
+#   with the same results jsonpath_ng would give. Anything else (arithmetic, `split`) falls back to jsonpath_ng.
+
+_PATH_STEP = re.compile(r"\.([A-Za-z_][\w-]*)|\[\*\]|\[\?\(@\.([A-Za-z_][\w-]*)\s*==\s*'([^']*)'\)\]")
+
+def _field_step(nodes, name):
+    return [(row, value[name]) for row, value in nodes if isinstance(value, dict) and name in value]
+
+def _wildcard_step(nodes):
+    # Same coercion as jsonpath_ng's Slice: falsy values match nothing, dicts and scalars match themselves
+    out = []
+    for row, value in nodes:
+        if not value:
+            continue
+        if isinstance(value, (dict, int, str)):
+            out.append((row, value))
+        else:
+            out.extend((row, value[i]) for i in range(len(value)))
+    return out
+
+def _filter_step(nodes, key, match):
+    out = []
+    for row, value in nodes:
+        candidates = value.values() if isinstance(value, dict) else value if isinstance(value, list) else ()
+        out.extend((row, v) for v in candidates if isinstance(v, dict) and key in v and v[key] == match)
+    return out
+
+@functools.lru_cache(maxsize=None)
+def compile_column(expression: str):
+    """
+    Compile a field's JSONPath once into a function mapping a list of N records to N lists of matched values
+    """
+    steps = []
+    pos = 1 if expression.startswith('$') else len(expression) + 1
+    while pos < len(expression):
+        m = _PATH_STEP.match(expression, pos)
+        if not m:
+            break
+        if m.group(1):
+            steps.append(functools.partial(_field_step, name=m.group(1)))
+        elif m.group(2):
+            steps.append(functools.partial(_filter_step, key=m.group(2), match=m.group(3)))
+        else:
+            steps.append(_wildcard_step)
+        pos = m.end()
+
+    if pos != len(expression):
+        jsonpath_expr = parse(expression)
+        return lambda records: [[match.value for match in jsonpath_expr.find(r)] for r in records]
+
+    def extract(records):
+        nodes = list(enumerate(records))
+        for step in steps:
+            nodes = step(nodes)
+        column = [[] for _ in records]
+        for row, value in nodes:
+            column[row].append(value)
+        return column
+    return extract
+
+# What a malformed record (or a field definition that does not fit it) raises while its fields are filled
+_FIELD_ERRORS = (KeyError, IndexError, TypeError, ValueError)
+
+def extract_column(expression: str, records: List[dict]) -> list:
+    '''
+    compile_column(expression)(records), except that a record the path cannot be evaluated on gets the
+    exception in its place instead of failing the whole batch
+    '''
+    extract = compile_column(expression)
+    try:
+        return extract(records)
+    except _FIELD_ERRORS:
+        column = []
+        for record in records:
+            try:
+                column.extend(extract([record]))
+            except _FIELD_ERRORS as e:
+                column.append(e)
+        return column
+
 # SIunit class/dataclass (requires Python 3.7+)
 #   Encapsulates all the info about a GLAM entity with a functioning API
 #   The configuration should be read in from a YAML file, using the class method .from_yaml(file)
@@ -124,13 +378,33 @@ def extract_filename_without_extension(url: str) -> str:
 @dataclass
 class SIunit:
     spec: dict = None  # Specification dictionary, as brought in by a YAML file or the like
+    session: requests.Session = field(default=None, repr=False)  # Shared with other units unless given
+    limiter: RateLimiter = field(default=None, repr=False)       # API quota pacing, may be shared by a router
+    policy: wacsession.RequestPolicy = field(default=None, repr=False)  # Retries, timeouts, circuit breaker
+    key_pool: ApiKeyPool = field(default=None, repr=False)       # api_key_string may be one key or a list
+    transform_cache: 'TransformCache' = field(default=None, repr=False)  # Optional, reuses rows for unchanged records
+    reconciler: 'Reconciler' = field(default=None, repr=False)  # Optional, for fields with action: reconcile
 
     def __post_init__(self):
-        requests_cache.install_cache('siapi_cache', backend='sqlite', expire_after=86400)
+        if self.session is None:
+            self.session = shared_api_session()
+        if self.key_pool is None:
+            self.key_pool = key_pool_for(self.spec['api']['api_key_string'])
+        if self.limiter is None:
+            self.limiter = limiter_for(tuple(self.key_pool.keys), unit_requests_per_hour(self.spec))
+        if self.policy is None:
+            self.policy = wacsession.get_policy()
 
     def to_dict(self):
         return dict(self.spec)
 
+    def spec_hash(self) -> str:
+        '''
+        Hash of everything in this unit that shapes the generated output: its spec and its template skeleton
+        '''
+        skeleton = commons_templates.get(self.spec.get('commons_template', {}).get('type'), '')
+        return hashlib.sha1((json.dumps(self.spec, sort_keys=True, default=str) + skeleton).encode('utf-8')).hexdigest()
+
     def to_string(self):
         return json.dumps(self.spec)
 
@@ -143,22 +417,16 @@ class SIunit:
         filename: valid YAML file 
         organization_name: full string of "name" field in YAML file
         '''
-        _incoming_dict = {}
-        with open(filename, "r") as stream:
-            try:
-                _incoming_dict = dict(yaml.safe_load(stream))
-            except yaml.YAMLError as exc:
-                logging.error(exc) # TODO: raise properly
         try:
-            for o in _incoming_dict['units']:
-                if o['unit']['name'] == organization_name:
-                    return cls(o['unit'])
-        except IndexError as exc:
+            for o in load_unit_specs(filename):
+                if o['name'] == organization_name:
+                    return cls(o)
+        except (IndexError, KeyError) as exc:
             logging.error(exc)  # TODO: raise proper error
 
         # TODO: should raise a not found exception
         return None
-        
+
     @staticmethod
     def extract_template_field(wiki_template: str, field: str) -> str:
         '''
@@ -296,40 +564,104 @@ class SIunit:
     
         return sanitized_filename
 
-    def api_template(self) -> str:
+    def api_template(self, api_key: str = None) -> str:
         '''
-        Return template for API call
+        Return template for API call, using api_key or else the next key from the unit's key pool
         '''
         # TODO: check for existence
         _url = self.spec['api']['api_url']
-        # TODO: check for existence
-        _apikey = self.spec['api']['api_key_string']
+        _apikey = api_key if api_key is not None else self.key_pool.acquire()
 
         return _url.format('{}', _apikey)
 
+    def is_cached(self, incoming_id: str, fresh: bool = False) -> bool:
+        '''
+        True if the API response for incoming_id is already in the cache (API keys are not part of the cache key).
+        With fresh, it must also not have expired, i.e. using it will not even need a revalidation request.
+        '''
+        url = self.api_template(self.key_pool.keys[0]).format(incoming_id)
+        if not fresh:
+            return wacsession.cached_response(self.session, url) is not None
+        return self.is_fresh(url)
+
+    def is_fresh(self, url: str) -> bool:
+        '''
+        True if url has an unexpired cache entry, so a GET is answered from the cache without any request.
+        An expired entry is sent again (as a conditional request if it has validators) and uses quota.
+        '''
+        response = wacsession.cached_response(self.session, url)
+        return response is not None and not response.is_expired
+
     def api_lookup(self, incoming_id: str, output_type: str = 'raw') -> dict:
         '''
         Return content from API call
         '''
-        _api_url = self.api_template().format(incoming_id)
-        
+        return self.api_request(incoming_id, lambda key: self.api_template(key).format(incoming_id))
+
+    def api_search(self, query: str, rows: int = 1000):
+        '''
+        Page through the API's search endpoint, yielding (identifier, record) pairs
+
+        Each record is wrapped like a content lookup ({'response': row}), so it can be handed straight to
+        id_to_commonsdict and friends without another API call. Needs api: search_url in the unit config,
+        with placeholders for query, start, rows and API key.
+        '''
+        _template = self.spec['api']['search_url']
+        start = 0
+        while True:
+            _page = self.api_request(f'search {query!r} at {start}',
+                                     lambda key: _template.format(quote(query), start, rows, key))
+            _rows = (_page or {}).get('response', {}).get('rows', [])
+            for row in _rows:
+                # Search rows carry e.g. url: "edanmdm:saam_1916.8.1", the same id api_lookup takes
+                identifier = row.get('url', '').split(':', 1)[-1] or row.get('id')
+                yield identifier, {'response': row}
+            start += len(_rows)
+            if not _rows or start >= _page['response'].get('rowCount', 0):
+                break
+
+    def api_request(self, label: str, build_url) -> dict:
+        '''
+        GET a JSON document from the unit's API with key rotation, quota pacing and 429 handling
+
+        Parameters
+        ----------
+        label: what is being fetched, for log messages (e.g. the identifier)
+        build_url: function taking an API key and returning the full request URL
+        '''
+        _cache_url = build_url(self.key_pool.keys[0])  # API keys are not part of the cache key
         retries = 4  # Number of retries allowed
         retry_delay = 5  # Initial retry delay in seconds
     
         while retries > 0:
             try:
-                _result = requests.get(_api_url)
+                # Only real API hits count against the quota, fresh cached lookups go straight through.
+                # Expired entries are re-sent (or revalidated), so they are paced and get a key like a miss.
+                if self.is_fresh(_cache_url):
+                    _api_key = self.key_pool.keys[0]
+                else:
+                    self.limiter.wait()
+                    _api_key = self.key_pool.acquire()
+                _api_url = build_url(_api_key)
+
+                # Timeouts, retries with backoff on errors/5xx and the per-host circuit breaker live in the policy
+                _result = self.policy.request(self.session, 'GET', _api_url)
+                self.key_pool.update(_api_key, _result)
     
                 if _result.status_code == 200:
                     _oa_dict = dict(_result.json())
                     return _oa_dict
     
                 elif _result.status_code == 404:
-                    logging.error('%s, status code %s' % (incoming_id, _result.status_code))
+                    logging.error('%s, status code %s' % (label, _result.status_code))
                     return None
     
                 elif _result.status_code == 429:
                     logging.info("HTTP 429 - Too Many Requests")
+
+                    if self.key_pool.available():
+                        # Another key still has quota, so switch to it straight away
+                        continue
     
                     # Check if the response contains rate limiting headers
                     if 'X-RateLimit-Limit' in _result.headers:
@@ -356,6 +688,9 @@ class SIunit:
     
                         # Wait for the specified Retry-After duration
                         time.sleep(retry_after)
+                    else:
+                        # No hint from the server, so back off with jitter
+                        time.sleep(retry_delay * random.uniform(0.5, 1.5))
     
                     # Decrement the number of retries and increase the retry delay (exponential backoff)
                     retries -= 1
@@ -366,10 +701,10 @@ class SIunit:
                     continue
     
                 else:
-                    raise ValueError('%s, status code %s' % (incoming_id, _result.status_code))
+                    raise ValueError('%s, status code %s' % (label, _result.status_code))
     
             except Exception as e:
-                logging.error(f'Error occurred while making API request: {e}')
+                logging.error(f'Error occurred while making API request: {wacsession.redact(str(e))}')
                 return None
             
     @staticmethod
@@ -446,7 +781,7 @@ class SIunit:
     
         return combined_string
     
-    def fill_wiki_template(self, wiki_template: str, field_dict: dict) -> str:
+    def fill_wiki_template(self, wiki_template: str, field_dict: dict, identifier: str = None) -> str:
         '''
         Fill in a Commons template using a dict with the keys matching the field names such as:
          |artist             = 
@@ -459,12 +794,22 @@ class SIunit:
         ----------
         wiki_template: text of Template in wikimarkup
         field_dict: dict of keyword/value pairs that match the parameters of the Template
+        identifier: if given and the unit has a transform cache, the filled-in template body is kept there,
+            keyed on a hash of the skeleton and field_dict, so config changes to append or categories only
+            redo the final concatenation
 
         Output
         ------
         Wiki template filled in
         '''
 
+        body_key = None
+        if identifier is not None and self.transform_cache is not None:
+            body_key = TransformCache.record_hash({'skeleton': wiki_template, 'fields': field_dict})
+            new_template = self.transform_cache.get_template(identifier, body_key)
+            if new_template is not None:
+                return self.finish_wiki_template(new_template)
+
         base_search_string = r'^\s*\|{}\s*=\s*$'
         new_template = wiki_template
 
@@ -495,7 +840,14 @@ class SIunit:
                 # print ('new string: ', new_string)
                 new_template = new_template.replace(match_string, new_string)
 
-        # Add final parts of template, categories or otherwise from config
+        if body_key is not None:
+            self.transform_cache.put_template(identifier, body_key, new_template)
+        return self.finish_wiki_template(new_template)
+
+    def finish_wiki_template(self, new_template: str) -> str:
+        '''
+        Add final parts of template, categories or otherwise from config
+        '''
         new_template += self.spec['commons_template']['append']
         new_template += '\n\n'
         new_template += self.spec['commons_template']['categories']
@@ -503,7 +855,24 @@ class SIunit:
         # print ('fill_wiki_template:', new_template)
         return new_template
     
-    def id_to_commonswblist(self, incoming_id: str, wb_template_dict: dict) -> list:
+    def reconcile_fields(self) -> dict:
+        '''
+        Return the commons_template fields that have action: reconcile, as field name -> field definition
+        '''
+        fields = self.spec.get('commons_template', {}).get('fields', {})
+        return {k: v for k, v in fields.items() if isinstance(v, dict) and v.get('action') == 'reconcile'}
+
+    def reconcile_names(self, record: dict) -> set:
+        '''
+        Return the distinct names in a record that reconcile fields would look up
+        '''
+        names = set()
+        for tvar in self.reconcile_fields().values():
+            if 'jsonpath' in tvar:
+                names.update(v for v in compile_column(tvar['jsonpath'])([record])[0] if isinstance(v, str))
+        return names
+
+    def id_to_commonswblist(self, incoming_id: str, wb_template_dict: dict, record: dict = None) -> list:
         '''
         Return a list of Wikidata statements corresponding to add them to Wikibase
         
@@ -519,11 +888,14 @@ class SIunit:
                                 {'property': 'P180', 'value': : '{"entity-type": "item", "numeric-id": "12345"}' },
                                  ...
                                 # TODO: Add a summary field perhaps?
+        'value' is JSON encoded for wbcreateclaim (see gen_wikibase_postdata); the same value is also given
+        unencoded as 'datavalue', with 'datatype' ('string' or 'wikibase-item') saying how to read it
         '''
         _return_list = []
         _outstring = ''
 
-        _oa_dict = self.api_lookup(incoming_id)  # Get JSON/dict returned from API
+        # Get JSON/dict returned from API, unless the record was already fetched (e.g. from a search page)
+        _oa_dict = record if record is not None else self.api_lookup(incoming_id)
 
         # Iterate over fields defined in YAML and look them up from JSON/dict returned from API
         # print ('wb_template_dict:', wb_template_dict)
@@ -549,6 +921,7 @@ class SIunit:
                     # TODO: handle a list of matches better
                     # TODO: handle if this is a Q number with entity-type
                     _return_item['value'] = matches
+                    _return_item['datatype'], _return_item['datavalue'] = 'string', matches
                     # next?
                 if 'static' in tvar:
                     _outstring += '  static: ' + str(tvar['static'])
@@ -559,9 +932,11 @@ class SIunit:
                         jstring = {"entity-type":"item","numeric-id": instring.replace(u'Q', u'')}
                         postvalue = json.dumps(jstring)
                         _outstring += '    item: ' + postvalue
+                        _return_item['datatype'], _return_item['datavalue'] = 'wikibase-item', jstring
                     else: # Assume it is string, TODO: check claimtype == 'string'
                         postvalue = '"'+instring+'"'
                         _outstring += '    generic/string: ' + postvalue
+                        _return_item['datatype'], _return_item['datavalue'] = 'string', instring
                     _return_item['value'] = postvalue
                     pass
 #                 if 'action' in tvar.keys():
@@ -582,7 +957,7 @@ class SIunit:
         # print (_return_dict)
         return _return_list
 
-    def id_to_commonsdict(self, incoming_id: str, commons_template_dict: dict):
+    def id_to_commonsdict(self, incoming_id: str, commons_template_dict: dict, record: dict = None):
         '''
         Return a dict of keyword/value pairs corresponding to how to fill in the template
         
@@ -591,68 +966,80 @@ class SIunit:
         incoming_id: item identifier
         commons_template_dict: definition brought in from YAML file
             At a minimum, 'url' and 'fields' should be valid keys
+        record: API response for the item if already fetched, otherwise it is looked up
         
         Output
         ------
         dict of format: {'title': ['Old Arrow Maker'], 'accession number': ['1983.95.182'], ...
         '''
-        _return_dict = {}
-        _outstring = ''
-
         try:
-            _oa_dict = self.api_lookup(incoming_id)  # Get JSON/dict returned from API
+            # Get JSON/dict returned from API
+            _oa_dict = record if record is not None else self.api_lookup(incoming_id)
         except ValueError:
             raise ValueError('id_to_commonsdict: %s' % (incoming_id,))
 
         if not _oa_dict:
             return None
 
-        # Iterate over fields defined in YAML and look them up from JSON/dict returned from API
-        for i in commons_template_dict['fields']:
-            _outstring += 'field: ' + i
-            tvar = commons_template_dict['fields'][i]  # Grab list of fields
-            if isinstance(tvar, dict):
-                # print ('  ', tvar.keys())
-                matches = []
-                if 'jsonpath' in tvar.keys():
-                    # print ("  jsonpath:", tvar['jsonpath'])
-                    # TODO - make API call with that path
-                    logging.debug ('debug: ', tvar['jsonpath'])
-                    jsonpath_expr = parse(tvar['jsonpath'])
-                    matches = [match.value for match in jsonpath_expr.find(_oa_dict)]
-                    # Use special formatting string
-                    if matches and 'formatstring' in tvar.keys():
-                        formatstring = tvar['formatstring']
-                        # TODO: check for exception if bad format string
-                        # TODO: check for just one element in matches
-                        returnstring = formatstring % matches[0]
-                    else:
-                        returnstring = matches
-                    _outstring += '  ' + str(returnstring)
-                    _return_dict[i] = returnstring
-                if 'action' in tvar.keys():
-                    # TODO: process action like reconciliation
-                    # print ("  ", tvar['action'])
-                    _outstring += '  action: ' + str(tvar['action'])
-                    # TODO: handle the actions here
-                    pass
-                if 'static' in tvar.keys():
-                    # print ("  ", tvar['static'])
-                    _outstring += '  static: ' + str(tvar['static'])
-                    _return_dict[i] = tvar['static']
-                    pass
-                if 'append' in tvar.keys():
-                    # print ("  ", tvar['static'])
-                    _outstring += '  append: ' + str(tvar['append'])
-                    # TODO: Need to handle this more elegantly in case there is a real list
-                    _return_dict[i] = _return_dict[i][0] + ' ' + tvar['append']
-                    pass
-            _outstring += '\n'
-        logging.debug (_outstring)
-        # print (_return_dict)
-        return _return_dict
+        return self.records_to_commonsdicts([_oa_dict], commons_template_dict, [incoming_id])[0]
+
+    def records_to_commonsdicts(self, records: List[dict], commons_template_dict: dict,
+                                identifiers: List[str] = None) -> List[Optional[dict]]:
+        '''
+        Batch version of id_to_commonsdict: fill the template fields for N records at once
 
-    def api_crossformat(self, incoming_id: str, crossformat: str = 'commons_template') -> list:
+        Each field's JSONPath is compiled once and evaluated as a column across the whole batch
+        (see compile_column), then the per-field options (formatstring, action, static, append) are applied
+        record by record. A record whose fields cannot be filled is logged (by its entry in identifiers, if
+        given) and gets None, without affecting the rest of the batch.
+
+        Output
+        ------
+        list of N dicts (or None), in the same order as records
+        '''
+        identifiers = identifiers if identifiers is not None else [f'record {n}' for n in range(len(records))]
+        fields = {i: tvar for i, tvar in commons_template_dict['fields'].items() if isinstance(tvar, dict)}
+        columns = {i: extract_column(tvar['jsonpath'], records) for i, tvar in fields.items() if 'jsonpath' in tvar}
+
+        _return_dicts = []
+        for row, identifier in enumerate(identifiers):
+            _return_dict = {}
+            for i, tvar in fields.items():
+                try:
+                    self.fill_field(_return_dict, i, tvar, columns[i][row] if i in columns else None)
+                except _FIELD_ERRORS as e:
+                    logging.error(f'Skipping {identifier}: field {i!r} could not be filled: {e!r}')
+                    _return_dict = None
+                    break
+            _return_dicts.append(_return_dict)
+        logging.debug(_return_dicts)
+        return _return_dicts
+
+    def fill_field(self, _return_dict: dict, i: str, tvar: dict, matches) -> None:
+        '''
+        Set field i of one record's dict from its JSONPath matches and the field's options
+        '''
+        if isinstance(matches, Exception):
+            raise matches  # The JSONPath itself failed on this record (see extract_column)
+        if 'jsonpath' in tvar.keys():
+            # Use special formatting string
+            if matches and 'formatstring' in tvar.keys():
+                # TODO: check for just one element in matches
+                _return_dict[i] = tvar['formatstring'] % matches[0]
+            else:
+                _return_dict[i] = matches
+        if 'action' in tvar.keys():
+            if tvar['action'] == 'reconcile' and self.reconciler is not None and i in _return_dict:
+                # Names were resolved up front by reconcile_stage, so this only reads the local index
+                _return_dict[i] = self.reconciler.render(_return_dict[i], tvar.get('reconcile_format'))
+            # TODO: handle other actions here
+        if 'static' in tvar.keys():
+            _return_dict[i] = tvar['static']
+        if 'append' in tvar.keys():
+            # TODO: Need to handle this more elegantly in case there is a real list
+            _return_dict[i] = _return_dict[i][0] + ' ' + tvar['append']
+
+    def api_crossformat(self, incoming_id: str, crossformat: str = 'commons_template', record: dict = None) -> list:
         '''
         Crossformat out the API content into a format as specified
         
@@ -662,6 +1049,7 @@ class SIunit:
         format: 
           commons_template is usually desired, otherwise 
           commons_wikibase is for SDC
+        record: API response for the item if already fetched, otherwise it is looked up
         
         Return
         ------
@@ -674,54 +1062,66 @@ class SIunit:
         _newspec = self.to_dict()
         # print ('api_crossformat newspec:', _newspec)
         _return_list = []
-        _return_dict = {}
         
         _outstring = incoming_id + '\n'
         if crossformat == 'commons_template':
-            _object_dict = self.id_to_commonsdict(incoming_id, _newspec['commons_template'])
+            _object_dict = self.id_to_commonsdict(incoming_id, _newspec['commons_template'], record)
 
             if not _object_dict:
                 return None
 
-            # Set the name/title part of dict
-            if 'title' in _object_dict:
-                try:
-                    _return_dict['title'] = _object_dict['title'][0]
-                except IndexError:
-                    logging.error ('IndexError:', incoming_id, 'object_dict:', _object_dict)
-                    _return_dict['title'] = None
-            else:
-                _return_dict['title'] = None
-
-            # Set the image part of dict
-            if '_image' in _object_dict and _object_dict['_image']:
-                _return_dict['url'] = _object_dict['_image'][0]
-            else:
-                logging.debug ("_object_dict['image'] is empty, skipping")
-                _return_dict['url'] = None
-    
-            # Set the Commons template filled out
-            # Grab this from config file
-            commons_template_type = self.spec['commons_template']['type']
-            # TODO: May want to download directly from Commons in the future
-            commons_template_skeleton = commons_templates[commons_template_type]
-            _filled_template = self.fill_wiki_template(commons_template_skeleton, _object_dict)
-
-            if _filled_template:
-                _return_dict['template'] = _filled_template
-            else:
-                _return_dict['template'] = None
-
             # TODO: In theory there could be a whole list of images returned for a given object
-            _return_list.append(_return_dict)
+            _return_list.append(self.commonsdict_to_item(incoming_id, _object_dict))
             
         elif crossformat == 'commons_wikibase':
             # TODO: Suspect I can re-use the id_to_commonsdict by some slight rewrite
-            _object_dict = self.id_to_commonswblist(incoming_id, _newspec['commons_wikibase'])
+            _object_dict = self.id_to_commonswblist(incoming_id, _newspec['commons_wikibase'], record)
             _return_list.append(_object_dict)
 
         return _return_list
 
+    def commonsdict_to_item(self, incoming_id: str, _object_dict: dict) -> dict:
+        '''
+        Turn the field dict of one record into a {'title', 'url', 'template'} item with the Commons template filled out
+        '''
+        _return_dict = {}
+
+        # Set the name/title part of dict
+        if 'title' in _object_dict:
+            try:
+                _return_dict['title'] = _object_dict['title'][0]
+            except IndexError:
+                logging.error(f'IndexError: {incoming_id} object_dict: {_object_dict}')
+                _return_dict['title'] = None
+        else:
+            _return_dict['title'] = None
+
+        # Set the image part of dict
+        if '_image' in _object_dict and _object_dict['_image']:
+            _return_dict['url'] = _object_dict['_image'][0]
+        else:
+            logging.debug ("_object_dict['image'] is empty, skipping")
+            _return_dict['url'] = None
+
+        # Set the Commons template filled out
+        # Grab this from config file
+        commons_template_type = self.spec['commons_template']['type']
+        # TODO: May want to download directly from Commons in the future
+        commons_template_skeleton = commons_templates[commons_template_type]
+        _filled_template = self.fill_wiki_template(commons_template_skeleton, _object_dict, incoming_id)
+
+        _return_dict['template'] = _filled_template if _filled_template else None
+        return _return_dict
+
+    def batch_crossformat(self, records: Dict[str, dict]) -> Dict[str, list]:
+        '''
+        Batch version of api_crossformat for 'commons_template': identifier -> list of items, for records already
+        fetched. Records whose fields could not be filled map to None.
+        '''
+        _object_dicts = self.records_to_commonsdicts(list(records.values()), self.spec['commons_template'], list(records))
+        return {incoming_id: [self.commonsdict_to_item(incoming_id, _object_dict)] if _object_dict is not None else None
+                for incoming_id, _object_dict in zip(records, _object_dicts)}
+
     def identifier_to_url2commons(self, identifier: str, autorun: bool = False) -> str:
         '''
         Take an identifier to the API and generate the url2commons command for it
@@ -748,7 +1148,7 @@ class SIunit:
 
         return u2c_command
 
-    def identifier_to_commons_csv_entry(self, identifier: str) -> List[Dict[str, str]]:
+    def identifier_to_commons_csv_entry(self, identifier: str, record: dict = None) -> List[Dict[str, str]]:
         '''
         Take an identifier to the API and generate a CSV entry (or entries) of the crucial fields for Commons upload
         Example:
@@ -775,16 +1175,144 @@ class SIunit:
         https://smithsonian-open-access.s3-us-west-2.amazonaws.com/media/nmaahc/NMAAHC-2018_116_8_002.jpg \
         -descfile:nmaahc-2018_116_8_002.desc
 
+        '''
+        # Each call returns a dict in a list with 'url' and 'template' ready for Commons use
+        logging.debug(f'starting: {identifier}')
+        if record is None:
+            record = self.api_lookup(identifier)
+        if record is None:
+            return []
+        return self.records_to_commons_csv_entries({identifier: record})[identifier]
+
+    def records_to_commons_csv_entries(self, records: Dict[str, dict],
+                                       executor: concurrent.futures.Executor = None) -> Dict[str, List[Dict[str, str]]]:
+        '''
+        Batch version of identifier_to_commons_csv_entry for records already fetched: identifier -> CSV rows
+
+        Rows still valid in the transform cache are reused, and the rest go through batch_crossformat together.
+        With executor (a process pool set up by transform_pool), the transform runs in the pool in chunks of
+        TRANSFORM_CHUNK_SIZE records, while the cache stays in this process: each chunk carries the stored
+        field values and template bodies of its records, and what the worker computed is stored here.
+        '''
+        results = {}
+        pending = {}
+        record_hashes = {}
+        for identifier, record in records.items():
+            # Content-hash fallback for an API without ETag/Last-Modified: if neither the record nor the
+            # config changed since last time, the rows generated then are still right
+            if self.transform_cache is not None:
+                record_hash = TransformCache.record_hash(record)
+                if self.reconciler is not None and self.reconcile_fields():
+                    # Reconciled QIDs are part of the output, so a changed index entry must invalidate the rows
+                    qids = self.reconciler.lookup_many(self.reconcile_names(record))
+                    record_hash = TransformCache.record_hash({'record': record_hash, 'qids': qids})
+                record_hashes[identifier] = record_hash
+                cached_rows = self.transform_cache.get(identifier, record_hash, self.spec_hash())
+                if cached_rows is not None:
+                    results[identifier] = cached_rows
+                    continue
+            pending[identifier] = record
+
+        if executor is not None and pending:
+            pending_ids = list(pending)
+            chunks = [pending_ids[i:i + TRANSFORM_CHUNK_SIZE] for i in range(0, len(pending_ids), TRANSFORM_CHUNK_SIZE)]
+            futures = []
+            for chunk in chunks:
+                chunk_hashes = {i: record_hashes[i] for i in chunk} if self.transform_cache is not None else None
+                cache_snapshot = self.transform_cache.snapshot(chunk_hashes) if self.transform_cache is not None else None
+                futures.append(executor.submit(_transform_in_worker, self.spec['name'], {i: pending[i] for i in chunk},
+                                               chunk_hashes, cache_snapshot))
+            transformed = {}
+            for future in futures:
+                chunk_transformed, cache_changes = future.result()
+                transformed.update(chunk_transformed)
+                if cache_changes is not None:
+                    self.transform_cache.merge(cache_changes)
+        else:
+            transformed = self.transform_records(pending, record_hashes) if pending else {}
+
+        for identifier, csv_values in transformed.items():
+            if csv_values is None:
+                results[identifier] = []  # The transform failed (and was logged): nothing is cached, so it is retried
+                continue
+            if self.transform_cache is not None:
+                self.transform_cache.put(identifier, record_hashes[identifier], self.spec_hash(), csv_values)
+            results[identifier] = csv_values
+        if self.transform_cache is not None:
+            self.transform_cache.commit()
+
+        return {identifier: results[identifier] for identifier in records}
+
+    def transform_records(self, records: Dict[str, dict], record_hashes: Dict[str, str] = None) -> Dict[str, List[Dict[str, str]]]:
+        '''
+        The CPU-bound part of records_to_commons_csv_entries: identifier -> CSV rows. With record_hashes (and a
+        transform cache), field values and filled templates are reused from the cache where the config
+        sections they depend on have not changed; see cached_commonsdicts. A record whose transform failed maps
+        to None.
+        '''
+        if record_hashes is None or self.transform_cache is None:
+            return {identifier: self.items_to_csv_rows(identifier, item_list) if item_list is not None else None
+                    for identifier, item_list in self.batch_crossformat(records).items()}
+        _object_dicts = self.cached_commonsdicts(records, record_hashes)
+        return {identifier: self.items_to_csv_rows(identifier, [self.commonsdict_to_item(identifier, _object_dict)])
+                if _object_dict is not None else None
+                for identifier, _object_dict in zip(records, _object_dicts)}
+
+    def field_hashes(self) -> Dict[str, str]:
+        '''
+        Hash of each commons_template field definition, i.e. of everything its value depends on besides the record
+        '''
+        fields = self.spec['commons_template']['fields']
+        return {name: TransformCache.record_hash({'field': tvar, 'reconcile': self.reconciler is not None})
+                for name, tvar in fields.items() if isinstance(tvar, dict)}
+
+    def cached_commonsdicts(self, records: Dict[str, dict], record_hashes: Dict[str, str]) -> List[dict]:
+        '''
+        records_to_commonsdicts, reusing per-field values from the transform cache. Values are stored per record
+        (keyed on its record hash) and per field (keyed on the hash of the field's definition), so after a
+        config change only the fields whose definition changed are evaluated, and only over their records.
+        Records whose fields could not be filled get None, and nothing is stored for them.
+        '''
+        fields = self.spec['commons_template']['fields']
+        field_hashes = self.field_hashes()
+        stored = {identifier: self.transform_cache.get_fields(identifier, record_hashes[identifier]) for identifier in records}
+
+        # Records usually share the same stale fields (a config edit touches all of them), so group by those
+        groups = {}
+        failed = set()
+        for identifier in records:
+            stale = tuple(name for name, h in field_hashes.items() if stored[identifier].get(name, [None])[0] != h)
+            groups.setdefault(stale, []).append(identifier)
+        for stale, identifiers in groups.items():
+            self.transform_cache.fields_reused += len(identifiers) * (len(field_hashes) - len(stale))
+            if not stale:
+                continue
+            self.transform_cache.fields_evaluated += len(identifiers) * len(stale)
+            computed = self.records_to_commonsdicts([records[i] for i in identifiers],
+                                                    {'fields': {name: fields[name] for name in stale}}, identifiers)
+            for identifier, values in zip(identifiers, computed):
+                if values is None:
+                    failed.add(identifier)
+                    continue
+                for name in stale:
+                    # [definition hash, present, value]: a field can legitimately produce no entry
+                    stored[identifier][name] = [field_hashes[name], name in values, values.get(name)]
+                self.transform_cache.put_fields(identifier, record_hashes[identifier],
+                                                {name: stored[identifier][name] for name in field_hashes})
+
+        return [{name: stored[identifier][name][2] for name in field_hashes if stored[identifier][name][1]}
+                if identifier not in failed else None
+                for identifier in records]
+
+    def items_to_csv_rows(self, identifier: str, item_list: list) -> List[Dict[str, str]]:
+        '''
+        Turn the crossformatted items of one record into its CSV rows
         '''
         csv_values = []  # List of dicts that return the rows of the CSV
 
         # Want to fill each of these: 
         #   record_id, source_image_url, commons_filename, edit_summary, description
         
-        # Each call returns a dict in a list with 'url' and 'template' ready for Commons use
-        logging.debug('starting: ', identifier)
-        item_list = self.api_crossformat(identifier)
-        
         # TODO: Handle a list and not just one
         for item in item_list if item_list is not None else []:
             csv_entry = {}
@@ -910,6 +1438,30 @@ class SIunit:
 
         return 1  # Successful add
 
+    def identifiers_to_sdc(self, titles: Dict[str, str], writer: 'SDCWriter', test_mode: bool = False) -> Dict[str, int]:
+        '''
+        Write structured data for many uploaded files in batches
+
+        Parameters
+        ----------
+        titles: dict of Commons file title -> identifier, e.g. {'File:The Dying Tecumseh.jpg': 'saam_1916.8.1'}
+            (a record with several images has several titles)
+        writer: SDCWriter holding the Commons session
+
+        Output
+        ------
+        dict of file title -> number of statements added (see SDCWriter.write)
+        '''
+        statements = {}
+        item_lists = {}
+        for title, identifier in titles.items():
+            if identifier not in item_lists:
+                with wacsession.budget_scope(identifier):
+                    item_lists[identifier] = self.api_crossformat(identifier, crossformat='commons_wikibase')
+            if item_lists[identifier]:
+                statements[title] = item_lists[identifier][0]
+        return writer.write(statements, test_mode=test_mode)
+
 #     @staticmethod
 #     def upload_to_commons(site):
 
@@ -937,6 +1489,500 @@ class SIunit:
 
         return
 
+class UnitRouter:
+    """
+    Sends each identifier in a mixed list to the SIunit whose id_pattern matches it
+
+    All units are loaded from the config once, and their id_patterns are compiled into a single regular
+    expression. The units share one HTTP session (connection pool and cache) and one rate limiter.
+    """
+    def __init__(self, units: List[SIunit]):
+        self.units = [u for u in units if u.spec.get('id_pattern')]
+        for u in units:
+            if not u.spec.get('id_pattern'):
+                logging.warning(f"Unit {u.spec.get('name')} has no id_pattern and will not be routed to")
+        self._dispatch = re.compile('|'.join('(?P<_unit%d>%s)' % (n, u.spec['id_pattern'])
+                                             for n, u in enumerate(self.units)))
+
+    @classmethod
+    def from_yaml(cls, filename: str):
+        '''
+        Build a router over every unit in a YAML config file
+        '''
+        specs = load_unit_specs(filename)
+        session = shared_api_session()
+        # All units in one config share API keys, so the strictest quota applies to all
+        quotas = [unit_requests_per_hour(s) for s in specs]
+        quotas = [q for q in quotas if q]
+        limiter = limiter_for(('config', filename), min(quotas) if quotas else None)
+        return cls([SIunit(spec, session=session, limiter=limiter) for spec in specs])
+
+    def route(self, identifier: str) -> SIunit:
+        '''
+        Return the unit for an identifier, or None if no id_pattern matches
+        '''
+        if not self.units:
+            return None
+        m = self._dispatch.match(identifier)
+        if not m:
+            return None
+        for name, value in m.groupdict().items():
+            if value is not None and name.startswith('_unit'):
+                return self.units[int(name[len('_unit'):])]
+        return None
+
+class TransformCache:
+    """
+    Local sqlite cache of generated CSV rows, keyed on identifier plus a hash of the raw API record and a
+    hash of the unit spec. It lets unchanged records skip the JSONPath and template work even when the
+    HTTP cache had to re-download them.
+
+    When the spec did change, the intermediate results are still there to reuse: each record's field values,
+    keyed on the hash of each field's definition, and its filled-in template body, keyed on the skeleton
+    and the field values. Changing categories or append then re-renders without evaluating any field, and
+    changing one field evaluates only that field.
+    """
+    def __init__(self, path: str = 'transform_cache.sqlite'):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS rows (
+                                identifier TEXT PRIMARY KEY,
+                                record_hash TEXT NOT NULL,
+                                spec_hash TEXT NOT NULL,
+                                output TEXT NOT NULL)''')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS fields (
+                                identifier TEXT PRIMARY KEY,
+                                record_hash TEXT NOT NULL,
+                                fields TEXT NOT NULL)''')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS templates (
+                                identifier TEXT PRIMARY KEY,
+                                body_key TEXT NOT NULL,
+                                body TEXT NOT NULL)''')
+        self.conn.commit()
+        self.hits = 0
+        self.misses = 0
+        self.fields_reused = 0
+        self.fields_evaluated = 0
+        self.templates_reused = 0
+
+    @staticmethod
+    def record_hash(record: dict) -> str:
+        return hashlib.sha1(json.dumps(record, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def get(self, identifier: str, record_hash: str, spec_hash: str) -> list:
+        '''
+        Return the stored rows if they were generated from the same record and spec, otherwise None
+        '''
+        found = self.conn.execute('SELECT output FROM rows WHERE identifier = ? AND record_hash = ? AND spec_hash = ?',
+                                  (identifier, record_hash, spec_hash)).fetchone()
+        if found:
+            self.hits += 1
+            return json.loads(found[0])
+        self.misses += 1
+        return None
+
+    def put(self, identifier: str, record_hash: str, spec_hash: str, rows: list) -> None:
+        self.conn.execute('INSERT OR REPLACE INTO rows VALUES (?, ?, ?, ?)',
+                          (identifier, record_hash, spec_hash, json.dumps(rows)))
+
+    def get_fields(self, identifier: str, record_hash: str) -> dict:
+        '''
+        Return the stored field values of a record, as field name -> [definition hash, present, value],
+        or an empty dict if there are none for this version of the record
+        '''
+        found = self.conn.execute('SELECT fields FROM fields WHERE identifier = ? AND record_hash = ?',
+                                  (identifier, record_hash)).fetchone()
+        return json.loads(found[0]) if found else {}
+
+    def put_fields(self, identifier: str, record_hash: str, fields: dict) -> None:
+        self.conn.execute('INSERT OR REPLACE INTO fields VALUES (?, ?, ?)', (identifier, record_hash, json.dumps(fields)))
+
+    def get_template(self, identifier: str, body_key: str) -> str:
+        found = self.conn.execute('SELECT body FROM templates WHERE identifier = ? AND body_key = ?',
+                                  (identifier, body_key)).fetchone()
+        if found:
+            self.templates_reused += 1
+            return found[0]
+        return None
+
+    def put_template(self, identifier: str, body_key: str, body: str) -> None:
+        self.conn.execute('INSERT OR REPLACE INTO templates VALUES (?, ?, ?)', (identifier, body_key, body))
+
+    def commit(self) -> None:
+        '''
+        Write out everything put since the last commit (done once per batch rather than per row)
+        '''
+        self.conn.commit()
+
+    def snapshot(self, record_hashes: Dict[str, str]) -> dict:
+        '''
+        The stored field values and template bodies of these records (identifier -> record hash), for handing
+        to a transform process along with the records
+        '''
+        fields = {}
+        templates = {}
+        for identifier, record_hash in record_hashes.items():
+            found = self.conn.execute('SELECT fields FROM fields WHERE identifier = ? AND record_hash = ?',
+                                      (identifier, record_hash)).fetchone()
+            if found:
+                fields[identifier] = [record_hash, json.loads(found[0])]
+            found = self.conn.execute('SELECT body_key, body FROM templates WHERE identifier = ?', (identifier,)).fetchone()
+            if found:
+                templates[identifier] = list(found)
+        return {'fields': fields, 'templates': templates}
+
+    @classmethod
+    def from_snapshot(cls, snapshot: dict) -> 'TransformCache':
+        '''
+        In-memory TransformCache holding snapshot(); changes_since() then reports what a transform added to it
+        '''
+        cache = cls(':memory:')
+        for identifier, (record_hash, fields) in snapshot['fields'].items():
+            cache.put_fields(identifier, record_hash, fields)
+        for identifier, (body_key, body) in snapshot['templates'].items():
+            cache.put_template(identifier, body_key, body)
+        return cache
+
+    def changes_since(self, snapshot: dict, record_hashes: Dict[str, str]) -> dict:
+        '''
+        What was put since from_snapshot(snapshot), with the reuse counters, for merge() in the main process
+        '''
+        current = self.snapshot(record_hashes)
+        changes = {kind: {identifier: value for identifier, value in current[kind].items()
+                          if snapshot[kind].get(identifier) != value}
+                   for kind in ('fields', 'templates')}
+        changes['counts'] = {'fields_reused': self.fields_reused, 'fields_evaluated': self.fields_evaluated,
+                             'templates_reused': self.templates_reused}
+        return changes
+
+    def merge(self, changes: dict) -> None:
+        '''
+        Store the field values and template bodies a transform process computed, and add up its counters
+        '''
+        for identifier, (record_hash, fields) in changes['fields'].items():
+            self.put_fields(identifier, record_hash, fields)
+        for identifier, (body_key, body) in changes['templates'].items():
+            self.put_template(identifier, body_key, body)
+        for name, count in changes['counts'].items():
+            setattr(self, name, getattr(self, name) + count)
+
+def wikidata_reconcile_backend(names: List[str]) -> Dict[str, str]:
+    '''
+    Resolve a batch of person names to Wikidata QIDs with one SPARQL query on exact labels of humans.
+    "Last, First" names are also tried as "First Last". Names with no match, or with several candidates,
+    map to None rather than risk a wrong link.
+    '''
+    variants = {}
+    for name in names:
+        variants.setdefault(name, set()).add(name)
+        if name.count(', ') == 1 and not re.search(r'\d', name):
+            last, first = name.split(', ')
+            variants.setdefault(f'{first} {last}', set()).add(name)
+
+    values = ' '.join('%s@en' % (json.dumps(v, ensure_ascii=False),) for v in variants)
+    query = 'SELECT ?name ?item WHERE { VALUES ?name { %s } ?item rdfs:label ?name ; wdt:P31 wd:Q5 . }' % (values,)
+    response = wacsession.get_policy().request(
+        wacsession.get_session('wikidata'), 'POST', 'https://query.wikidata.org/sparql',
+        data={'query': query}, headers={'Accept': 'application/sparql-results+json'})
+    response.raise_for_status()
+
+    candidates = {name: set() for name in names}
+    for binding in response.json()['results']['bindings']:
+        qid = binding['item']['value'].rsplit('/', 1)[-1]
+        for name in variants.get(binding['name']['value'], ()):
+            candidates[name].add(qid)
+    return {name: qids.pop() if len(qids) == 1 else None for name, qids in candidates.items()}
+
+class Reconciler:
+    """
+    Persistent local name -> Wikidata QID index with a TTL, filled in batches
+
+    prepare() resolves every unknown or expired name through the backend, batch_size names per call, and
+    stores misses too so they are not looked up again until they expire. Rendering then only reads the
+    index. backend is any function taking a list of names and returning a dict of name -> QID or None,
+    so a local stub can stand in for Wikidata.
+    """
+    def __init__(self, path: str = 'reconcile_index.sqlite', backend=wikidata_reconcile_backend,
+                 ttl: int = 30 * 86400, batch_size: int = 100):
+        self.backend = backend
+        self.ttl = ttl
+        self.batch_size = batch_size
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS names (
+                                name TEXT PRIMARY KEY,
+                                qid TEXT,
+                                checked REAL NOT NULL)''')
+        self.conn.commit()
+        self._index = {name: (qid, checked) for name, qid, checked in self.conn.execute('SELECT * FROM names')}
+        self.lookups = 0
+
+    def prepare(self, names) -> None:
+        '''
+        Make sure every name is in the index and fresh, resolving the rest in batches
+        '''
+        now = time.time()
+        stale = sorted(n for n in set(names) if n not in self._index or now - self._index[n][1] > self.ttl)
+        logging.info(f"Reconcile: {len(set(names))} distinct names, {len(stale)} to look up")
+        for i in range(0, len(stale), self.batch_size):
+            batch = stale[i:i + self.batch_size]
+            try:
+                found = self.backend(batch)
+            except Exception as e:
+                logging.error(f'Reconciliation lookup failed, leaving {len(batch)} names unreconciled: {e}')
+                continue
+            self.lookups += 1
+            rows = [(n, found.get(n), now) for n in batch]
+            self.conn.executemany('INSERT OR REPLACE INTO names VALUES (?, ?, ?)', rows)
+            self.conn.commit()
+            self._index.update((n, (qid, checked)) for n, qid, checked in rows)
+
+    def snapshot(self) -> Dict[str, tuple]:
+        '''
+        The whole index as name -> (QID, checked), for handing to processes that only render
+        '''
+        return dict(self._index)
+
+    @classmethod
+    def from_snapshot(cls, snapshot: Dict[str, tuple]) -> 'Reconciler':
+        '''
+        In-memory, render-only Reconciler built from snapshot()
+        '''
+        reconciler = cls(':memory:', backend=None)
+        reconciler._index.update(snapshot)
+        return reconciler
+
+    def lookup(self, name: str) -> str:
+        return self._index.get(name, (None, 0))[0]
+
+    def lookup_many(self, names) -> Dict[str, str]:
+        return {n: self.lookup(n) for n in sorted(names)}
+
+    def render(self, value, reconcile_format: str = None):
+        '''
+        Replace reconciled names in a field value (string or list of strings) using reconcile_format,
+        by default a Wikidata-driven {{Creator}} template. Unreconciled names are left as they are.
+        '''
+        reconcile_format = reconcile_format or '{{Creator|Wikidata=%s}}'
+        def _render(name):
+            qid = self.lookup(name) if isinstance(name, str) else None
+            return reconcile_format % (qid,) if qid else name
+        if isinstance(value, list):
+            return [_render(v) for v in value]
+        return _render(value)
+
+def reconcile_stage(identifiers, unit_for, reconciler: Reconciler, records: dict = None) -> None:
+    '''
+    Collect the distinct names to reconcile across the whole identifier list and resolve each unique name
+    once, before any rows are rendered. unit_for maps an identifier to its SIunit (or None).
+    '''
+    names = set()
+    for identifier in tqdm(identifiers, desc="Collecting names"):
+        si_unit = unit_for(identifier)
+        if not si_unit or not si_unit.reconcile_fields():
+            continue
+        with wacsession.budget_scope(identifier):
+            record = records.get(identifier) if records else None
+            if record is None:
+                record = si_unit.api_lookup(identifier)  # Lands in the HTTP cache for the render pass
+        if record:
+            names.update(si_unit.reconcile_names(record))
+    reconciler.prepare(names)
+
+class SyncManifest:
+    """
+    Local sqlite manifest of record ID -> last-seen update timestamp and content hash, per sync scope
+
+    The scope is the search query, so separate departments synced from one manifest do not report each
+    other's records as removed.
+    """
+    def __init__(self, path: str = 'sync_manifest.sqlite'):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS records (
+                                scope TEXT NOT NULL,
+                                record_id TEXT NOT NULL,
+                                last_updated TEXT,
+                                content_hash TEXT,
+                                last_seen TEXT NOT NULL,
+                                PRIMARY KEY (scope, record_id))''')
+        self.conn.commit()
+
+    @staticmethod
+    def content_hash(record: dict) -> str:
+        return hashlib.sha1(json.dumps(record, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def delta(self, scope: str, seen: Dict[str, tuple]) -> tuple:
+        '''
+        Compare this run's records against the manifest
+
+        Parameters
+        ----------
+        seen: dict of record ID -> (last_updated, content_hash) from this run
+
+        Output
+        ------
+        (new, changed, removed) lists of record IDs
+        '''
+        known = {rid: (updated, chash) for rid, updated, chash in self.conn.execute(
+            'SELECT record_id, last_updated, content_hash FROM records WHERE scope = ?', (scope,))}
+        new = [rid for rid in seen if rid not in known]
+        changed = [rid for rid in seen if rid in known and known[rid] != seen[rid]]
+        removed = [rid for rid in known if rid not in seen]
+        return new, changed, removed
+
+    def commit(self, scope: str, seen: Dict[str, tuple], removed: List[str]) -> None:
+        '''
+        Store this run's records as the new baseline and forget removed ones
+        '''
+        now = datetime.now().isoformat(timespec='seconds')
+        self.conn.executemany('INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?, ?)',
+                              [(scope, rid, updated, chash, now) for rid, (updated, chash) in seen.items()])
+        self.conn.executemany('DELETE FROM records WHERE scope = ? AND record_id = ?',
+                              [(scope, rid) for rid in removed])
+        self.conn.commit()
+
+class SDCWriter:
+    """
+    Batched writer for structured data (SDC) on Commons MediaInfo entities
+
+    Instead of a wbgetentities check, token fetch and wbcreateclaim per statement (see addClaimByDict),
+    it resolves MediaInfo IDs for up to 50 titles per query, checks existing statements for up to 50
+    entities per wbgetentities call, and writes all new claims for a file in one wbeditentity edit.
+    The CSRF token is fetched once and cached.
+
+    api_url and fetch (same call signature as pywikibot.comms.http.fetch) can point it at a local fake API.
+    """
+    BATCH_SIZE = 50  # MediaWiki limit for titles/ids per query for non-bot accounts
+
+    def __init__(self, api_url: str = 'https://commons.wikimedia.org/w/api.php', fetch=http.fetch):
+        self.api_url = api_url
+        self.fetch = fetch
+        self._token = None
+
+    def _get(self, **params) -> dict:
+        params['format'] = 'json'
+        response = self.fetch(self.api_url, method='GET', params=params)
+        return json.loads(response.text)
+
+    def _post(self, **data) -> dict:
+        data['format'] = 'json'
+        response = self.fetch(self.api_url, method='POST', data=data)
+        return json.loads(response.text)
+
+    def csrf_token(self) -> str:
+        if self._token is None:
+            tokendata = self._get(action='query', meta='tokens', type='csrf')
+            self._token = tokendata['query']['tokens']['csrftoken']
+        return self._token
+
+    def resolve_mids(self, titles: List[str]) -> Dict[str, str]:
+        '''
+        Map file titles to MediaInfo IDs (M + pageid), skipping titles that do not exist
+        '''
+        mids = {}
+        for i in range(0, len(titles), self.BATCH_SIZE):
+            batch = titles[i:i + self.BATCH_SIZE]
+            data = self._get(action='query', titles='|'.join(batch), formatversion=2)
+            query = data.get('query', {})
+            normalized = {n['to']: n['from'] for n in query.get('normalized', [])}
+            for page in query.get('pages', []):
+                if 'pageid' in page:
+                    mids[normalized.get(page['title'], page['title'])] = 'M%s' % (page['pageid'],)
+        return mids
+
+    def existing_properties(self, mids: List[str]) -> Dict[str, set]:
+        '''
+        Map MediaInfo IDs to the set of properties that already have statements
+        '''
+        existing = {}
+        for i in range(0, len(mids), self.BATCH_SIZE):
+            batch = mids[i:i + self.BATCH_SIZE]
+            data = self._get(action='wbgetentities', ids='|'.join(batch), props='claims')
+            for mid, entity in data.get('entities', {}).items():
+                # Files without any SDC come back as 'missing', and statements may be an empty list
+                statements = entity.get('statements') or {}
+                existing[mid] = set(statements.keys()) if isinstance(statements, dict) else set()
+        return existing
+
+    @staticmethod
+    def statement_json(item: dict) -> dict:
+        '''
+        Convert a {'property': ..., 'datatype': ..., 'datavalue': ...} dict from id_to_commonswblist into a
+        wbeditentity claim, or None if there is no value
+
+        Items without a datatype are taken as plain strings: 'value' is never decoded, so a record whose text
+        happens to start with { or " is written as it reads.
+        '''
+        datatype = item.get('datatype', 'string')
+        value = item.get('datavalue', item.get('value'))
+        if isinstance(value, list):  # Same handling as gen_wikibase_postdata: first match only
+            value = value[0] if value else None
+        if value is None or value == '':
+            return None
+
+        if datatype == 'wikibase-item':
+            numeric_id = int(str(value['numeric-id'] if isinstance(value, dict) else value).lstrip('Q'))
+            datavalue = {'type': 'wikibase-entityid',
+                         'value': {'entity-type': 'item', 'numeric-id': numeric_id, 'id': 'Q%s' % (numeric_id,)}}
+        elif datatype == 'string':
+            datavalue = {'type': 'string', 'value': str(value)}
+        else:
+            raise ValueError(f"unsupported datatype {datatype!r} for {item['property']}")
+
+        return {'mainsnak': {'snaktype': 'value', 'property': item['property'], 'datavalue': datavalue},
+                'type': 'statement',
+                'rank': 'normal'}
+
+    def write(self, statements: Dict[str, list], test_mode: bool = False) -> Dict[str, int]:
+        '''
+        Add statements to many files, honoring any statement already present for a property
+
+        Parameters
+        ----------
+        statements: dict of file title -> list of {'property': ..., 'value': ...} dicts
+
+        Output
+        ------
+        dict of file title -> number of statements added, 0 if nothing to do, -1 if the file was not found,
+        -2 on an API error
+        '''
+        results = {}
+        mids = self.resolve_mids(list(statements.keys()))
+        existing = self.existing_properties(list(mids.values()))
+
+        for title, items in statements.items():
+            if title not in mids:
+                logging.error(f'SDCWriter: {title} not found on Commons')
+                results[title] = -1
+                continue
+            mid = mids[title]
+            claims = []
+            for item in items:
+                try:
+                    claim = self.statement_json(item)
+                except (KeyError, TypeError, ValueError) as e:
+                    # A bad value skips that statement only, not the file or the rest of the batch
+                    logging.error(f"SDCWriter: {title} {item.get('property')}: {e!r}")
+                    continue
+                if claim and claim['mainsnak']['property'] not in existing.get(mid, set()):
+                    claims.append(claim)
+            if not claims:
+                results[title] = 0
+                continue
+
+            summary = 'added %s via Wiki API connector' % (', '.join(c['mainsnak']['property'] for c in claims),)
+            if test_mode:
+                logging.info(f'TEST_MODE: wbeditentity {mid}: {claims}')
+                results[title] = len(claims)
+                continue
+
+            data = self._post(action='wbeditentity', id=mid, data=json.dumps({'claims': claims}),
+                              token=self.csrf_token(), bot=1, summary=summary)
+            if 'error' in data:
+                logging.error(f"SDCWriter: {title} ({mid}): {data['error']}")
+                results[title] = -2
+            else:
+                results[title] = len(claims)
+        return results
+
 def run_test_saam():
     """
     Test Smithsonian American Art Museum
@@ -979,42 +2025,583 @@ def run_test() -> None:
     return
 
 
-def process_identifiers(identifiers, config_file, unit_string, output_file) -> None:
+COLUMNAR_EXTENSIONS = ('.parquet', '.arrow')
+CSV_COLUMNS = ['record_id', 'source_image_url', 'commons_filename', 'edit_summary', 'description']
+
+def normalize_commons_title(filename: str) -> str:
+    '''
+    Normalize a filename the way MediaWiki normalizes page titles, so names that would land on the same
+    File: page compare equal: NFC, underscores as spaces, runs of whitespace collapsed, first letter uppercase
+    '''
+    title = re.sub(r'[_\s]+', ' ', unicodedata.normalize('NFC', filename)).strip()
+    return title[:1].upper() + title[1:]
+
+def resolve_filename_collisions(rows: List[Dict[str, str]]) -> List[Dict[str, str]]:
+    '''
+    Find rows across the whole batch whose commons_filename would be the same File: page and rename all
+    but one of each group, in place. Within a group the rows are ordered by record_id and source URL, the
+    first keeps its name and the others get a short hash of those two appended, so the result does not
+    depend on the order of the input. Rows for the same source image are one file, not a collision.
+    Returns a list of {record_id, source_image_url, original, renamed} for reporting.
+    '''
+    groups = {}
+    for row in rows:
+        if row.get('commons_filename'):
+            groups.setdefault(normalize_commons_title(row['commons_filename']), []).append(row)
+    planned = set(groups)
+
+    collisions = []
+    for group in groups.values():
+        if len({row['source_image_url'] for row in group}) < 2:
+            continue
+        group.sort(key=lambda row: (row['record_id'], row['source_image_url']))
+        keep_url = group[0]['source_image_url']
+        for row in group[1:]:
+            if row['source_image_url'] == keep_url:
+                continue
+            original = row['commons_filename']
+            stem, dot, extension = original.rpartition('.')
+            if not dot:
+                stem, extension = original, ''
+            digest = hashlib.sha1(f"{row['record_id']}|{row['source_image_url']}".encode('utf-8')).hexdigest()
+            for length in range(8, len(digest) + 1):
+                renamed = f'{stem} ({digest[:length]}){dot}{extension}'
+                if normalize_commons_title(renamed) not in planned:
+                    break
+            planned.add(normalize_commons_title(renamed))
+            row['commons_filename'] = renamed
+            collisions.append({'record_id': row['record_id'], 'source_image_url': row['source_image_url'],
+                               'original': original, 'renamed': renamed})
+    return collisions
+
+def report_collisions(collisions: List[Dict[str, str]], collisions_file: str = None) -> None:
+    '''
+    Log the renames made by resolve_filename_collisions, and write them to collisions_file as CSV if given
+    '''
+    if collisions:
+        logging.warning(f"Renamed {len(collisions)} files whose Commons filenames collided within this batch")
+        for c in collisions:
+            logging.info(f"Filename collision for {c['record_id']}: {c['original']} -> {c['renamed']}")
+    if collisions_file:
+        with open(collisions_file, 'w', newline='') as f:
+            collision_writer = csv.DictWriter(f, fieldnames=['record_id', 'source_image_url', 'original', 'renamed'])
+            collision_writer.writeheader()
+            collision_writer.writerows(collisions)
+
+def parse_shard(spec: str) -> tuple:
+    '''
+    Parse a --shard value of the form i/N (0 <= i < N) into (i, N)
+    '''
+    try:
+        index, count = (int(part) for part in spec.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'Shard must look like i/N, not {spec}')
+    if not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f'Shard index must be from 0 to {count - 1}, not {index}')
+    return index, count
+
+def in_shard(identifier: str, shard: tuple) -> bool:
+    '''
+    Whether an identifier belongs to shard (i, N). The split is by a hash of the identifier, so it is the
+    same on every machine and for every ordering of the input, and the N shards never overlap.
+    '''
+    if shard is None:
+        return True
+    index, count = shard
+    return int(hashlib.sha1(identifier.encode('utf-8')).hexdigest()[:16], 16) % count == index
+
+DEFAULT_BATCH_SIZE = 500  # Records transformed together when they were fetched in bulk
+TRANSFORM_CHUNK_SIZE = 100  # Records per task sent to a transform process
+
+# Process pool for the transform stage
+#   Each worker gets the unit specs (and reconciliation index) once, through the pool initializer, and builds
+#   its own SIunits. Tasks then carry only the raw records. Network and sqlite access stay in the main process.
+
+_worker_units = {}
+
+def _init_transform_worker(specs: List[dict], reconcile_snapshot: Dict[str, tuple] = None) -> None:
+    reconciler = Reconciler.from_snapshot(reconcile_snapshot) if reconcile_snapshot is not None else None
+    for spec in specs:
+        # A plain session: workers never fetch, and should not open the HTTP cache file
+        _worker_units[spec['name']] = SIunit(spec, session=requests.Session(), reconciler=reconciler)
+
+def _transform_in_worker(unit_name: str, records: Dict[str, dict], record_hashes: Dict[str, str] = None,
+                         cache_snapshot: dict = None) -> Tuple[Dict[str, List[Dict[str, str]]], dict]:
+    '''
+    transform_records in a worker, reusing field values and template bodies from cache_snapshot (taken by the
+    main process's TransformCache). Returns the rows, and the cache changes for TransformCache.merge (or None).
+    '''
+    si_unit = _worker_units[unit_name]
+    if cache_snapshot is None:
+        return si_unit.transform_records(records), None
+    si_unit.transform_cache = TransformCache.from_snapshot(cache_snapshot)
+    try:
+        transformed = si_unit.transform_records(records, record_hashes)
+        return transformed, si_unit.transform_cache.changes_since(cache_snapshot, record_hashes)
+    finally:
+        si_unit.transform_cache.conn.close()
+        si_unit.transform_cache = None
+
+def transform_pool(processes: int, units: List[SIunit], reconciler: 'Reconciler' = None) -> concurrent.futures.ProcessPoolExecutor:
+    '''
+    Start a process pool for records_to_commons_csv_entries, with the units' specs shipped to each worker once
+    '''
+    return concurrent.futures.ProcessPoolExecutor(
+        max_workers=processes, initializer=_init_transform_worker,
+        initargs=([u.spec for u in units], reconciler.snapshot() if reconciler is not None else None))
+
+def write_columnar(rows: List[Dict[str, str]], output_file: str, row_group_size: int = 10000) -> None:
+    '''
+    Write the generated rows as Parquet (.parquet) or Arrow IPC (.arrow) instead of CSV, with
+    zstd-compressed, dictionary-encoded string columns. Requires pyarrow (pip install pyarrow).
+    '''
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        logging.error('Writing %s needs pyarrow: pip install pyarrow' % (output_file,))
+        sys.exit(1)
+
+    schema = pa.schema([(name, pa.string()) for name in CSV_COLUMNS])
+    table = pa.Table.from_pylist(rows, schema=schema)
+    if output_file.endswith('.parquet'):
+        # Row groups let the uploader read the file in parallel
+        pq.write_table(table, output_file, compression='zstd', use_dictionary=True, row_group_size=row_group_size)
+    else:
+        options = pa.ipc.IpcWriteOptions(compression='zstd')
+        with pa.OSFile(output_file, 'wb') as sink, pa.ipc.new_file(sink, schema, options=options) as writer:
+            writer.write_table(table, max_chunksize=row_group_size)
+
+def read_rows(input_file: str) -> List[Dict[str, str]]:
+    '''
+    Read generated rows back from a CSV, Parquet or Arrow file
+    '''
+    if not input_file.endswith(COLUMNAR_EXTENSIONS):
+        with open(input_file, newline='') as f:
+            return list(csv.DictReader(f))
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        logging.error('Reading %s needs pyarrow: pip install pyarrow' % (input_file,))
+        sys.exit(1)
+    if input_file.endswith('.parquet'):
+        return pq.read_table(input_file, memory_map=True).to_pylist()
+    with pa.memory_map(input_file) as source:
+        return pa.ipc.open_file(source).read_all().to_pylist()
+
+def write_rows(rows: List[Dict[str, str]], output_file: str) -> None:
+    '''
+    Write generated rows as CSV (stdout if output_file is None), or as Parquet/Arrow by file extension
+    '''
+    if output_file is not None and output_file.endswith(COLUMNAR_EXTENSIONS):
+        write_columnar(rows, output_file)
+    else:
+        output_stream = sys.stdout if output_file is None else open(output_file, 'w')
+
+        if rows:
+            logging.debug ('Processing csv_master_list')
+            example_dict = rows[0] # Example item for creating field names
+            csv_writer = csv.DictWriter(output_stream, fieldnames=example_dict.keys())
+            csv_writer.writeheader()
+            csv_writer.writerows(rows)
+
+        if output_file is not None:
+            output_stream.close()        
+
+def merge_shards(shard_files: List[str], output_file: str, collisions_file: str = None) -> None:
+    '''
+    Combine the outputs of a sharded run (CSV, Parquet or Arrow, in any mix) into one file ordered by
+    record_id, dropping rows repeated across shards, and resolving filename collisions between shards,
+    which no single shard could see. Logs per-shard counts: rows, records, rows without an image
+    (no URL at the API) and duplicates dropped.
+    '''
+    merged = []
+    seen = set()
+    for shard_file in shard_files:
+        rows = read_rows(shard_file)
+        duplicates = 0
+        for row in rows:
+            key = (row['record_id'], row['source_image_url'], row['commons_filename'])
+            if key in seen:
+                duplicates += 1
+                continue
+            seen.add(key)
+            merged.append(row)
+        failures = sum(1 for row in rows if not row['source_image_url'])
+        logging.info(f"{shard_file}: {len(rows)} rows, {len({row['record_id'] for row in rows})} records, "
+                     f"{failures} without an image, {duplicates} duplicates dropped")
+
+    merged.sort(key=lambda row: row['record_id'])  # Stable, so a record's own rows keep their order
+    report_collisions(resolve_filename_collisions(merged), collisions_file)
+    write_rows(merged, output_file)
+    logging.info(f"Merged {len(shard_files)} shards into {len(merged)} rows")
+
+@dataclass
+class RunPlan:
+    """
+    How a list of identifiers splits into free work and API quota, worked out before a run starts
+    """
+    cached: List[str]    # Record already at hand or in the API cache: no quota needed
+    misses: List[str]    # Each costs an API call, paced by its unit's RateLimiter
+    unrouted: List[str]  # No unit id_pattern matches
+    seconds: float       # Least time the misses take at the configured requests_per_hour
+    unpaced: int         # Misses for units without requests_per_hour, which cannot be estimated
+
+    @property
+    def order(self) -> List[str]:
+        '''
+        Processing order: cached records first, so their rows are ready at once, then the misses
+        '''
+        return self.cached + self.misses + self.unrouted
+
+def plan_run(identifiers, unit_for, records: dict = None) -> RunPlan:
+    '''
+    Check every identifier against the records given and the API cache, and estimate how long the
+    uncached ones take at the quota. Only fresh cache entries count as cached: an expired one is sent
+    again (as a revalidation if it can be), so it is paced and uses quota like a miss (see api_request).
+    '''
+    cached, misses, unrouted = [], [], []
+    limiter_seconds = {}
+    unpaced = 0
+    for identifier in identifiers:
+        si_unit = unit_for(identifier)
+        if not si_unit:
+            unrouted.append(identifier)
+        elif (records is not None and records.get(identifier) is not None) or si_unit.is_cached(identifier, fresh=True):
+            cached.append(identifier)
+        else:
+            misses.append(identifier)
+            if si_unit.limiter.interval:
+                # Units sharing a limiter share its pace, so their misses add up
+                pace = id(si_unit.limiter)
+                limiter_seconds[pace] = limiter_seconds.get(pace, 0.0) + si_unit.limiter.interval
+            else:
+                unpaced += 1
+    return RunPlan(cached, misses, unrouted, max(limiter_seconds.values(), default=0.0), unpaced)
+
+def log_plan(plan: RunPlan) -> None:
+    logging.info(f"Plan: {len(plan.cached)} cached, {len(plan.misses)} need an API call, "
+                 f"{len(plan.unrouted)} match no unit")
+    if plan.seconds:
+        finish = datetime.now() + timedelta(seconds=plan.seconds)
+        logging.info(f"Estimated API time at the configured quota: {timedelta(seconds=round(plan.seconds))} "
+                     f"(done around {finish:%Y-%m-%d %H:%M})")
+    if plan.unpaced:
+        logging.warning(f"{plan.unpaced} API calls are for units without requests_per_hour: they are not paced, "
+                        f"so their time cannot be estimated and the run may hit HTTP 429")
+
+def process_identifiers(identifiers, config_file, unit_string, output_file, records: dict = None,
+                        transform_cache: TransformCache = None, reconciler: Reconciler = None,
+                        collisions_file: str = None, processes: int = None, plan_only: bool = False) -> set:
+    # Returns the identifiers that produced rows in output_file
     # Your processing logic goes here
     logging.info(f"Configuration file: {config_file}")
     logging.info(f"Unit string: {unit_string}")
 
-    si_unit = SIunit.from_yaml(config_file, unit_string)
-    if not si_unit:
-        logging.error('Creating unit failed')
-        sys.exit(1)
-        
+    # Without a unit string, route every identifier to its unit by id_pattern
+    if unit_string:
+        si_unit = SIunit.from_yaml(config_file, unit_string)
+        if not si_unit:
+            logging.error('Creating unit failed')
+            sys.exit(1)
+        si_unit.transform_cache = transform_cache
+        router = None
+    else:
+        router = UnitRouter.from_yaml(config_file)
+        if not router.units:
+            logging.error('No units with an id_pattern in config file')
+            sys.exit(1)
+        for u in router.units:
+            u.transform_cache = transform_cache
+
+    units = router.units if router else [si_unit]
+    unit_for = router.route if router else (lambda identifier: si_unit)
+
+    # Cached records first, then the misses at the limiter's pace; rows are put back in input order at the end
+    input_position = {identifier: n for n, identifier in enumerate(identifiers)}
+    plan = plan_run(identifiers, unit_for, records)
+    log_plan(plan)
+    if plan_only:
+        return set()
+    identifiers = plan.order
+
+    if processes and records is None:
+        # All I/O happens here first; only the transform goes to the process pool
+        records = {}
+        for identifier in tqdm(identifiers, desc="Fetching"):
+            si_unit = unit_for(identifier)
+            if si_unit:
+                with wacsession.budget_scope(identifier):
+                    records[identifier] = si_unit.api_lookup(identifier)
+
+    if reconciler is not None and any(u.reconcile_fields() for u in units):
+        for u in units:
+            u.reconciler = reconciler
+        reconcile_stage(identifiers, unit_for, reconciler, records)
+
     csv_master_list = []  # List of dicts
-    with tqdm(total=len(identifiers), desc="Processing") as pbar:
+    if records is not None:
+        # Records already fetched (sync, dumps): transform them in batches, a column at a time
+        batch_results = {}
+        executor = transform_pool(processes, units, reconciler if any(u.reconciler for u in units) else None) if processes else None
+        batch_size = DEFAULT_BATCH_SIZE * (processes or 1)
+        with tqdm(total=len(identifiers), desc="Transforming") as pbar:
+            for start in range(0, len(identifiers), batch_size):
+                batch = identifiers[start:start + batch_size]
+                by_unit = {}
+                for identifier in batch:
+                    si_unit = unit_for(identifier)
+                    if si_unit and records.get(identifier) is not None:
+                        by_unit.setdefault(id(si_unit), (si_unit, {}))[1][identifier] = records[identifier]
+                for si_unit, unit_records in by_unit.values():
+                    batch_results.update(si_unit.records_to_commons_csv_entries(unit_records, executor))
+                pbar.update(len(batch))
+        if executor is not None:
+            executor.shutdown()
+        for identifier in identifiers:
+            if batch_results.get(identifier):
+                csv_master_list.extend(batch_results[identifier])
+            elif identifier in batch_results:
+                logging.error(f'No valid identifier_to_commons_csv_entry result for {identifier}')
+        # Anything not transformed here (no record, no unit) goes through the per-identifier path below
+        identifiers = [i for i in identifiers if i not in batch_results]
+
+    with tqdm(total=len(identifiers), desc="Processing", disable=not identifiers) as pbar:
         for identifier in identifiers:
             logging.debug(f"Processing: {identifier}\n")
-            # Add a delay here so API doesn't lock us out or throttle
-            # TODO - make this a parameter in config file or on command line
-            # ON SECOND THOUGHT bad approach as it delays even local cached lookups
-            # time.sleep(1)
-            csv_entries = si_unit.identifier_to_commons_csv_entry(identifier)
+            # Pacing against the API quota is done by the unit's RateLimiter, and only for uncached lookups
+            si_unit = unit_for(identifier)
+            if not si_unit:
+                logging.error(f'No unit id_pattern matches {identifier}')
+                pbar.update(1)
+                continue
+            with wacsession.budget_scope(identifier):
+                csv_entries = si_unit.identifier_to_commons_csv_entry(identifier, records.get(identifier) if records else None)
             if not csv_entries:
                 logging.error('No valid identifier_to_commons_csv_entry result for', identifier)
             else:
                 csv_master_list.extend(csv_entries)
             pbar.update(1)
 
-    output_stream = sys.stdout if output_file is None else open(output_file, 'w')
+    csv_master_list.sort(key=lambda row: input_position.get(row['record_id'], len(input_position)))
 
-    if csv_master_list:
-        logging.debug ('Processing csv_master_list')
-        example_dict = csv_master_list[0] # Example item for creating field names
-        csv_writer = csv.DictWriter(output_stream, fieldnames=example_dict.keys())
-        csv_writer.writeheader()
-        csv_writer.writerows(csv_master_list)
-    
-    if output_file is not None:
-        output_stream.close()        
+    # Two objects mapping to one File: page would only fail at upload time, after the download
+    report_collisions(resolve_filename_collisions(csv_master_list), collisions_file)
+    write_rows(csv_master_list, output_file)
+    written = {row['record_id'] for row in csv_master_list}
+
+    wacsession.log_stats()
+    if transform_cache is not None:
+        logging.info(f"Transform cache: {transform_cache.hits} rows reused, {transform_cache.misses} regenerated "
+                     f"({transform_cache.fields_reused} field values and {transform_cache.templates_reused} "
+                     f"template bodies reused, {transform_cache.fields_evaluated} field values evaluated)")
+    return written
+
+def search_unit_for(config_file, unit_string) -> SIunit:
+    '''
+    The unit whose API search endpoint is used: the -u unit, or the first routed unit (they share one API).
+    Exits with status 4 if that unit has no api: search_url, so callers can fall back to scraping.
+    '''
+    if unit_string:
+        search_unit = SIunit.from_yaml(config_file, unit_string)
+    else:
+        router = UnitRouter.from_yaml(config_file)
+        search_unit = router.units[0] if router.units else None
+    if not search_unit:
+        logging.error('Creating unit failed')
+        sys.exit(1)
+    if not search_unit.spec.get('api', {}).get('search_url'):
+        logging.error(f"Unit {search_unit.spec['name']!r} has no api: search_url in {config_file}, so it cannot be "
+                      f"searched through the API; scrape the search with si-collections-search-dumper.py "
+                      f"and pass the identifiers with -i")
+        sys.exit(4)
+    return search_unit
+
+def search_records(search_unit: SIunit, query: str, shard: tuple = None, cc0_only: bool = False) -> Dict[str, dict]:
+    '''
+    The records of an API search by identifier, keeping only those in shard (i, N) if given and, with cc0_only,
+    those with CC0 media (what media.CC0=true selects on collections.si.edu, which the API query cannot express)
+    '''
+    records = {}
+    without_cc0 = 0
+    for identifier, record in tqdm(search_unit.api_search(query), desc="Searching", unit='record'):
+        if not in_shard(identifier, shard):
+            continue
+        if cc0_only and not sisearch.has_cc0_media(record['response']):
+            without_cc0 += 1
+            continue
+        records.setdefault(identifier, record)
+    if without_cc0:
+        logging.info(f"Search: skipped {without_cc0} records without CC0 media (media.CC0=true)")
+    if shard is not None:
+        logging.info(f"Shard {shard[0]}/{shard[1]}: {len(records)} records")
+    return records
+
+def process_search(search_url, config_file, unit_string, output_file, ids_file: str = None, shard: tuple = None,
+                   **options) -> bool:
+    '''
+    Generate the output for a collections.si.edu search URL straight from the API: the URL is translated
+    into an API search query and paged through 1000 records at a time, and the records in the search
+    responses are transformed without any per-object lookups. Returns False, having fetched nothing, if the
+    URL cannot be translated and needs the HTML scraper. With shard (i, N), only the records in that shard
+    are generated. The identifiers kept go to ids_file if given. options are passed on to process_identifiers.
+    '''
+    query = sisearch.collections_url_to_api_query(search_url)
+    if query is None:
+        return False
+    logging.info(f"API search query: {query}")
+
+    search_unit = search_unit_for(config_file, unit_string)
+    records = search_records(search_unit, query, shard, sisearch.requires_cc0_media(search_url))
+    identifiers = list(records)
+    if ids_file:
+        with open(ids_file, 'w') as stream:
+            stream.write(''.join(rid + '\n' for rid in identifiers))
+
+    process_identifiers(identifiers, config_file, unit_string, output_file, records=records, **options)
+    return True
+
+PREFETCH_PAUSE = 300  # Seconds to wait when the reserved share of the quota is all that is left
+
+def prefetch(identifiers, config_file, unit_string, quota_share: float = 0.5) -> None:
+    '''
+    Fill the API cache for a list of identifiers in the background, so later runs over them are cache hits.
+
+    Only quota_share of each unit's hourly quota is used: requests are paced at that share of
+    requests_per_hour, and when the quota the API reports as left drops to the rest, prefetch pauses so
+    interactive runs (in other processes) still have their share. Records already cached and unexpired are
+    skipped, so an interrupted prefetch picks up where it stopped when run again with the same list.
+    Expired records are fetched again (or revalidated) like misses, at the same pace and against the same share.
+    '''
+    if unit_string:
+        units = [SIunit.from_yaml(config_file, unit_string)]
+        if not units[0]:
+            logging.error('Creating unit failed')
+            sys.exit(1)
+        unit_for = lambda identifier: units[0]
+    else:
+        router = UnitRouter.from_yaml(config_file)
+        units, unit_for = router.units, router.route
+
+    # Units sharing keys share one quota, so they share one limiter, paced for the strictest of them
+    rates = {}
+    for u in units:
+        per_hour = unit_requests_per_hour(u.spec)
+        if per_hour:
+            rates[id(u.key_pool)] = min(rates.get(id(u.key_pool), per_hour), per_hour)
+    limiters = {pool: RateLimiter(max(1, int(rate * quota_share))) for pool, rate in rates.items()}
+    for u in units:
+        u.limiter = limiters.get(id(u.key_pool), RateLimiter())
+
+    fetched = refreshed = skipped = failed = 0
+    try:
+        for identifier in tqdm(identifiers, desc="Prefetching"):
+            si_unit = unit_for(identifier)
+            if not si_unit:
+                logging.error(f'No unit id_pattern matches {identifier}')
+                continue
+            if si_unit.is_cached(identifier, fresh=True):
+                skipped += 1
+                continue
+            stale = si_unit.is_cached(identifier)
+            per_hour = unit_requests_per_hour(si_unit.spec)
+            # The count only changes with our own responses, or goes stale (None) when the quota resets
+            remaining = si_unit.key_pool.remaining()
+            while per_hour and remaining is not None and remaining <= per_hour * (1 - quota_share):
+                logging.info(f"{remaining} API requests left this hour, all reserved for other runs; "
+                             f"pausing prefetch for {PREFETCH_PAUSE} s")
+                time.sleep(PREFETCH_PAUSE)
+                remaining = si_unit.key_pool.remaining()
+            if si_unit.api_lookup(identifier) is None:
+                failed += 1
+            elif stale:
+                refreshed += 1
+            else:
+                fetched += 1
+    except KeyboardInterrupt:
+        logging.info('Prefetch interrupted; run it again with the same list to continue')
+    logging.info(f"Prefetch: {fetched} fetched, {refreshed} expired and refreshed, {skipped} already cached, "
+                 f"{failed} failed")
+    wacsession.log_stats()
+
+def write_sdc(rows_file, config_file, unit_string, writer: SDCWriter = None, test_mode: bool = False) -> Dict[str, int]:
+    '''
+    Add the commons_wikibase statements of each unit to files already uploaded from a generated CSV
+    (or Parquet/Arrow) file, finding each file by its commons_filename. Returns SDCWriter.write's results.
+    '''
+    if unit_string:
+        si_unit = SIunit.from_yaml(config_file, unit_string)
+        if not si_unit:
+            logging.error('Creating unit failed')
+            sys.exit(1)
+        unit_for = lambda identifier: si_unit
+    else:
+        unit_for = UnitRouter.from_yaml(config_file).route
+
+    if writer is None:
+        if not test_mode:
+            pywikibot.Site('commons', 'commons').login()  # SDCWriter posts through pywikibot's logged-in session
+        writer = SDCWriter()
+
+    per_unit = {}
+    for row in read_rows(rows_file):
+        if not row.get('commons_filename'):
+            continue
+        si_unit = unit_for(row['record_id'])
+        if si_unit is None or 'commons_wikibase' not in si_unit.spec:
+            logging.warning(f"No commons_wikibase statements configured for {row['record_id']}, skipping")
+            continue
+        per_unit.setdefault(id(si_unit), (si_unit, {}))[1]['File:' + row['commons_filename']] = row['record_id']
+
+    results = {}
+    for si_unit, titles in per_unit.values():
+        results.update(si_unit.identifiers_to_sdc(titles, writer, test_mode=test_mode))
+    added = sum(n for n in results.values() if n > 0)
+    failed = sum(1 for n in results.values() if n < 0)
+    logging.info(f"Structured data: {added} statements added to {len(results)} files, {failed} files failed")
+    return results
+
+def sync_search(query, config_file, unit_string, output_file, manifest_file, removed_file,
+                transform_cache: TransformCache = None, reconciler: Reconciler = None,
+                collisions_file: str = None, shard: tuple = None, processes: int = None,
+                cc0_only: bool = False) -> None:
+    '''
+    Delta sync: page through an API search, and generate CSV rows only for records that are new or changed
+    since the last sync of the same query. Records that have disappeared are written to removed_file.
+
+    The search pages carry the full records, so a department of 20k objects costs about 20 API calls
+    at 1000 rows per page, plus nothing for unchanged records.
+
+    With shard (i, N), only the records in that shard are considered, and the manifest keeps a separate
+    scope per shard, so the N nodes of a sharded sync can share one query without stepping on each other.
+    With cc0_only (a search URL with media.CC0=true), records without CC0 media are left out, under a scope
+    of their own.
+    '''
+    search_unit = search_unit_for(config_file, unit_string)
+
+    records = search_records(search_unit, query, shard, cc0_only)
+    seen = {identifier: (record['response'].get('lastTimeUpdated'), SyncManifest.content_hash(record['response']))
+            for identifier, record in records.items()}
+
+    manifest = SyncManifest(manifest_file)
+    scope = query + (' [CC0 media]' if cc0_only else '') + ('' if shard is None else ' [shard %d/%d]' % shard)
+    new, changed, removed = manifest.delta(scope, seen)
+    logging.info(f"Sync: {len(seen)} records, {len(new)} new, {len(changed)} changed, {len(removed)} removed")
+
+    delta_ids = new + changed
+    written = process_identifiers(delta_ids, config_file, unit_string, output_file,
+                                  records={rid: records[rid] for rid in delta_ids}, transform_cache=transform_cache,
+                                  reconciler=reconciler, collisions_file=collisions_file, processes=processes)
+
+    if removed_file:
+        with open(removed_file, 'w') as stream:
+            stream.write(''.join(rid + '\n' for rid in removed))
+    # Records that produced no rows keep their old manifest entry (or none), so the next sync tries them again
+    failed = set(delta_ids) - written
+    if failed:
+        logging.warning(f"Sync: {len(failed)} new or changed records produced no rows and will be retried next sync")
+    manifest.commit(scope, {rid: v for rid, v in seen.items() if rid not in failed}, removed)
 
 def main():
     # Create an ArgumentParser
@@ -1026,18 +2613,101 @@ def main():
     # Add optional command line options
     parser.add_argument("-c", "--config", dest="config_file", help="Configuration file in YAML format")
     parser.add_argument("-u", "--unit", dest="unit_string", help="Unit string, name of entity in config file")
+    parser.add_argument("-r", "--route", action="store_true",
+                        help="Route each identifier to its unit by the units' id_pattern, instead of using -u")
     parser.add_argument("-o", "--output", dest="output_file", help="Output file (default is stdout)")
     parser.add_argument("-i", "--input", dest="input_file", help="Input file with identifiers (one per line)")
+    parser.add_argument("--sync", dest="sync_query", metavar="QUERY",
+                        help="Delta sync: run this API search and only output records new or changed since the last sync")
+    parser.add_argument("-s", "--search", dest="search_url", metavar="URL",
+                        help="Process the objects of a collections.si.edu search URL, fetched through the API search")
+    parser.add_argument("--ids-output", dest="ids_file", help="With --search, also write the identifiers found to this file")
+    parser.add_argument("--manifest", dest="manifest_file", default='sync_manifest.sqlite',
+                        help="Sync manifest file (default: sync_manifest.sqlite)")
+    parser.add_argument("--removed", dest="removed_file", help="Sync: write IDs of records that disappeared to this file")
+    parser.add_argument("--no-transform-cache", dest="transform_cache", action="store_false",
+                        help="Regenerate every row, even for records and config that have not changed")
+    parser.add_argument("--no-reconcile", dest="reconcile", action="store_false",
+                        help="Leave fields with action: reconcile as plain names instead of Wikidata links")
+    parser.add_argument("--collisions", dest="collisions_file",
+                        help="Write a CSV of Commons filenames renamed because they collided within the batch")
+    parser.add_argument("--shard", dest="shard", type=parse_shard, metavar="i/N",
+                        help="Only process the identifiers in shard i of N (0-based), split by a stable hash")
+    parser.add_argument("--merge", dest="merge_files", nargs="+", metavar="FILE",
+                        help="Merge the outputs of a sharded run into one file (-o), ordered and deduplicated")
+    parser.add_argument("-p", "--processes", dest="processes", type=int,
+                        help="Fetch in this process, then transform the records in a pool of this many processes")
+    parser.add_argument("--plan", dest="plan_only", action="store_true",
+                        help="Only report how many identifiers are cached and how long the API calls for the rest will take")
+    parser.add_argument("--prefetch", action="store_true",
+                        help="Only fill the API cache for the identifiers, using a share of the hourly quota")
+    parser.add_argument("--quota-share", dest="quota_share", type=float, default=0.5,
+                        help="Prefetch: share of each hourly API quota to use, 0-1 (default: 0.5)")
+    parser.add_argument("--sdc", dest="sdc_file", metavar="FILE",
+                        help="Add the unit's commons_wikibase statements to the files uploaded from this generated CSV")
+    parser.add_argument("--test-mode", dest="test_mode", action="store_true",
+                        help="With --sdc, log the statements that would be added instead of editing Commons")
+    parser.add_argument("--budget", dest="budget", action="append", metavar="HOST=N",
+                        help="Fail the run if any identifier needs more than N network requests to HOST, e.g. api.si.edu=1")
+    parser.add_argument("--pool-size", dest="pool_size", type=int, help="Keep-alive connections per host")
+    parser.add_argument("--timeout", dest="timeout", type=float, help="HTTP timeout in seconds")
 
     # Parse the command line arguments
     args = parser.parse_args()
 
-    # Check if -c and -u options are set; display usage message and quit if not set
-    if not args.config_file or not args.unit_string:
+    if args.merge_files:
+        merge_shards(args.merge_files, args.output_file, args.collisions_file)
+        return
+
+    # Check if -c and -u (or -r) options are set; display usage message and quit if not set
+    if not args.config_file or not (args.unit_string or args.route):
         parser.print_usage()
-        logging.error('Need to define -c and -u parameters')
+        logging.error('Need to define -c and either -u or -r parameters')
         sys.exit(1)
 
+    wacsession.configure(pool_maxsize=args.pool_size, timeout=args.timeout)
+    transform_cache = TransformCache() if args.transform_cache else None
+    reconciler = Reconciler() if args.reconcile else None
+    budget = wacsession.RequestBudget(wacsession.RequestBudget.parse(args.budget)) if args.budget else None
+    wacsession.set_budget(budget)
+
+    if args.sdc_file:
+        results = write_sdc(args.sdc_file, args.config_file, None if args.route else args.unit_string,
+                            test_mode=args.test_mode)
+        if budget is not None and not budget.check():
+            sys.exit(2)
+        if any(n < 0 for n in results.values()):
+            sys.exit(1)
+        return
+
+    if args.search_url:
+        if not process_search(args.search_url, args.config_file, None if args.route else args.unit_string,
+                              args.output_file, args.ids_file, args.shard, transform_cache=transform_cache,
+                              reconciler=reconciler, collisions_file=args.collisions_file, processes=args.processes):
+            logging.error('This search URL cannot be translated into an API search; scrape it with '
+                          'si-collections-search-dumper.py and pass the identifiers with -i')
+            sys.exit(3)
+        if budget is not None and not budget.check():
+            sys.exit(2)
+        return
+
+    cc0_only = False
+    if args.sync_query and args.sync_query.startswith(('http://', 'https://')):
+        # A collections.si.edu search URL can be synced by its API equivalent
+        cc0_only = sisearch.requires_cc0_media(args.sync_query)
+        args.sync_query = sisearch.collections_url_to_api_query(args.sync_query)
+        if args.sync_query is None:
+            logging.error('This search URL cannot be translated into an API search query')
+            sys.exit(3)
+
+    if args.sync_query:
+        sync_search(args.sync_query, args.config_file, None if args.route else args.unit_string,
+                    args.output_file, args.manifest_file, args.removed_file, transform_cache, reconciler,
+                    args.collisions_file, args.shard, args.processes, cc0_only)
+        if budget is not None and not budget.check():
+            sys.exit(2)
+        return
+
     # If an input file is provided, read identifiers from the file
     if args.input_file:
         with open(args.input_file, 'r') as input_file:
@@ -1063,8 +2733,20 @@ def main():
                 except EOFError:
                     break
 
+    if args.shard:
+        identifiers = [i for i in identifiers if in_shard(i, args.shard)]
+        logging.info(f"Shard {args.shard[0]}/{args.shard[1]}: {len(identifiers)} identifiers")
+
+    if args.prefetch:
+        prefetch(identifiers, args.config_file, None if args.route else args.unit_string, args.quota_share)
+        return
+
     # Call the process_identifiers function with the provided arguments
-    process_identifiers(identifiers, args.config_file, args.unit_string, args.output_file)
+    process_identifiers(identifiers, args.config_file, None if args.route else args.unit_string, args.output_file,
+                        transform_cache=transform_cache, reconciler=reconciler, collisions_file=args.collisions_file,
+                        processes=args.processes, plan_only=args.plan_only)
+    if budget is not None and not budget.check():
+        sys.exit(2)
 
 if __name__ == "__main__":
 